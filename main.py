@@ -24,6 +24,18 @@ from src.grpc.manager import WMCreator
 add_creator(WMCreator)
 from src.measurer import MeasurerCreator
 add_creator(MeasurerCreator)
+from src.scratch import ScratchCreator
+add_creator(ScratchCreator)
+from src.runner import ToolRunnerCreator
+add_creator(ToolRunnerCreator)
+from src.cdn import EdgePoolCreator
+add_creator(EdgePoolCreator)
+from src.download_cache import DownloadCacheCreator
+add_creator(DownloadCacheCreator)
+from src.catalog_cache import CatalogCacheCreator
+add_creator(CatalogCacheCreator)
+from src.artwork_cache import ArtworkCacheCreator
+add_creator(ArtworkCacheCreator)
 
 from src.cmd import InteractiveShell
 
@@ -1,30 +1,45 @@
 import asyncio
-from io import BytesIO
+import base64
+import json
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
 from ssl import SSLError
-from typing import Type
+from contextlib import asynccontextmanager
+from typing import Type, Optional, Callable, Awaitable, AsyncIterator
 
 import hishel
 import httpx
+import m3u8
 import regex
 from creart import AbstractCreator, CreateTargetInfo, exists_module, it
 from httpx import Request, Response, AsyncHTTPTransport
 from tenacity import retry, retry_if_exception_type, wait_random_exponential, stop_after_attempt, before_sleep_log
 
+from src.artwork_cache import ArtworkCache
+from src.catalog_cache import CatalogCache, CATALOG_HOST
+from src.cdn import EdgePool
 from src.config import Config
+from src.download_cache import ByteRange, DownloadCache, PartialDownload
+from src.exceptions import ResumeRejectedException
+from src.limiter import AdaptiveLimiter, BandwidthShaper, Lane, RequestScheduler, TrafficClass
 from src.logger import GlobalLogger
 from src.measurer import SpeedMeasurer
 from src.models import *
+from src.utils import get_next_offset, run_sync
 
 
 class NameSolver:
     def get(self, name: str) -> str:
         if name == "aod.itunes.apple.com":
-            return it(Config).download.appleCDNIP
+            return it(EdgePool).pick()
         return ''
 
     def resolve(self, request: Request) -> Request:
         host = request.url.host
-        ip = self.get(host)
+        # The prober asks for a specific edge
+        ip = request.extensions.get("cdn_edge") or self.get(host)
 
         if ip:
             request.extensions["sni_hostname"] = host
@@ -33,40 +48,206 @@ class NameSolver:
         return request
 
 
+@dataclass
+class CDNStats:
+    requests: int = 0
+    connections: int = 0
+    http2_requests: int = 0
+    rebuilds: int = 0
+
+    def summary(self) -> str:
+        reused = max(self.requests - self.connections, 0)
+        return f"{self.requests} requests over {self.connections} connections " \
+               f"({reused / self.requests if self.requests else 0:.1%} reused, {self.http2_requests} over HTTP/2), " \
+               f"rebuilt {self.rebuilds} times"
+
+
 class AsyncCustomHost(AsyncHTTPTransport):
-    def __init__(self, solver: NameSolver, *args, **kwargs) -> None:
+    def __init__(self, solver: NameSolver, *args, stats: Optional[CDNStats] = None, **kwargs) -> None:
         self.solver = solver
+        self.stats = stats
         super().__init__(*args, **kwargs)
 
+    async def _trace(self, event_name: str, info: dict):
+        if event_name == "connection.connect_tcp.complete":
+            self.stats.connections += 1
+
     async def handle_async_request(self, request: Request) -> Response:
         request = self.solver.resolve(request)
-        return await super().handle_async_request(request)
+        edge = request.url.host if "sni_hostname" in request.extensions else None
+        if self.stats:
+            request.extensions.setdefault("trace", self._trace)
+        start = time.monotonic()
+        try:
+            response = await super().handle_async_request(request)
+        except httpx.TransportError:
+            if edge:
+                it(EdgePool).record_failure(edge)
+            raise
+        if edge:
+            if response.status_code >= 500:
+                it(EdgePool).record_failure(edge)
+            elif response.status_code < 400:
+                # Failures are only forgiven once the body arrived as well
+                it(EdgePool).record_ttfb(edge, time.monotonic() - start)
+        if not self.stats:
+            return response
+        self.stats.requests += 1
+        if response.extensions.get("http_version") == b"HTTP/2":
+            self.stats.http2_requests += 1
+        return response
+
+
+# Ranges smaller than this are not worth another connection
+MIN_RANGE_SIZE = 1024 * 1024
+# Bytes fetched from each edge when probing
+PROBE_SIZE = 256 * 1024
+# Seconds before the expiry of the API token at which it is refreshed
+TOKEN_REFRESH_MARGIN = 24 * 3600
+# Seconds to wait after a refresh that did not produce a newer token
+TOKEN_RETRY_INTERVAL = 600
+# Seconds a parsed HLS playlist is reused
+PLAYLIST_TTL = 60
+# Pages of a catalog listing fetched ahead of the one being consumed
+PAGINATION_WINDOW = 4
+ALBUM_INFO_PARAMS = {"omit[resource]": "autos", "include": "tracks,artists,record-labels", "include[songs]": "artists",
+                     "fields[artists]": "name", "fields[albums:albums]": "artistName,artwork,name,releaseDate,url",
+                     "fields[record-labels]": "name"}
+
+
+def _token_expiry(token: str) -> float:
+    # exp claim of the JWT payload
+    payload = token.split(".")[1]
+    return json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))["exp"]
 
 
 class WebAPI:
     client: httpx.AsyncClient
-    download_lock: asyncio.Semaphore
-    request_lock: asyncio.Semaphore
+    cdn_client: httpx.AsyncClient
+    cdn_settings: tuple
+    cdn_stats: CDNStats
+    _cdn_users: dict[httpx.AsyncClient, int]
+    download_lock: AdaptiveLimiter
+    bandwidth: BandwidthShaper
+    request_lock: RequestScheduler
+    _inflight: dict[tuple, asyncio.Task]
+    _playlists: dict[str, tuple[float, m3u8.M3U8]]
+    connections: int
+    probe_url: Optional[str]
     token: str
+    token_expiry: float
 
-    def __init__(self, proxy: str, parallel_num: int):
+    def __init__(self, proxy: str, parallel_num: int, connections: int = 1, parallel_min: int = 1,
+                 parallel_max: int = 8):
         self._set_token()
         self.client = hishel.AsyncCacheClient(headers={"Authorization": f"Bearer {self.token}",
                                                        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
                                                        "Origin": "https://music.apple.com"},
                                               proxy=proxy if proxy else None)
-        self.download_lock = asyncio.Semaphore(parallel_num)
-        self.request_lock = asyncio.Semaphore(256)
+        self.download_lock = AdaptiveLimiter(parallel_num, parallel_min, parallel_max)
+        self.bandwidth = BandwidthShaper()
+        self.connections = connections
+        self.request_lock = RequestScheduler(256, it(Config).download.laneConcurrency)
+        self._inflight = {}
+        self._playlists = {}
+        self.cdn_stats = CDNStats()
+        self.cdn_settings = self._cdn_settings()
+        self.cdn_client = self._build_cdn_client(self.cdn_settings)
+        self._cdn_users = {self.cdn_client: 0}
+        # An asset URL to probe edges with, known once the first song is downloaded
+        self.probe_url = None
+
+    def _cdn_settings(self) -> tuple:
+        download = it(Config).download
+        # HTTP/2 would multiplex the ranges of a song over one connection
+        http2 = download.cdnHttp2 and self.connections == 1 and exists_module("h2")
+        return download.appleCDNIP, download.cdnPoolSize, http2
+
+    def _build_cdn_client(self, settings: tuple) -> httpx.AsyncClient:
+        _, pool_size, http2 = settings
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        return httpx.AsyncClient(transport=AsyncCustomHost(NameSolver(), stats=self.cdn_stats, http2=http2,
+                                                           limits=limits))
+
+    async def rebuild_cdn_client(self):
+        """Replace the CDN client with one built from the current config, closing the old one once it is idle"""
+        old_client = self.cdn_client
+        self.cdn_settings = self._cdn_settings()
+        self.cdn_client = self._build_cdn_client(self.cdn_settings)
+        self._cdn_users[self.cdn_client] = 0
+        self.cdn_stats.rebuilds += 1
+        if not self._cdn_users[old_client]:
+            del self._cdn_users[old_client]
+            await old_client.aclose()
+
+    @asynccontextmanager
+    async def _cdn(self) -> AsyncIterator[httpx.AsyncClient]:
+        if self._cdn_settings() != self.cdn_settings:
+            await self.rebuild_cdn_client()
+        client = self.cdn_client
+        self._cdn_users[client] += 1
+        try:
+            yield client
+        finally:
+            self._cdn_users[client] -= 1
+            if client is not self.cdn_client and not self._cdn_users[client]:
+                del self._cdn_users[client]
+                await client.aclose()
 
     @retry(retry=retry_if_exception_type((httpx.HTTPError, SSLError, FileNotFoundError)),
            wait=wait_random_exponential(multiplier=1, max=60),
            stop=stop_after_attempt(32))
-    def _set_token(self):
+    def _fetch_token(self) -> str:
         with httpx.Client() as client:
             resp = client.get("https://beta.music.apple.com", follow_redirects=True)
             index_js_uri = regex.findall(r"/assets/index-legacy-[^/]+\.js", resp.text)[0]
             js_resp = client.get("https://beta.music.apple.com" + index_js_uri)
-            self.token = regex.search(r'eyJh([^"]*)', js_resp.text)[0]
+            return regex.search(r'eyJh([^"]*)', js_resp.text)[0]
+
+    def _set_token(self):
+        # The token scraped in an earlier run is used until it is about to expire
+        path = it(Config).download.tokenCache
+        try:
+            token = json.loads(Path(path).read_text())["token"]
+            if _token_expiry(token) > time.time():
+                self._store_token(token, persist=False)
+                return
+        except (OSError, ValueError, KeyError, IndexError, TypeError):
+            pass
+        self._store_token(self._fetch_token())
+
+    def _store_token(self, token: str, persist: bool = True):
+        self.token = token
+        try:
+            self.token_expiry = _token_expiry(token)
+        except (ValueError, KeyError, IndexError, TypeError):
+            self.token_expiry = time.time() + TOKEN_REFRESH_MARGIN * 2
+        if hasattr(self, "client"):
+            self.client.headers["Authorization"] = f"Bearer {token}"
+        path = it(Config).download.tokenCache
+        if persist and path:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            Path(path).write_text(json.dumps({"token": token}))
+
+    async def refresh_token(self):
+        """Scrape a new token, requests in flight keep the old one"""
+        async def refresh():
+            self._store_token(await run_sync(self._fetch_token))
+            it(GlobalLogger).logger.info(f"Refreshed the API token, it expires at "
+                                         f"{datetime.fromtimestamp(self.token_expiry):%Y-%m-%d %H:%M}")
+
+        await self._single_flight(("token",), refresh)
+
+    async def keep_token_fresh(self):
+        while True:
+            await asyncio.sleep(max(self.token_expiry - TOKEN_REFRESH_MARGIN - time.time(), 0))
+            expiry = self.token_expiry
+            try:
+                await self.refresh_token()
+            except Exception as e:
+                it(GlobalLogger).logger.warning(f"Failed to refresh the API token: {e}")
+            if self.token_expiry == expiry:
+                await asyncio.sleep(TOKEN_RETRY_INTERVAL)
 
     # DO NOT REMOVE IT
     def init(self):
@@ -75,77 +256,372 @@ class WebAPI:
     @retry(retry=retry_if_exception_type((httpx.HTTPError, SSLError, FileNotFoundError)),
            wait=wait_random_exponential(multiplier=1, max=60),
            stop=stop_after_attempt(32), before_sleep=before_sleep_log(it(GlobalLogger).logger, "WARNING"))
-    async def _request(self, *args, **kwargs):
-        async with self.request_lock:
-            return await self.client.request(*args, **kwargs)
+    async def _request(self, method: str, url: str, *args, lane: Lane = Lane.METADATA,
+                       traffic: TrafficClass = TrafficClass.API, **kwargs):
+        catalog_url = httpx.Request(method, url, params=kwargs.get("params")).url
+        cacheable = it(CatalogCache).cacheable(method, catalog_url)
+        if cacheable and (cached := await it(CatalogCache).get(catalog_url)):
+            return cached
+        async with self.request_lock.slot(lane):
+            resp = await self.client.request(method, url, *args, **kwargs)
+        if resp.status_code == 401 and catalog_url.host == CATALOG_HOST:
+            # Another request may have refreshed the token already
+            if resp.request.headers.get("Authorization") == f"Bearer {self.token}":
+                await self.refresh_token()
+            async with self.request_lock.slot(lane):
+                resp = await self.client.request(method, url, *args, **kwargs)
+        if not resp.extensions.get("from_cache"):
+            await self.bandwidth.consume(traffic, len(resp.content))
+        if cacheable:
+            await it(CatalogCache).put(catalog_url, resp)
+        return resp
+
+    async def download_song(self, url: str,
+                            on_chunk: Optional[Callable[[bytearray, int], Awaitable[None]]] = None) -> bytearray:
+        """
+        Download the song into a buffer of its full size. on_chunk is awaited with the buffer and the length of
+        the received prefix whenever it grows, the buffer is never resized so views into it stay valid.
+        """
+        try:
+            return await self._download_song(url, on_chunk)
+        except BaseException:
+            # Retries are exhausted or the song was cancelled, nothing will resume the partial download
+            await asyncio.shield(it(DownloadCache).discard(url))
+            raise
 
     @retry(retry=retry_if_exception_type((httpx.HTTPError, SSLError, FileNotFoundError)),
            wait=wait_random_exponential(multiplier=1, max=60),
            stop=stop_after_attempt(32), before_sleep=before_sleep_log(it(GlobalLogger).logger, "WARNING"))
-    async def download_song(self, url: str) -> bytes:
+    async def _download_song(self, url: str,
+                             on_chunk: Optional[Callable[[bytearray, int], Awaitable[None]]]) -> bytearray:
+        self.probe_url = url
         async with self.download_lock:
-            result = BytesIO()
-            async with httpx.AsyncClient(transport=AsyncCustomHost(NameSolver())) as client:
-                async with client.stream('GET', url) as response:
-                    total = int(response.headers.get("Content-Length") if response.headers.get("Content-Length")
-                                else response.headers.get("X-Apple-MS-Content-Length"))
+            download = await it(DownloadCache).open(url)
+            if download and download.complete:
+                if on_chunk:
+                    await on_chunk(download.buffer, download.total)
+                return download.buffer
+            async with self._cdn() as client:
+                try:
+                    if self.connections > 1:
+                        result = await self._download_ranges(client, url, on_chunk, download)
+                        if result is not None:
+                            return result
+                    return await self._download_stream(client, url, on_chunk, download)
+                except httpx.TimeoutException:
+                    self.download_lock.record_error()
+                    raise
+                except ResumeRejectedException as e:
+                    # The song changed on the CDN since the partial download was made, start over
+                    await it(DownloadCache).discard(url)
+                    raise httpx.HTTPError(str(e)) from e
+
+    def _check_throttled(self, response: Response):
+        if response.status_code == 429 or response.status_code >= 500:
+            self.download_lock.record_error()
+            raise httpx.HTTPError(f"CDN answered {response.status_code}")
+
+    async def _finish_download(self, download: PartialDownload) -> bytearray:
+        received = sum(byte_range.received for byte_range in download.ranges)
+        if received != download.total:
+            raise httpx.HTTPError(f"Received {received} of {download.total} bytes")
+        await it(DownloadCache).finish(download)
+        # The buffer is handed over as is, views of the streamed samples point into it
+        return download.buffer
+
+    async def _download_stream(self, client: httpx.AsyncClient, url: str,
+                               on_chunk: Optional[Callable[[bytearray, int], Awaitable[None]]],
+                               download: Optional[PartialDownload]) -> bytearray:
+        headers = {}
+        if download:
+            # Resume after the contiguous data of an earlier attempt
+            download.restart_from_prefix()
+            if download.ranges[0].received == download.total:
+                if on_chunk:
+                    await on_chunk(download.buffer, download.total)
+                return await self._finish_download(download)
+            headers["Range"] = f"bytes={download.ranges[0].received}-"
+            if download.etag:
+                headers["If-Range"] = download.etag
+        async with client.stream('GET', url, headers=headers) as response:
+            self._check_throttled(response)
+            content_range = response.headers.get("Content-Range", "")
+            if download and (response.status_code != 206 or content_range !=
+                             f"bytes {download.ranges[0].received}-{download.total - 1}/{download.total}"):
+                if response.status_code != 200:
+                    raise ResumeRejectedException(f"Resume rejected: {response.status_code} {content_range}")
+                # The whole file, it changed since the partial download was made
+                download = None
+            if not download:
+                if response.status_code != 200:
+                    raise httpx.HTTPError(f"Unexpected response: {response.status_code} {content_range}")
+                total = int(response.headers.get("Content-Length") if response.headers.get("Content-Length")
+                            else response.headers.get("X-Apple-MS-Content-Length"))
+                download = await it(DownloadCache).create(url, total, response.headers.get("ETag"),
+                                                          [ByteRange(0, total)])
+            byte_range = download.ranges[0]
+            if on_chunk and byte_range.received:
+                await on_chunk(download.buffer, byte_range.received)
+            start = byte_range.received
+            transfer_start = time.monotonic()
+            try:
+                async for chunk in response.aiter_bytes():
+                    await self.bandwidth.consume(TrafficClass.AUDIO, len(chunk))
+                    it(SpeedMeasurer).record_download(len(chunk))
+                    if byte_range.received + len(chunk) > download.total:
+                        raise httpx.HTTPError(f"Received more than {download.total} bytes")
+                    download.buffer[byte_range.received:byte_range.received + len(chunk)] = chunk
+                    byte_range.received += len(chunk)
+                    await it(DownloadCache).flush(download)
+                    if on_chunk:
+                        await on_chunk(download.buffer, byte_range.received)
+            except httpx.HTTPError:
+                it(EdgePool).record_failure(response.request.url.host)
+                await it(DownloadCache).flush(download, force=True)
+                raise
+            it(EdgePool).record_success(response.request.url.host, size=byte_range.received - start,
+                                        elapsed=time.monotonic() - transfer_start)
+        return await self._finish_download(download)
+
+    async def _download_ranges(self, client: httpx.AsyncClient, url: str,
+                               on_chunk: Optional[Callable[[bytearray, int], Awaitable[None]]],
+                               download: Optional[PartialDownload]) -> Optional[bytes]:
+        """Download the song over several connections by byte ranges, return None if the CDN ignores ranges"""
+        if not download:
+            async with client.stream('GET', url, headers={"Range": "bytes=0-0"}) as response:
+                self._check_throttled(response)
+                content_range = response.headers.get("Content-Range", "")
+                if response.status_code != 206 or not content_range.startswith("bytes 0-0/"):
+                    return None
+                total = int(content_range.rsplit("/", 1)[1])
+                etag = response.headers.get("ETag")
+            count = max(1, min(self.connections, total // MIN_RANGE_SIZE))
+            download = await it(DownloadCache).create(url, total, etag, [ByteRange(total * i // count,
+                                                                                   total * (i + 1) // count)
+                                                                         for i in range(count)])
+        reported = 0
+        report_lock = asyncio.Lock()
+
+        async def report():
+            # Only the contiguous prefix is useful to on_chunk
+            nonlocal reported
+            async with report_lock:
+                filled = download.prefix()
+                if filled > reported:
+                    reported = filled
+                    await on_chunk(download.buffer, filled)
+
+        if on_chunk:
+            await report()
+        tasks = [asyncio.create_task(self._download_range(client, url, download, byte_range,
+                                                          report if on_chunk else None))
+                 for byte_range in download.ranges]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException as e:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # A rejected resume is discarded by the caller
+            if not isinstance(e, ResumeRejectedException):
+                await it(DownloadCache).flush(download, force=True)
+            raise
+        return await self._finish_download(download)
+
+    @retry(retry=retry_if_exception_type((httpx.HTTPError, SSLError)),
+           wait=wait_random_exponential(multiplier=1, max=30),
+           stop=stop_after_attempt(8), before_sleep=before_sleep_log(it(GlobalLogger).logger, "WARNING"))
+    async def _download_range(self, client: httpx.AsyncClient, url: str, download: PartialDownload,
+                              byte_range: ByteRange, on_progress: Optional[Callable[[], Awaitable[None]]]):
+        # A retry resumes from the bytes already received
+        start = byte_range.start + byte_range.received
+        if start >= byte_range.end:
+            return
+        headers = {"Range": f"bytes={start}-{byte_range.end - 1}"}
+        if download.etag:
+            # The CDN answers with the whole file if it has changed since the first range
+            headers["If-Range"] = download.etag
+        async with client.stream('GET', url, headers=headers) as response:
+            self._check_throttled(response)
+            if response.status_code != 206 or \
+                    response.headers.get("Content-Range") != f"bytes {start}-{byte_range.end - 1}/{download.total}":
+                raise ResumeRejectedException(f"Unexpected response to range {start}-{byte_range.end - 1}: "
+                                              f"{response.status_code} {response.headers.get('Content-Range')}")
+            transfer_start = time.monotonic()
+            try:
+                async for chunk in response.aiter_bytes():
+                    await self.bandwidth.consume(TrafficClass.AUDIO, len(chunk))
+                    it(SpeedMeasurer).record_download(len(chunk))
+                    offset = byte_range.start + byte_range.received
+                    if offset + len(chunk) > byte_range.end:
+                        raise httpx.HTTPError(f"Received more than range {byte_range.start}-{byte_range.end - 1}")
+                    download.buffer[offset:offset + len(chunk)] = chunk
+                    byte_range.received += len(chunk)
+                    await it(DownloadCache).flush(download)
+                    if on_progress:
+                        await on_progress()
+            except httpx.HTTPError as e:
+                it(EdgePool).record_failure(response.request.url.host)
+                if isinstance(e, httpx.TimeoutException):
+                    self.download_lock.record_error()
+                raise
+            it(EdgePool).record_success(response.request.url.host,
+                                        size=byte_range.start + byte_range.received - start,
+                                        elapsed=time.monotonic() - transfer_start)
+        if byte_range.start + byte_range.received != byte_range.end:
+            raise httpx.HTTPError(f"Range {byte_range.start}-{byte_range.end - 1} ended early")
+
+    async def probe_cdn_edges(self):
+        """Measure every CDN edge periodically, so edges are scored and re-admitted without waiting for downloads"""
+        while True:
+            if it(Config).download.cdnProbeInterval > 0 and self.probe_url:
+                for ip in list(it(EdgePool).edges):
+                    await self._probe_edge(ip)
+            await asyncio.sleep(it(Config).download.cdnProbeInterval or 60)
+
+    async def _probe_edge(self, ip: str):
+        start = time.monotonic()
+        size = 0
+        headers_received = False
+        try:
+            async with self._cdn() as client:
+                async with client.stream('GET', self.probe_url, headers={"Range": f"bytes=0-{PROBE_SIZE - 1}"},
+                                         extensions={"cdn_edge": ip}) as response:
+                    headers_received = True
+                    # Failures of the edge itself (5xx) are recorded by the transport
+                    if response.status_code not in (200, 206):
+                        return
                     async for chunk in response.aiter_bytes():
-                        it(SpeedMeasurer).record_download(len(chunk))
-                        result.write(chunk)
-                if len(result.getvalue()) != total:
-                    raise httpx.HTTPError
-                return result.getvalue()
-
-    async def get_album_info(self, album_id: str, storefront: str, lang: str):
+                        await self.bandwidth.consume(TrafficClass.AUDIO, len(chunk))
+                        size += len(chunk)
+        except httpx.HTTPError:
+            # Failures before the headers arrived are recorded by the transport
+            if headers_received:
+                it(EdgePool).record_failure(ip)
+            return
+        it(EdgePool).record_success(ip, size=size, elapsed=time.monotonic() - start)
+
+    async def _single_flight(self, key: tuple, factory: Callable[[], Awaitable]):
+        """Concurrent calls with the same key share the result of the first one"""
+        if key not in self._inflight:
+            # The lookup runs on its own, so that a cancelled caller does not cancel it for the others
+            task = asyncio.create_task(factory())
+            # Nobody may be waiting for the shared task when it fails
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            task.add_done_callback(lambda t: self._inflight.pop(key, None) if self._inflight.get(key) is t else None)
+            self._inflight[key] = task
+        return await asyncio.shield(self._inflight[key])
+
+    async def get_album_info(self, album_id: str, storefront: str, lang: str) -> AlbumMeta:
+        return await self._single_flight(("album", album_id, storefront, lang),
+                                         lambda: self._get_album_info(album_id, storefront, lang))
+
+    async def _get_album_info(self, album_id: str, storefront: str, lang: str):
         req = await self._request("GET",
                                   f"https://amp-api.music.apple.com/v1/catalog/{storefront}/albums/{album_id}",
-                                  params={"omit[resource]": "autos", "include": "tracks,artists,record-labels",
-                                          "include[songs]": "artists", "fields[artists]": "name",
-                                          "fields[albums:albums]": "artistName,artwork,name,releaseDate,url",
-                                          "fields[record-labels]": "name", "l": lang})
+                                  params={**ALBUM_INFO_PARAMS, "l": lang})
         album_info_obj = AlbumMeta.model_validate(req.json())
-        if album_info_obj.data[0].relationships.tracks.next:
-            all_tracks = await self.get_album_tracks(album_id, storefront, lang)
-            album_info_obj.data[0].relationships.tracks.data = all_tracks
+        await self._complete_album_tracks(album_info_obj, storefront, lang)
         return album_info_obj
 
+    async def get_albums_info(self, album_ids: list[str], storefront: str, lang: str) -> list[AlbumMeta]:
+        """Info of several albums in one request, each as its own AlbumMeta"""
+        req = await self._request("GET", f"https://amp-api.music.apple.com/v1/catalog/{storefront}/albums",
+                                  params={**ALBUM_INFO_PARAMS, "ids": ",".join(album_ids), "l": lang})
+        albums = [AlbumMeta(data=[album]) for album in AlbumMeta.model_validate(req.json()).data]
+        await asyncio.gather(*[self._complete_album_tracks(album, storefront, lang) for album in albums])
+        return albums
+
+    async def _complete_album_tracks(self, album_info_obj: AlbumMeta, storefront: str, lang: str):
+        tracks = album_info_obj.data[0].relationships.tracks
+        if tracks.next:
+            tracks.data.extend(await self.get_album_tracks(album_info_obj.data[0].id, storefront, lang,
+                                                           get_next_offset(tracks.next)))
+
+    async def _paginate(self, url: str, params: dict, offset: int = 0) -> AsyncIterator[dict]:
+        """
+        Yield the pages of a catalog listing in order. The page size is taken from the "next" of the first page,
+        the following pages are fetched concurrently, up to meta.total when the listing reports it. Otherwise the
+        window opens gradually, doubling with every page that has a next one up to PAGINATION_WINDOW pages ahead
+        """
+        async def fetch(page_offset: int) -> dict:
+            resp = await self._request("GET", url, params={**params, "offset": page_offset})
+            if resp.status_code != 200:
+                raise httpx.HTTPStatusError(f"Listing page at offset {page_offset} returned {resp.status_code}",
+                                            request=resp.request, response=resp)
+            return resp.json()
+
+        page = await fetch(offset)
+        yield page
+        if not page.get("next"):
+            return
+        total = page.get("meta", {}).get("total")
+        next_offset = get_next_offset(page["next"])
+        page_size = next_offset - offset
+        if page_size <= 0:
+            return
+        # Without a total the end of the listing is unknown, pages past it would be fetched for nothing
+        window = PAGINATION_WINDOW if total is not None else 1
+        pending: dict[int, asyncio.Task] = {}
+        try:
+            while True:
+                while len(pending) < window and (total is None or next_offset < total):
+                    pending[next_offset] = asyncio.create_task(fetch(next_offset))
+                    next_offset += page_size
+                if not pending:
+                    return
+                page = await pending.pop(min(pending))
+                yield page
+                if not page.get("next") or not page.get("data"):
+                    return
+                window = min(window * 2, PAGINATION_WINDOW)
+        finally:
+            # Pages probed past the end of the listing are dropped
+            for task in pending.values():
+                task.cancel()
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    async def iter_album_tracks(self, album_id: str, storefront: str, lang: str, offset: int = 0):
+        async for page in self._paginate(f"https://amp-api.music.apple.com/v1/catalog/{storefront}/albums/{album_id}/tracks",
+                                         {"l": lang}, offset):
+            yield AlbumTracks.model_validate(page).data or []
+
     async def get_album_tracks(self, album_id: str, storefront: str, lang: str, offset: int = 0):
-        req = await self._request("GET", f"https://amp-api.music.apple.com/v1/catalog/{storefront}/albums/{album_id}/tracks?offset={offset}")
-        album_info_obj = AlbumTracks.model_validate(req.json())
-        tracks = album_info_obj.data
-        if album_info_obj.next:
-            next_tracks = await self.get_album_tracks(album_id, storefront, lang, offset + 300)
-            tracks.extend(next_tracks)
-        return tracks
-
-    async def get_playlist_info_and_tracks(self, playlist_id: str, storefront: str, lang: str):
+        return [track async for tracks in self.iter_album_tracks(album_id, storefront, lang, offset)
+                for track in tracks]
+
+    async def get_playlist_info(self, playlist_id: str, storefront: str, lang: str):
+        """Playlist info with the first page of its tracks"""
         resp = await self._request("GET",
                                    f"https://amp-api.music.apple.com/v1/catalog/{storefront}/playlists/{playlist_id}",
                                    params={"l": lang})
-        playlist_info_obj = PlaylistInfo.model_validate(resp.json())
-        if playlist_info_obj.data[0].relationships.tracks.next:
-            all_tracks = await self.get_playlist_tracks(playlist_id, storefront, lang)
-            playlist_info_obj.data[0].relationships.tracks.data = all_tracks
-        return playlist_info_obj
+        return PlaylistInfo.model_validate(resp.json())
 
-    async def get_playlist_tracks(self, playlist_id: str, storefront: str, lang: str, offset: int = 0):
-        resp = await self._request("GET",
-                                   f"https://amp-api.music.apple.com/v1/catalog/{storefront}/playlists/{playlist_id}/tracks",
-                                   params={"l": lang, "offset": offset})
-        playlist_tracks = PlaylistTracks.model_validate(resp.json())
-        tracks = playlist_tracks.data
-        if playlist_tracks.next:
-            next_tracks = await self.get_playlist_tracks(playlist_id, storefront, lang, offset + 100)
-            tracks.extend(next_tracks)
-        return tracks
+    async def iter_playlist_tracks(self, playlist_id: str, storefront: str, lang: str, offset: int = 0):
+        async for page in self._paginate(f"https://amp-api.music.apple.com/v1/catalog/{storefront}/playlists/{playlist_id}/tracks",
+                                         {"l": lang}, offset):
+            yield PlaylistTracks.model_validate(page).data
 
     async def get_cover(self, url: str, cover_format: str, cover_size: str):
-        async with self.request_lock:
-            formatted_url = regex.sub('bb.jpg', f'bb.{cover_format}', url)
-            req = await self._request("GET", formatted_url.replace("{w}x{h}", cover_size))
+        formatted_url = regex.sub('bb.jpg', f'bb.{cover_format}', url).replace("{w}x{h}", cover_size)
+
+        async def fetch():
+            req = await self._request("GET", formatted_url, lane=Lane.ARTWORK, traffic=TrafficClass.ARTWORK)
+            # Error pages must not end up cached as the cover
+            req.raise_for_status()
             return req.content
 
+        try:
+            return await it(ArtworkCache).get(formatted_url, fetch)
+        except httpx.HTTPStatusError as e:
+            it(GlobalLogger).logger.warning(f"Failed to download cover: {e}")
+            return None
+
     async def get_song_info(self, song_id: str, storefront: str, lang: str):
+        return await self._single_flight(("song", song_id, storefront, lang),
+                                         lambda: self._get_song_info(song_id, storefront, lang))
+
+    async def _get_song_info(self, song_id: str, storefront: str, lang: str):
         req = await self._request("GET", f"https://amp-api.music.apple.com/v1/catalog/{storefront}/songs/{song_id}",
                                   params={"extend": "extendedAssetUrls", "include": "albums,explicit", "l": lang})
         song_data_obj = SongData.model_validate(req.json())
@@ -154,39 +630,35 @@ class WebAPI:
                 return data
         return None
 
+    async def get_songs_info(self, song_ids: list[str], storefront: str, lang: str):
+        req = await self._request("GET", f"https://amp-api.music.apple.com/v1/catalog/{storefront}/songs",
+                                  params={"ids": ",".join(song_ids), "extend": "extendedAssetUrls",
+                                          "include": "albums,explicit", "l": lang})
+        return SongData.model_validate(req.json()).data
+
     async def song_exist(self, song_id: str, storefront: str):
-        req = await self._request("HEAD", f"https://amp-api.music.apple.com/v1/catalog/{storefront}/songs/{song_id}")
+        req = await self._request("HEAD", f"https://amp-api.music.apple.com/v1/catalog/{storefront}/songs/{song_id}",
+                                  lane=Lane.EXISTENCE)
         if req.status_code == 200:
             return True
         return False
 
     async def album_exist(self, album_id: str, storefront: str):
-        req = await self._request("HEAD", f"https://amp-api.music.apple.com/v1/catalog/{storefront}/albums/{album_id}")
+        req = await self._request("HEAD", f"https://amp-api.music.apple.com/v1/catalog/{storefront}/albums/{album_id}",
+                                  lane=Lane.EXISTENCE)
         if req.status_code == 200:
             return True
         return False
 
-    async def get_albums_from_artist(self, artist_id: str, storefront: str, lang: str, offset: int = 0):
-        resp = await self._request("GET",
-                                   f"https://amp-api.music.apple.com/v1/catalog/{storefront}/artists/{artist_id}/albums",
-                                   params={"l": lang, "offset": offset})
-        artist_album = ArtistAlbums.model_validate(resp.json())
-        albums = [album.attributes.url for album in artist_album.data]
-        if artist_album.next:
-            next_albums = await self.get_albums_from_artist(artist_id, storefront, lang, offset + 25)
-            albums.extend(next_albums)
-        return list(set(albums))
-
-    async def get_songs_from_artist(self, artist_id: str, storefront: str, lang: str, offset: int = 0):
-        resp = await self._request("GET",
-                                   f"https://amp-api.music.apple.com/v1/catalog/{storefront}/artists/{artist_id}/songs",
-                                   params={"l": lang, "offset": offset})
-        artist_song = ArtistSongs.model_validate(resp.json())
-        songs = [song.attributes.url for song in artist_song.data]
-        if artist_song.next:
-            next_songs = await self.get_songs_from_artist(artist_id, storefront, lang, offset + 20)
-            songs.extend(next_songs)
-        return list(set(songs))
+    async def iter_albums_from_artist(self, artist_id: str, storefront: str, lang: str):
+        async for page in self._paginate(f"https://amp-api.music.apple.com/v1/catalog/{storefront}/artists/{artist_id}/albums",
+                                         {"l": lang}):
+            yield [album.attributes.url for album in ArtistAlbums.model_validate(page).data]
+
+    async def iter_songs_from_artist(self, artist_id: str, storefront: str, lang: str):
+        async for page in self._paginate(f"https://amp-api.music.apple.com/v1/catalog/{storefront}/artists/{artist_id}/songs",
+                                         {"l": lang}):
+            yield [song.attributes.url for song in ArtistSongs.model_validate(page).data]
 
     async def get_artist_info(self, artist_id: str, storefront: str, lang: str):
         resp = await self._request("GET",
@@ -194,12 +666,27 @@ class WebAPI:
                                    params={"l": lang})
         return ArtistInfo.model_validate(resp.json())
 
+    async def get_m3u8(self, m3u8_url: str) -> m3u8.M3U8:
+        """Parsed playlist, shared by everyone asking for the same URL within PLAYLIST_TTL seconds"""
+        cached = self._playlists.get(m3u8_url)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        async def load():
+            parsed = m3u8.loads(await self.download_m3u8(m3u8_url), uri=m3u8_url)
+            now = time.monotonic()
+            self._playlists = {url: entry for url, entry in self._playlists.items() if entry[0] > now}
+            self._playlists[m3u8_url] = (now + PLAYLIST_TTL, parsed)
+            return parsed
+
+        return await self._single_flight(("m3u8", m3u8_url), load)
+
     async def download_m3u8(self, m3u8_url: str) -> str:
-        resp = await self._request("GET", m3u8_url)
+        resp = await self._request("GET", m3u8_url, lane=Lane.INTERACTIVE)
         return resp.text
 
     async def get_real_url(self, url: str):
-        req = await self._request("GET", url, follow_redirects=True)
+        req = await self._request("GET", url, lane=Lane.INTERACTIVE, follow_redirects=True)
         return str(req.url)
 
     async def get_album_by_upc(self, upc: str, storefront: str):
@@ -238,4 +725,6 @@ class APICreator(AbstractCreator):
 
     @staticmethod
     def create(create_type: Type[WebAPI]) -> WebAPI:
-        return create_type(it(Config).download.proxy, it(Config).download.parallelNum)
+        return create_type(it(Config).download.proxy, it(Config).download.parallelNum,
+                           it(Config).download.connectionsPerSong, it(Config).download.parallelNumMin,
+                           it(Config).download.parallelNumMax)
@@ -0,0 +1,127 @@
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Type, Callable, Awaitable
+from urllib.parse import urlsplit
+
+from creart import AbstractCreator, CreateTargetInfo, exists_module, it
+
+from src.config import Config
+from src.utils import run_sync
+
+
+def _artwork_key(url: str) -> str:
+    # Artwork is served by several mzstatic hosts, the path alone identifies the image, format and size
+    return hashlib.sha256(urlsplit(url).path.encode()).hexdigest()[:32]
+
+
+class ArtworkCache:
+    """
+    Covers kept in memory by LRU within a byte budget and optionally on disk, so that the songs of an album
+    download their cover once
+    """
+    root: Optional[Path]
+    max_memory: int
+    max_size: int
+    memory: OrderedDict[str, bytes]
+    memory_size: int
+    hits: int
+    misses: int
+    _inflight: dict[str, asyncio.Task]
+
+    def __init__(self, root: str, max_memory: int, max_size: int):
+        self.root = Path(root) if root else None
+        self.max_memory = max_memory
+        self.max_size = max_size
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.hits = 0
+        self.misses = 0
+        self._inflight = {}
+        if self.root:
+            self.root.mkdir(parents=True, exist_ok=True)
+
+    async def get(self, url: str, fetch: Callable[[], Awaitable[bytes]]) -> bytes:
+        key = _artwork_key(url)
+        if key in self.memory:
+            self.hits += 1
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if key in self._inflight:
+            self.hits += 1
+        else:
+            # The download is its own task, so cancelling one of the songs waiting for it does not cancel the others
+            task = asyncio.create_task(self._load(key, fetch))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            task.add_done_callback(lambda t: self._inflight.pop(key, None) if self._inflight.get(key) is t else None)
+            self._inflight[key] = task
+        return await asyncio.shield(self._inflight[key])
+
+    async def _load(self, key: str, fetch: Callable[[], Awaitable[bytes]]) -> bytes:
+        data = await run_sync(self._read, key) if self.root else None
+        if data is None:
+            self.misses += 1
+            data = await fetch()
+            if self.root:
+                await run_sync(self._write, key, data)
+        else:
+            self.hits += 1
+        self._remember(key, data)
+        return data
+
+    def _remember(self, key: str, data: bytes):
+        if len(data) > self.max_memory:
+            return
+        self.memory[key] = data
+        self.memory_size += len(data)
+        while self.memory_size > self.max_memory:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_size -= len(evicted)
+
+    def _read(self, key: str) -> Optional[bytes]:
+        path = self.root / key
+        try:
+            data = path.read_bytes()
+        except OSError:
+            return None
+        os.utime(path)
+        return data
+
+    def _write(self, key: str, data: bytes):
+        tmp_path = self.root / f"{key}.tmp"
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, self.root / key)
+        # Least recently used first
+        entries = []
+        for path in self.root.iterdir():
+            try:
+                entries.append((path.stat().st_mtime, path.stat().st_size, path))
+            except OSError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def summary(self) -> str:
+        return f"{self.hits} hits, {self.misses} downloads, {len(self.memory)} covers " \
+               f"({self.memory_size / 1024 / 1024:.2f} MB) in memory"
+
+
+class ArtworkCacheCreator(AbstractCreator):
+    targets = (
+        CreateTargetInfo("src.artwork_cache", "ArtworkCache"),
+    )
+
+    @staticmethod
+    def available() -> bool:
+        return exists_module("src.artwork_cache")
+
+    @staticmethod
+    def create(create_type: Type[ArtworkCache]) -> ArtworkCache:
+        return create_type(it(Config).download.artworkCache, it(Config).download.artworkMemoryCache * 1024 * 1024,
+                           it(Config).download.artworkCacheSize * 1024 * 1024)
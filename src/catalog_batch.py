@@ -0,0 +1,128 @@
+import asyncio
+from typing import Optional, Callable, Awaitable
+
+from creart import it
+
+from src.api import WebAPI
+from src.logger import GlobalLogger
+from src.models import AlbumMeta
+from src.models.song_data import Datum
+from src.utils import chunk
+
+# IDs requested within this many seconds are resolved together
+BATCH_DELAY = 0.05
+SONGS_PER_REQUEST = 100
+# Album responses include their tracks, so they are requested in smaller chunks
+ALBUMS_PER_REQUEST = 20
+
+
+class BatchLoader:
+    """Coalesces the IDs requested by concurrent callers and resolves them in chunks through one callable"""
+    resolve: Callable[[list[str]], Awaitable[dict]]
+    chunk_size: int
+    futures: dict[str, asyncio.Future]
+    requests: int
+    _queue: list[str]
+    _flush_task: Optional[asyncio.Task]
+
+    def __init__(self, resolve: Callable[[list[str]], Awaitable[dict]], chunk_size: int):
+        self.resolve = resolve
+        self.chunk_size = chunk_size
+        self.futures = {}
+        self.requests = 0
+        self._queue = []
+        self._flush_task = None
+
+    def prefetch(self, ids: list[str]):
+        for item_id in ids:
+            if item_id not in self.futures:
+                self.futures[item_id] = asyncio.get_running_loop().create_future()
+                self._queue.append(item_id)
+        if self._queue and not self._flush_task:
+            self._flush_task = asyncio.create_task(self._flush())
+
+    def prime(self, item_id: str, item):
+        """Resolve an item that was already loaded by other means"""
+        if item_id not in self.futures or self.futures[item_id].done():
+            self.futures[item_id] = asyncio.get_running_loop().create_future()
+        self.futures[item_id].set_result(item)
+
+    async def load(self, item_id: str):
+        """The resolved item, or None when it could not be resolved in a batch"""
+        self.prefetch([item_id])
+        return await asyncio.shield(self.futures[item_id])
+
+    async def _flush(self):
+        await asyncio.sleep(BATCH_DELAY)
+        queue, self._queue, self._flush_task = self._queue, [], None
+        await asyncio.gather(*[self._resolve_chunk(list(ids)) for ids in chunk(queue, self.chunk_size)],
+                             return_exceptions=True)
+
+    async def _resolve_chunk(self, ids: list[str]):
+        self.requests += 1
+        items = {}
+        try:
+            items = await self.resolve(ids)
+        except Exception as e:
+            it(GlobalLogger).logger.warning(f"Batched catalog request failed, loading {len(ids)} items one by one: {e}")
+        finally:
+            # Whatever went wrong, callers must not wait forever, they load the items left over one by one
+            for item_id in ids:
+                if not self.futures[item_id].done():
+                    self.futures[item_id].set_result(items.get(item_id))
+
+
+class CatalogBatch:
+    """
+    Song and album metadata of one album or playlist job, loaded with songs?ids= and albums?ids= instead of
+    one request per song. Albums referenced by the songs are resolved as soon as their songs are
+    """
+    storefront: str
+    language: str
+    songs: BatchLoader
+    albums: BatchLoader
+    fallbacks: int
+
+    def __init__(self, storefront: str, language: str):
+        self.storefront = storefront
+        self.language = language
+        self.songs = BatchLoader(self._resolve_songs, SONGS_PER_REQUEST)
+        self.albums = BatchLoader(self._resolve_albums, ALBUMS_PER_REQUEST)
+        self.fallbacks = 0
+
+    async def _resolve_songs(self, ids: list[str]) -> dict[str, Datum]:
+        songs = {song.id: song for song in await it(WebAPI).get_songs_info(ids, self.storefront, self.language)}
+        self.albums.prefetch(list(dict.fromkeys(song.relationships.albums.data[0].id for song in songs.values()
+                                                if song.relationships.albums.data)))
+        return songs
+
+    async def _resolve_albums(self, ids: list[str]) -> dict[str, AlbumMeta]:
+        albums = await it(WebAPI).get_albums_info(ids, self.storefront, self.language)
+        return {album.data[0].id: album for album in albums}
+
+    def prime_album(self, album: AlbumMeta):
+        self.albums.prime(album.data[0].id, album)
+
+    def prefetch(self, song_ids: list[str]):
+        self.songs.prefetch(song_ids)
+
+    async def song_info(self, song_id: str) -> Optional[Datum]:
+        song = await self.songs.load(song_id)
+        if not song:
+            self.fallbacks += 1
+            song = await it(WebAPI).get_song_info(song_id, self.storefront, self.language)
+            self.songs.prime(song_id, song)
+        return song
+
+    async def album_info(self, album_id: str) -> AlbumMeta:
+        album = await self.albums.load(album_id)
+        if not album:
+            self.fallbacks += 1
+            album = await it(WebAPI).get_album_info(album_id, self.storefront, self.language)
+            self.albums.prime(album_id, album)
+        return album
+
+    def summary(self) -> str:
+        return f"metadata of {len(self.songs.futures)} songs and {len(self.albums.futures)} albums loaded in " \
+               f"{self.songs.requests + self.albums.requests + self.fallbacks} requests " \
+               f"({self.fallbacks} outside of batches)"
@@ -0,0 +1,123 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Optional, Type
+
+import httpx
+from creart import AbstractCreator, CreateTargetInfo, exists_module, it
+
+from src.config import Config
+from src.utils import run_sync
+
+# Set by `dl --no-cache`, inherited by every task created for that download
+bypass_catalog_cache: ContextVar[bool] = ContextVar("bypass_catalog_cache", default=False)
+
+CATALOG_HOST = "amp-api.music.apple.com"
+
+
+def _resource_type(url: httpx.URL) -> str:
+    # /v1/catalog/{storefront}/{type}/...
+    parts = url.path.split("/")
+    return parts[4] if len(parts) > 4 and parts[2] == "catalog" else "default"
+
+
+class CatalogCache:
+    """Catalog responses of the Apple Music API kept in SQLite, expired by TTLs per resource type and evicted by LRU"""
+    max_size: int
+    ttls: dict[str, int]
+    size: int
+    hits: int
+    misses: int
+    _db: Optional[sqlite3.Connection]
+    _lock: threading.Lock
+
+    def __init__(self, path: str, max_size: int, ttls: dict[str, int]):
+        self.max_size = max_size
+        self.ttls = ttls
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        self._lock = threading.Lock()
+        if path:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, body BLOB, size INTEGER, "
+                             "stored REAL, accessed REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self.size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def cacheable(method: str, url: httpx.URL) -> bool:
+        return method == "GET" and url.host == CATALOG_HOST and "/catalog/" in url.path
+
+    @staticmethod
+    def _key(url: httpx.URL) -> str:
+        # Storefront and endpoint are in the path, language and the other params in the query
+        query = "&".join(f"{key}={value}" for key, value in sorted(url.params.multi_items()))
+        return hashlib.sha256(f"{url.path}?{query}".encode()).hexdigest()
+
+    def _get(self, url: httpx.URL) -> Optional[bytes]:
+        ttl = self.ttls.get(_resource_type(url), self.ttls.get("default", 0))
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT body, stored FROM responses WHERE key = ?", (self._key(url),)).fetchone()
+            if not row or now - row[1] > ttl:
+                return None
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, self._key(url)))
+            self._db.commit()
+            return row[0]
+
+    def _put(self, url: httpx.URL, body: bytes):
+        now = time.time()
+        with self._lock:
+            old = self._db.execute("SELECT size FROM responses WHERE key = ?", (self._key(url),)).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                             (self._key(url), body, len(body), now, now))
+            self.size += len(body) - (old[0] if old else 0)
+            # Least recently used first
+            while self.size > self.max_size:
+                row = self._db.execute("SELECT key, size FROM responses ORDER BY accessed LIMIT 1").fetchone()
+                if not row:
+                    break
+                self._db.execute("DELETE FROM responses WHERE key = ?", (row[0],))
+                self.size -= row[1]
+            self._db.commit()
+
+    async def get(self, url: httpx.URL) -> Optional[httpx.Response]:
+        if not self._db or bypass_catalog_cache.get():
+            return None
+        body = await run_sync(self._get, url)
+        if body is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return httpx.Response(200, content=body, headers={"Content-Type": "application/json"},
+                              request=httpx.Request("GET", url))
+
+    async def put(self, url: httpx.URL, response: httpx.Response):
+        if self._db and response.status_code == 200:
+            await run_sync(self._put, url, response.content)
+
+    def summary(self) -> str:
+        total = self.hits + self.misses
+        return f"{self.hits} hits, {self.misses} misses ({self.hits / total if total else 0:.1%} hit rate), " \
+               f"{self.size / 1024 / 1024:.2f} MB"
+
+
+class CatalogCacheCreator(AbstractCreator):
+    targets = (
+        CreateTargetInfo("src.catalog_cache", "CatalogCache"),
+    )
+
+    @staticmethod
+    def available() -> bool:
+        return exists_module("src.catalog_cache")
+
+    @staticmethod
+    def create(create_type: Type[CatalogCache]) -> CatalogCache:
+        return create_type(it(Config).download.catalogCache, it(Config).download.catalogCacheSize * 1024 * 1024,
+                           it(Config).download.catalogCacheTTL)
@@ -0,0 +1,151 @@
+import ipaddress
+import random
+import time
+from dataclasses import dataclass
+from typing import Optional, Type
+
+from creart import AbstractCreator, CreateTargetInfo, exists_module, it
+
+from src.config import Config
+
+# Ranges and networks are expanded to at most this many edges
+MAX_EDGES = 256
+# Size of the reference download used to turn TTFB and throughput into one score
+REFERENCE_SIZE = 1024 * 1024
+DEFAULT_TTFB = 0.2
+DEFAULT_THROUGHPUT = 1024 * 1024
+EWMA_ALPHA = 0.3
+EJECT_AFTER_FAILURES = 3
+EJECT_BASE_SECONDS = 30
+EJECT_MAX_SECONDS = 600
+
+
+def parse_edges(value: str | list[str]) -> list[str]:
+    """
+    Expand appleCDNIP into a list of IPs. Accepts a list or a comma separated string of IPs,
+    ranges such as 17.253.85.201-17.253.85.206 and networks such as 17.253.85.200/29
+    """
+    items = value if isinstance(value, list) else value.replace(" ", ",").split(",")
+    edges = []
+    for item in filter(None, (item.strip() for item in items)):
+        if "/" in item:
+            hosts = ipaddress.ip_network(item, strict=False).hosts()
+            edges.extend(str(host) for _, host in zip(range(MAX_EDGES), hosts))
+        elif "-" in item:
+            start, end = item.split("-", 1)
+            start = ipaddress.ip_address(start.strip())
+            end = end.strip()
+            # 17.253.85.201-206 is a shorthand of 17.253.85.201-17.253.85.206
+            end = ipaddress.ip_address(end if "." in end or ":" in end else
+                                       str(start).rsplit(".", 1)[0] + "." + end)
+            edges.extend(str(start + offset) for offset in range(min(int(end) - int(start) + 1, MAX_EDGES)))
+        else:
+            edges.append(str(ipaddress.ip_address(item)))
+    return list(dict.fromkeys(edges))[:MAX_EDGES]
+
+
+@dataclass
+class Edge:
+    ip: str
+    ttfb: Optional[float] = None
+    throughput: Optional[float] = None
+    failures: int = 0
+    ejections: int = 0
+    ejected_until: float = 0.0
+
+    @property
+    def ejected(self) -> bool:
+        return self.ejected_until > time.monotonic()
+
+    def score(self) -> float:
+        # Inverse of the expected time to download a reference chunk from this edge
+        ttfb = DEFAULT_TTFB if self.ttfb is None else self.ttfb
+        throughput = DEFAULT_THROUGHPUT if not self.throughput else self.throughput
+        return 1 / (ttfb + REFERENCE_SIZE / throughput)
+
+
+def _ewma(old: Optional[float], new: float) -> float:
+    return new if old is None else old + EWMA_ALPHA * (new - old)
+
+
+class EdgePool:
+    edges: dict[str, Edge]
+    _source: str | list[str]
+
+    def __init__(self):
+        self.edges = {}
+        self._source = ""
+        self._sync()
+
+    def _sync(self):
+        # Follow changes of appleCDNIP, keeping the measurements of edges that are still listed
+        source = it(Config).download.appleCDNIP
+        if source == self._source:
+            return
+        self._source = source
+        self.edges = {ip: self.edges.get(ip, Edge(ip)) for ip in parse_edges(source)}
+
+    def pick(self) -> str:
+        """Choose an edge weighted by its score, an empty string means resolving the host normally"""
+        self._sync()
+        if not self.edges:
+            return ""
+        admitted = [edge for edge in self.edges.values() if not edge.ejected]
+        if not admitted:
+            return min(self.edges.values(), key=lambda edge: edge.ejected_until).ip
+        return random.choices(admitted, weights=[edge.score() for edge in admitted])[0].ip
+
+    def record_ttfb(self, ip: str, ttfb: float):
+        """The headers of a response arrived, the transfer may still fail"""
+        edge = self.edges.get(ip)
+        if edge:
+            edge.ttfb = _ewma(edge.ttfb, ttfb)
+
+    def record_success(self, ip: str, size: int = 0, elapsed: float = 0.0):
+        """A transfer completed"""
+        edge = self.edges.get(ip)
+        if not edge:
+            return
+        # Small transfers say more about latency than about throughput
+        if size >= REFERENCE_SIZE // 4 and elapsed > 0:
+            edge.throughput = _ewma(edge.throughput, size / elapsed)
+        edge.failures = 0
+        if edge.ejected:
+            # Only the prober reaches an ejected edge, a success re-admits it early
+            edge.ejected_until = 0.0
+        else:
+            edge.ejections = 0
+
+    def record_failure(self, ip: str):
+        edge = self.edges.get(ip)
+        if not edge:
+            return
+        edge.failures += 1
+        if edge.failures >= EJECT_AFTER_FAILURES and not edge.ejected:
+            # Every ejection in a row doubles the time before the edge is tried again
+            edge.ejected_until = time.monotonic() + min(EJECT_BASE_SECONDS * 2 ** edge.ejections, EJECT_MAX_SECONDS)
+            edge.ejections += 1
+            edge.failures = 0
+
+    def summary(self) -> list[str]:
+        lines = []
+        for edge in sorted(self.edges.values(), key=lambda edge: edge.score(), reverse=True):
+            ttfb = f"{edge.ttfb * 1000:.0f}ms" if edge.ttfb is not None else "-"
+            throughput = f"{edge.throughput / 1024 / 1024:.2f}MB/s" if edge.throughput else "-"
+            state = f"ejected for {edge.ejected_until - time.monotonic():.0f}s" if edge.ejected else "admitted"
+            lines.append(f"{edge.ip}: score {edge.score():.2f}, TTFB {ttfb}, {throughput}, {state}")
+        return lines
+
+
+class EdgePoolCreator(AbstractCreator):
+    targets = (
+        CreateTargetInfo("src.cdn", "EdgePool"),
+    )
+
+    @staticmethod
+    def available() -> bool:
+        return exists_module("src.cdn")
+
+    @staticmethod
+    def create(create_type: Type[EdgePool]) -> EdgePool:
+        return create_type()
@@ -8,14 +8,20 @@ from prompt_toolkit.patch_stdout import patch_stdout
 from prompt_toolkit.completion import NestedCompleter
 
 from src.api import WebAPI
+from src.artwork_cache import ArtworkCache
+from src.catalog_cache import CatalogCache, bypass_catalog_cache
+from src.cdn import EdgePool
 from src.config import Config
 from src.flags import Flags
 from src.grpc.manager import WrapperManager, WrapperManagerException
 from src.logger import GlobalLogger
 from src.measurer import SpeedMeasurer
-from src.rip import on_decrypt_success, on_decrypt_failed, rip_song, rip_album, rip_artist, rip_playlist
+from src.runner import ToolRunner
+from src.rip import on_decrypt_success, on_decrypt_failed, rip_song, rip_album, rip_artist, rip_playlist, \
+    adam_id_task_mapping
+from src.task import Status
 from src.url import AppleMusicURL, URLType
-from src.utils import check_dep, run_sync, safely_create_task, get_tasks_num, config_outdated
+from src.utils import check_dep, run_sync, safely_create_task, get_tasks_num, config_outdated, get_executor_status
 
 
 class InteractiveShell:
@@ -33,6 +39,8 @@ class InteractiveShell:
         loop.run_until_complete(run_sync(it(WebAPI).init))
         loop.run_until_complete(it(WrapperManager).init(it(Config).instance.url, it(Config).instance.secure))
         safely_create_task(it(WrapperManager).decrypt_init(on_success=on_decrypt_success, on_failure=on_decrypt_failed))
+        safely_create_task(it(WebAPI).probe_cdn_edges())
+        safely_create_task(it(WebAPI).keep_token_fresh())
         loop.run_until_complete(self.show_status())
 
         if config_outdated():
@@ -48,6 +56,7 @@ class InteractiveShell:
         download_parser.add_argument("-f", "--force", default=False, action="store_true")
         download_parser.add_argument("-l", "--language", default=it(Config).region.language, action="store")
         download_parser.add_argument("--include-participate-songs", default=False, dest="include", action="store_true")
+        download_parser.add_argument("--no-cache", default=False, dest="no_cache", action="store_true")
 
         subparser.add_parser("status")
         subparser.add_parser("login")
@@ -57,6 +66,27 @@ class InteractiveShell:
     async def show_status(self):
         st_resp = await it(WrapperManager).status()
         it(GlobalLogger).logger.info(f"Regions available on wrapper-manager instance: {', '.join(st_resp.regions)}")
+        if it(SpeedMeasurer).finalized_songs:
+            it(GlobalLogger).logger.info(f"Finalized {it(SpeedMeasurer).finalized_songs} songs, "
+                                         f"{it(SpeedMeasurer).finalize_copied_bytes / 1024 / 1024:.2f} MB copied")
+        it(GlobalLogger).logger.info(f"Scratch usage: {it(SpeedMeasurer).scratch_usage()}")
+        if it(WebAPI).cdn_stats.requests:
+            it(GlobalLogger).logger.info(f"CDN client: {it(WebAPI).cdn_stats.summary()}")
+        it(GlobalLogger).logger.info(f"API requests: {it(WebAPI).request_lock.summary()}")
+        if it(CatalogCache).hits or it(CatalogCache).misses:
+            it(GlobalLogger).logger.info(f"Catalog cache: {it(CatalogCache).summary()}")
+        if it(ArtworkCache).hits or it(ArtworkCache).misses:
+            it(GlobalLogger).logger.info(f"Artwork cache: {it(ArtworkCache).summary()}")
+        for line in it(EdgePool).summary():
+            it(GlobalLogger).logger.info(f"CDN edge {line}")
+        if it(ToolRunner).stats:
+            it(GlobalLogger).logger.info(f"External tools: {it(ToolRunner).summary()}")
+        if get_executor_status():
+            it(GlobalLogger).logger.info(f"Executors: {get_executor_status()}")
+        for task in list(adam_id_task_mapping.values()):
+            if task.status == Status.DECRYPTING and task.decryptedMask:
+                it(GlobalLogger).logger.info(f"{task.logger.full_name}: {task.decrypt_progress():.1%} decrypted, "
+                                             f"{len(task.missing_ranges())} missing ranges")
 
     async def command_parser(self, cmd: str):
         if not cmd.strip():
@@ -69,14 +99,23 @@ class InteractiveShell:
             return
         match cmds[0]:
             case "download" | "dl":
-                await self.do_download(args.url, args.codec, args.force, args.language, args.include)
+                await self.do_download(args.url, args.codec, args.force, args.language, args.include, args.no_cache)
             case "status":
                 await self.show_status()
             case "exit":
                 self.loop.stop()
                 sys.exit()
 
-    async def do_download(self, raw_url: str, codec: str, force_download: bool, language: str, include: bool = False):
+    async def do_download(self, raw_url: str, codec: str, force_download: bool, language: str, include: bool = False,
+                          no_cache: bool = False):
+        # Tasks copy the context when they are created, so the flag reaches every request of this download
+        token = bypass_catalog_cache.set(no_cache)
+        try:
+            await self._do_download(raw_url, codec, force_download, language, include)
+        finally:
+            bypass_catalog_cache.reset(token)
+
+    async def _do_download(self, raw_url: str, codec: str, force_download: bool, language: str, include: bool):
         url = AppleMusicURL.parse_url(raw_url)
         if not url:
             real_url = await it(WebAPI).get_real_url(raw_url)
@@ -99,7 +138,7 @@ class InteractiveShell:
                 return
 
     def bottom_toolbar(self):
-        return f"Download Speed: {it(SpeedMeasurer).download_speed()}, Decrypt Speed: {it(SpeedMeasurer).decrypt_speed()}, Tasks: {get_tasks_num()-2}"
+        return f"Download Speed: {it(SpeedMeasurer).download_speed()}, Decrypt Speed: {it(SpeedMeasurer).decrypt_speed()}, Downloads: {it(WebAPI).download_lock.active}/{it(WebAPI).download_lock.limit}, Tasks: {get_tasks_num()-4}"
 
     def completer(self):
         mycompleter = {
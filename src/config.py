@@ -1,5 +1,5 @@
 import tomllib
-from typing import Type
+from typing import Type, Optional
 
 from creart import exists_module
 from creart.creator import AbstractCreator, CreateTargetInfo
@@ -18,11 +18,36 @@ class Region(BaseModel):
     languageNotExistWarning: bool = True
 
 
+class BandwidthRule(BaseModel):
+    start: str
+    end: str
+    audio: Optional[int] = None
+    artwork: Optional[int] = None
+    api: Optional[int] = None
+
+
 class Download(BaseModel):
     proxy: str = ""
     parallelNum: int = 1
+    parallelNumMin: int = 1
+    parallelNumMax: int = 8
+    connectionsPerSong: int = 1
+    cdnPoolSize: int = 32
+    cdnHttp2: bool = True
+    cdnProbeInterval: int = 300
+    downloadCache: str = ""
+    downloadCacheSize: int = 2048
+    catalogCache: str = "cache/catalog.db"
+    catalogCacheSize: int = 64
+    catalogCacheTTL: dict[str, int] = {"songs": 604800, "albums": 604800, "artists": 86400, "playlists": 3600,
+                                       "default": 3600}
+    artworkCache: str = "cache/artwork"
+    artworkCacheSize: int = 512
+    artworkMemoryCache: int = 128
+    tokenCache: str = "cache/token.json"
+    laneConcurrency: dict[str, int] = {"interactive": 64, "metadata": 128, "existence": 64, "artwork": 16}
     maxRunningTasks: int = 128
-    appleCDNIP: str = ""
+    appleCDNIP: str | list[str] = ""
     codecAlternative: bool = True
     codecPriority: list[str] = ["alac", "ec3", "ac3", "aac"]
     atmosConventToM4a: bool = True
@@ -36,6 +61,20 @@ class Download(BaseModel):
     coverFormat: str = "jpg"
     coverSize: str = "5000x5000"
     afterDownloaded: str = ""
+    demuxer: str = "native"
+    muxer: str = "native"
+    scratchRoot: str = "/dev/shm"
+    scratchBudget: int = 1024
+    toolConcurrency: int = 0
+    toolTimeout: int = 600
+    cpuWorkers: int = 0
+    ioWorkers: int = 0
+    integrityCheck: str = "full"
+    integrityCheckWindows: int = 4
+    audioBandwidth: int = 0
+    artworkBandwidth: int = 0
+    apiBandwidth: int = 0
+    bandwidthSchedule: list[BandwidthRule] = []
 
 
 class Metadata(BaseModel):
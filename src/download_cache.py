@@ -0,0 +1,210 @@
+import asyncio
+import hashlib
+import json
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional, Type
+from urllib.parse import urlsplit
+
+from creart import AbstractCreator, CreateTargetInfo, exists_module, it
+
+from src.config import Config
+from src.utils import run_sync
+
+# Received bytes are written to disk in pieces of at least this size
+FLUSH_SIZE = 1024 * 1024
+
+
+@dataclass
+class ByteRange:
+    start: int
+    end: int
+    received: int = 0
+    flushed: int = 0
+
+
+@dataclass
+class PartialDownload:
+    """A download held in a buffer of its full size and mirrored to disk, so it can be resumed by byte ranges"""
+    key: str
+    total: int
+    etag: Optional[str]
+    ranges: list[ByteRange]
+    buffer: bytearray
+    path: Optional[Path] = None
+    complete: bool = False
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+    @property
+    def meta_path(self) -> Path:
+        return self.path.with_suffix(".json")
+
+    def _prefix(self, counter: str) -> int:
+        filled = 0
+        for byte_range in sorted(self.ranges, key=lambda byte_range: byte_range.start):
+            if byte_range.start > filled:
+                break
+            filled = byte_range.start + getattr(byte_range, counter)
+            if filled < byte_range.end:
+                break
+        return filled
+
+    def prefix(self) -> int:
+        """Length of the contiguous data received from the start of the file"""
+        return self._prefix("received")
+
+    def restart_from_prefix(self):
+        # Continue as a single stream after the contiguous data
+        self.ranges = [ByteRange(0, self.total, self._prefix("received"), self._prefix("flushed"))]
+
+
+def _cache_key(url: str) -> str:
+    # Query parameters of asset URLs carry tokens that change between requests
+    return hashlib.sha256(urlsplit(url)._replace(query="", fragment="").geturl().encode()).hexdigest()[:32]
+
+
+def _write_at(path: Path, offset: int, data: memoryview):
+    with open(path, "r+b") as f:
+        f.seek(offset)
+        f.write(data)
+
+
+def _write_meta(download: PartialDownload):
+    meta = {"total": download.total, "etag": download.etag, "complete": download.complete,
+            "ranges": [[byte_range.start, byte_range.end, byte_range.flushed] for byte_range in download.ranges]}
+    tmp_path = download.meta_path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(meta))
+    os.replace(tmp_path, download.meta_path)
+
+
+class DownloadCache:
+    root: Optional[Path]
+    max_size: int
+    downloads: dict[str, PartialDownload]
+    active: set[str]
+
+    def __init__(self, root: str, max_size: int):
+        self.root = Path(root) if root else None
+        self.max_size = max_size
+        self.downloads = {}
+        self.active = set()
+        if self.root:
+            self.root.mkdir(parents=True, exist_ok=True)
+
+    def _load(self, key: str) -> Optional[PartialDownload]:
+        path = self.root / f"{key}.part"
+        try:
+            meta = json.loads(path.with_suffix(".json").read_text())
+            if path.stat().st_size != meta["total"]:
+                return None
+            ranges = [ByteRange(start, end, flushed, flushed) for start, end, flushed in meta["ranges"]]
+            buffer = bytearray(meta["total"])
+            with open(path, "rb") as f:
+                f.readinto(buffer)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        os.utime(path)
+        return PartialDownload(key, meta["total"], meta["etag"], ranges, buffer, path, meta["complete"])
+
+    async def open(self, url: str) -> Optional[PartialDownload]:
+        """Find what was downloaded of url before, in this process or in an earlier one"""
+        key = _cache_key(url)
+        self.active.add(key)
+        if key in self.downloads:
+            return self.downloads[key]
+        if not self.root:
+            return None
+        download = await run_sync(self._load, key)
+        if download and not download.complete:
+            self.downloads[key] = download
+        return download
+
+    async def create(self, url: str, total: int, etag: Optional[str], ranges: list[ByteRange]) -> PartialDownload:
+        key = _cache_key(url)
+        self.active.add(key)
+        download = PartialDownload(key, total, etag, ranges, bytearray(total))
+        if self.root:
+            download.path = self.root / f"{key}.part"
+
+            def prepare():
+                with open(download.path, "wb") as f:
+                    f.truncate(total)
+                _write_meta(download)
+
+            await run_sync(prepare)
+        self.downloads[key] = download
+        return download
+
+    async def flush(self, download: PartialDownload, force: bool = False):
+        if not download.path:
+            return
+        async with download.lock:
+            pending = [byte_range for byte_range in download.ranges
+                       if byte_range.received - byte_range.flushed >= (1 if force else FLUSH_SIZE)]
+            if not pending:
+                return
+            buffer = memoryview(download.buffer)
+            for byte_range in pending:
+                received = byte_range.received
+                await run_sync(_write_at, download.path, byte_range.start + byte_range.flushed,
+                               buffer[byte_range.start + byte_range.flushed:byte_range.start + received])
+                byte_range.flushed = received
+            await run_sync(_write_meta, download)
+
+    async def finish(self, download: PartialDownload):
+        """Mark the download as complete, it stays on disk until the song is saved"""
+        await self.flush(download, force=True)
+        download.complete = True
+        if download.path:
+            await run_sync(_write_meta, download)
+        self.downloads.pop(download.key, None)
+
+    async def discard(self, url: str):
+        """Forget what was downloaded of url, in memory and on disk"""
+        key = _cache_key(url)
+        self.downloads.pop(key, None)
+        self.active.discard(key)
+        if self.root:
+            await run_sync(self._remove, key)
+
+    def _remove(self, key: str):
+        for suffix in (".part", ".json"):
+            (self.root / f"{key}{suffix}").unlink(missing_ok=True)
+
+    async def release(self, url: str):
+        """The song of url is done with, its download may now be evicted"""
+        self.active.discard(_cache_key(url))
+        if self.root:
+            await run_sync(self._evict)
+
+    def _evict(self):
+        # Least recently used first, never evicting downloads that are still in use
+        entries = []
+        for path in self.root.glob("*.part"):
+            try:
+                entries.append((path.stat().st_mtime, path.stat().st_size, path.stem))
+            except OSError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_size:
+                break
+            if key in self.active:
+                continue
+            self._remove(key)
+            total -= size
+
+
+class DownloadCacheCreator(AbstractCreator):
+    targets = (
+        CreateTargetInfo("src.download_cache", "DownloadCache"),
+    )
+
+    @staticmethod
+    def available() -> bool:
+        return exists_module("src.download_cache")
+
+    @staticmethod
+    def create(create_type: Type[DownloadCache]) -> DownloadCache:
+        return create_type(it(Config).download.downloadCache, it(Config).download.downloadCacheSize * 1024 * 1024)
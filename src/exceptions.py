@@ -16,3 +16,19 @@ class RetryableDecryptException(Exception):
 
 class SongNotPassIntegrityCheckException(Exception):
     ...
+
+
+class MP4ParseException(Exception):
+    ...
+
+
+class ResumeRejectedException(Exception):
+    ...
+
+
+class ToolException(Exception):
+    def __init__(self, tool: str, returncode: int | None, stderr: str):
+        self.tool = tool
+        self.returncode = returncode
+        self.stderr = stderr
+        super().__init__(f"{tool} failed with exit code {returncode}: {stderr}")
@@ -0,0 +1,563 @@
+import struct
+from dataclasses import dataclass
+from typing import Iterator, Optional, Sequence
+
+from src.exceptions import MP4ParseException
+from src.types import SampleTable
+
+# tfhd flags
+TFHD_BASE_DATA_OFFSET = 0x000001
+TFHD_SAMPLE_DESCRIPTION_INDEX = 0x000002
+TFHD_DEFAULT_SAMPLE_DURATION = 0x000008
+TFHD_DEFAULT_SAMPLE_SIZE = 0x000010
+TFHD_DEFAULT_SAMPLE_FLAGS = 0x000020
+TFHD_DEFAULT_BASE_IS_MOOF = 0x020000
+
+# trun flags
+TRUN_DATA_OFFSET = 0x000001
+TRUN_FIRST_SAMPLE_FLAGS = 0x000004
+TRUN_SAMPLE_DURATION = 0x000100
+TRUN_SAMPLE_SIZE = 0x000200
+TRUN_SAMPLE_FLAGS = 0x000400
+TRUN_SAMPLE_CTS_OFFSET = 0x000800
+
+CONTAINER_BOXES = {b"moov", b"trak", b"mdia", b"minf", b"stbl", b"dinf", b"edts", b"udta", b"mvex", b"moof",
+                   b"traf", b"ilst"}
+
+
+@dataclass
+class Box:
+    type: bytes
+    offset: int
+    header_size: int
+    size: int
+
+    @property
+    def body(self) -> int:
+        return self.offset + self.header_size
+
+    @property
+    def end(self) -> int:
+        return self.offset + self.size
+
+
+@dataclass
+class AudioSampleEntry:
+    box: Box
+    channels: int
+    sample_size: int
+    sample_rate: int
+    children_offset: int
+
+
+@dataclass
+class TrackDefaults:
+    sample_description_index: int = 1
+    sample_duration: int = 0
+    sample_size: int = 0
+
+
+@dataclass
+class Track:
+    timescale: int
+    duration: int
+    creation_time: int
+    modification_time: int
+    entries: list[AudioSampleEntry]
+    samples: SampleTable
+
+
+def iter_boxes(data, start: int = 0, end: Optional[int] = None) -> Iterator[Box]:
+    end = len(data) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, offset)
+        header_size = 8
+        if size == 1:
+            if offset + 16 > end:
+                raise MP4ParseException(f"Truncated box header {box_type!r} at offset {offset}")
+            size, = struct.unpack_from(">Q", data, offset + 8)
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size or offset + size > end:
+            raise MP4ParseException(f"Truncated box {box_type!r} at offset {offset}")
+        yield Box(box_type, offset, header_size, size)
+        offset += size
+
+
+def find_boxes(data, box_type: bytes, start: int = 0, end: Optional[int] = None) -> list[Box]:
+    return [box for box in iter_boxes(data, start, end) if box.type == box_type]
+
+
+def find_box(data, path: str, start: int = 0, end: Optional[int] = None) -> Optional[Box]:
+    box = None
+    for box_type in path.split("/"):
+        box = next(iter(find_boxes(data, box_type.encode(), start, end)), None)
+        if not box:
+            return None
+        start, end = box.body, box.end
+    return box
+
+
+def read_full_box_header(data, box: Box) -> tuple[int, int]:
+    version_and_flags, = struct.unpack_from(">I", data, box.body)
+    return version_and_flags >> 24, version_and_flags & 0xFFFFFF
+
+
+def parse_time_header(data, box: Box) -> tuple[int, int, int, int]:
+    """Parse mvhd/mdhd, return (creation_time, modification_time, timescale, duration)"""
+    version, _ = read_full_box_header(data, box)
+    if version == 1:
+        return struct.unpack_from(">QQIQ", data, box.body + 4)
+    return struct.unpack_from(">IIII", data, box.body + 4)
+
+
+def parse_sample_entries(data, stsd: Box) -> list[AudioSampleEntry]:
+    entries = []
+    for box in iter_boxes(data, stsd.body + 8, stsd.end):
+        # SampleEntry: reserved(6) data_reference_index(2)
+        # AudioSampleEntry: version(2) revision(2) vendor(4) channelcount(2) samplesize(2)
+        #                   pre_defined(2) reserved(2) samplerate(4)
+        version, = struct.unpack_from(">H", data, box.body + 8)
+        channels, sample_size = struct.unpack_from(">HH", data, box.body + 16)
+        sample_rate, = struct.unpack_from(">I", data, box.body + 24)
+        children_offset = box.body + 28
+        # QuickTime sound sample description v1/v2
+        if version == 1:
+            children_offset += 16
+        elif version == 2:
+            children_offset += 36
+        entries.append(AudioSampleEntry(box=box, channels=channels, sample_size=sample_size,
+                                        sample_rate=sample_rate >> 16, children_offset=children_offset))
+    return entries
+
+
+def find_sample_entry_child(data, entry: AudioSampleEntry, box_type: bytes) -> Optional[Box]:
+    return next(iter(find_boxes(data, box_type, entry.children_offset, entry.box.end)), None)
+
+
+def get_original_format(data, entry: AudioSampleEntry) -> bytes:
+    sinf = find_sample_entry_child(data, entry, b"sinf")
+    if not sinf:
+        return entry.box.type
+    frma = find_box(data, "frma", sinf.body, sinf.end)
+    return bytes(data[frma.body:frma.body + 4]) if frma else entry.box.type
+
+
+def _read_descriptor_header(data, offset: int) -> tuple[int, int, int]:
+    tag = data[offset]
+    offset += 1
+    length = 0
+    for _ in range(4):
+        byte = data[offset]
+        offset += 1
+        length = (length << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            break
+    return tag, offset, length
+
+
+def get_audio_specific_config(data, esds: Box) -> Optional[bytes]:
+    # esds FullBox -> ES_Descriptor(0x03) -> DecoderConfigDescriptor(0x04) -> DecoderSpecificInfo(0x05)
+    tag, offset, length = _read_descriptor_header(data, esds.body + 4)
+    if tag != 0x03:
+        return None
+    es_flags = data[offset + 2]
+    offset += 3
+    if es_flags & 0x80:
+        offset += 2
+    if es_flags & 0x40:
+        offset += 1 + data[offset]
+    if es_flags & 0x20:
+        offset += 2
+    tag, offset, length = _read_descriptor_header(data, offset)
+    if tag != 0x04:
+        return None
+    end = offset + length
+    offset += 13
+    while offset < end:
+        tag, offset, length = _read_descriptor_header(data, offset)
+        if tag == 0x05:
+            return bytes(data[offset:offset + length])
+        offset += length
+    return None
+
+
+def _parse_trex(data, mvex: Optional[Box]) -> TrackDefaults:
+    if not mvex:
+        return TrackDefaults()
+    trex = next(iter(find_boxes(data, b"trex", mvex.body, mvex.end)), None)
+    if not trex:
+        return TrackDefaults()
+    _, sample_description_index, sample_duration, sample_size = struct.unpack_from(">IIII", data, trex.body + 4)
+    return TrackDefaults(sample_description_index, sample_duration, sample_size)
+
+
+def parse_moof(data, moof: Box, defaults: TrackDefaults, samples: SampleTable):
+    for traf in find_boxes(data, b"traf", moof.body, moof.end):
+        tfhd = next(iter(find_boxes(data, b"tfhd", traf.body, traf.end)), None)
+        if not tfhd:
+            raise MP4ParseException(f"traf without tfhd at offset {traf.offset}")
+        _, tf_flags = read_full_box_header(data, tfhd)
+        offset = tfhd.body + 8
+        base_data_offset = moof.offset
+        desc_index, default_duration, default_size = (defaults.sample_description_index, defaults.sample_duration,
+                                                      defaults.sample_size)
+        if tf_flags & TFHD_BASE_DATA_OFFSET:
+            base_data_offset, = struct.unpack_from(">Q", data, offset)
+            offset += 8
+        if tf_flags & TFHD_SAMPLE_DESCRIPTION_INDEX:
+            desc_index, = struct.unpack_from(">I", data, offset)
+            offset += 4
+        if tf_flags & TFHD_DEFAULT_SAMPLE_DURATION:
+            default_duration, = struct.unpack_from(">I", data, offset)
+            offset += 4
+        if tf_flags & TFHD_DEFAULT_SAMPLE_SIZE:
+            default_size, = struct.unpack_from(">I", data, offset)
+            offset += 4
+        data_offset = base_data_offset
+        for trun in find_boxes(data, b"trun", traf.body, traf.end):
+            _, tr_flags = read_full_box_header(data, trun)
+            sample_count, = struct.unpack_from(">I", data, trun.body + 4)
+            offset = trun.body + 8
+            if tr_flags & TRUN_DATA_OFFSET:
+                relative_offset, = struct.unpack_from(">i", data, offset)
+                data_offset = base_data_offset + relative_offset
+                offset += 4
+            if tr_flags & TRUN_FIRST_SAMPLE_FLAGS:
+                offset += 4
+            for _ in range(sample_count):
+                duration, size = default_duration, default_size
+                if tr_flags & TRUN_SAMPLE_DURATION:
+                    duration, = struct.unpack_from(">I", data, offset)
+                    offset += 4
+                if tr_flags & TRUN_SAMPLE_SIZE:
+                    size, = struct.unpack_from(">I", data, offset)
+                    offset += 4
+                if tr_flags & TRUN_SAMPLE_FLAGS:
+                    offset += 4
+                if tr_flags & TRUN_SAMPLE_CTS_OFFSET:
+                    offset += 4
+                if data_offset + size > len(data):
+                    raise MP4ParseException(f"Sample at offset {data_offset} exceeds the end of file")
+                samples.append(data_offset, size, duration, desc_index - 1)
+                data_offset += size
+
+
+def parse_init_segment(data) -> tuple[Track, TrackDefaults]:
+    moov = find_box(data, "moov")
+    if not moov:
+        raise MP4ParseException("moov box not found")
+    mvhd = find_box(data, "mvhd", moov.body, moov.end)
+    mdhd = find_box(data, "trak/mdia/mdhd", moov.body, moov.end)
+    stsd = find_box(data, "trak/mdia/minf/stbl/stsd", moov.body, moov.end)
+    if not (mvhd and mdhd and stsd):
+        raise MP4ParseException("Incomplete moov box")
+    creation_time, modification_time, _, _ = parse_time_header(data, mvhd)
+    _, _, timescale, duration = parse_time_header(data, mdhd)
+    track = Track(timescale=timescale, duration=duration, creation_time=creation_time,
+                  modification_time=modification_time, entries=parse_sample_entries(data, stsd),
+                  samples=SampleTable(data))
+    return track, _parse_trex(data, find_box(data, "mvex", moov.body, moov.end))
+
+
+def parse_fragmented_mp4(data) -> Track:
+    track, defaults = parse_init_segment(data)
+    for moof in find_boxes(data, b"moof"):
+        parse_moof(data, moof, defaults, track.samples)
+    return track
+
+
+class FragmentStream:
+    """
+    Parse a fragmented MP4 while it is being downloaded into a preallocated buffer,
+    handing out the samples of each fragment as soon as its mdat is complete
+    """
+    buffer: Optional[bytearray]
+    position: int
+    defaults: Optional[TrackDefaults]
+    pending: list[Box]
+    parsed: int
+    emitted: int
+
+    def __init__(self):
+        self.buffer = None
+        self.position = 0
+        self.defaults = None
+        self.pending = []
+        self.parsed = 0
+        self.emitted = 0
+
+    def _next_box(self, data) -> Optional[Box]:
+        if self.position + 8 > len(data):
+            return None
+        size, box_type = struct.unpack_from(">I4s", data, self.position)
+        header_size = 8
+        if size == 1:
+            if self.position + 16 > len(data):
+                return None
+            size, = struct.unpack_from(">Q", data, self.position + 8)
+            header_size = 16
+        elif size == 0:
+            # The box extends to the end of file
+            if len(data) < len(self.buffer):
+                return None
+            size = len(data) - self.position
+        if size < header_size:
+            raise MP4ParseException(f"Invalid box {box_type!r} at offset {self.position}")
+        if self.position + size > len(data):
+            return None
+        return Box(box_type, self.position, header_size, size)
+
+    def feed(self, buffer: bytearray, filled: int) -> list[tuple[int, memoryview, int]]:
+        """
+        Parse the boxes completed by the first filled bytes of buffer, return (sample index, sample, desc index)
+        of the new samples. A new buffer means the download was restarted, samples handed out before are skipped.
+        """
+        if buffer is not self.buffer:
+            self.buffer, self.position, self.defaults, self.pending, self.parsed = buffer, 0, None, [], 0
+        data = memoryview(buffer)[:filled]
+        samples = SampleTable(buffer)
+        while box := self._next_box(data):
+            if box.type == b"moov":
+                _, self.defaults = parse_init_segment(data[:box.end])
+            elif box.type == b"moof":
+                self.pending.append(box)
+            elif box.type == b"mdat" and self.pending:
+                if not self.defaults:
+                    raise MP4ParseException("moof box before moov box")
+                for moof in self.pending:
+                    parse_moof(data, moof, self.defaults, samples)
+                self.pending = []
+            self.position = box.end
+        new_samples = []
+        for index, (sample, desc_index) in enumerate(zip(samples.views(), samples.desc_indexes), start=self.parsed):
+            if index >= self.emitted:
+                new_samples.append((index, sample, desc_index))
+        self.parsed += len(samples)
+        self.emitted = max(self.emitted, self.parsed)
+        return new_samples
+
+
+def parse_progressive_mp4(data) -> Track:
+    """Parse a non-fragmented MP4 holding one audio track, reading the samples from its stbl"""
+    moov = find_box(data, "moov")
+    if not moov:
+        raise MP4ParseException("moov box not found")
+    mvhd = find_box(data, "mvhd", moov.body, moov.end)
+    mdhd = find_box(data, "trak/mdia/mdhd", moov.body, moov.end)
+    stbl = find_box(data, "trak/mdia/minf/stbl", moov.body, moov.end)
+    if not (mvhd and mdhd and stbl):
+        raise MP4ParseException("Incomplete moov box")
+    stsd, stts, stsc, stsz = [find_box(data, box_type, stbl.body, stbl.end) for box_type in ("stsd", "stts", "stsc",
+                                                                                             "stsz")]
+    stco = find_box(data, "stco", stbl.body, stbl.end) or find_box(data, "co64", stbl.body, stbl.end)
+    if not (stsd and stts and stsc and stsz and stco):
+        raise MP4ParseException("Incomplete stbl box")
+    creation_time, modification_time, _, _ = parse_time_header(data, mvhd)
+    _, _, timescale, duration = parse_time_header(data, mdhd)
+
+    durations = []
+    entry_count, = struct.unpack_from(">I", data, stts.body + 4)
+    for count, delta in struct.iter_unpack(">II", data[stts.body + 8:stts.body + 8 + entry_count * 8]):
+        durations.extend([delta] * count)
+    sample_size, sample_count = struct.unpack_from(">II", data, stsz.body + 4)
+    sizes = [sample_size] * sample_count if sample_size \
+        else struct.unpack_from(f">{sample_count}I", data, stsz.body + 12)
+    if len(durations) != sample_count:
+        raise MP4ParseException(f"stts describes {len(durations)} samples, stsz describes {sample_count}")
+    entry_count, = struct.unpack_from(">I", data, stsc.body + 4)
+    chunk_runs = list(struct.iter_unpack(">III", data[stsc.body + 8:stsc.body + 8 + entry_count * 12]))
+    entry_count, = struct.unpack_from(">I", data, stco.body + 4)
+    chunk_offsets = struct.unpack_from(f">{entry_count}{'Q' if stco.type == b'co64' else 'I'}", data, stco.body + 8)
+
+    samples = SampleTable(data)
+    sample, run = 0, 0
+    for chunk_index, offset in enumerate(chunk_offsets, start=1):
+        while run + 1 < len(chunk_runs) and chunk_runs[run + 1][0] <= chunk_index:
+            run += 1
+        _, samples_per_chunk, desc_index = chunk_runs[run]
+        for _ in range(samples_per_chunk):
+            if sample >= sample_count:
+                raise MP4ParseException(f"stsc describes more than {sample_count} samples")
+            if offset + sizes[sample] > len(data):
+                raise MP4ParseException(f"Sample at offset {offset} exceeds the end of file")
+            samples.append(offset, sizes[sample], durations[sample], desc_index - 1)
+            offset += sizes[sample]
+            sample += 1
+    if sample != sample_count:
+        raise MP4ParseException(f"Chunks hold {sample} samples, stsz describes {sample_count}")
+    return Track(timescale=timescale, duration=duration, creation_time=creation_time,
+                 modification_time=modification_time, entries=parse_sample_entries(data, stsd), samples=samples)
+
+
+def check_box_tree(data, start: int = 0, end: Optional[int] = None):
+    """Walk the container boxes, raising MP4ParseException if a box overruns its parent"""
+    for box in iter_boxes(data, start, end):
+        if box.type in CONTAINER_BOXES:
+            check_box_tree(data, box.body, box.end)
+        elif box.type == b"meta":
+            check_box_tree(data, box.body + 4, box.end)
+
+
+def make_box(box_type: bytes, *payloads: bytes) -> bytes:
+    size = 8 + sum(len(payload) for payload in payloads)
+    if size > 0xFFFFFFFF:
+        return struct.pack(">I4sQ", 1, box_type, size + 8) + b"".join(payloads)
+    return struct.pack(">I4s", size, box_type) + b"".join(payloads)
+
+
+def make_full_box(box_type: bytes, version: int, flags: int, *payloads: bytes) -> bytes:
+    return make_box(box_type, struct.pack(">I", (version << 24) | flags), *payloads)
+
+
+def make_plain_sample_entry(data, entry: AudioSampleEntry) -> bytes:
+    """Turn an encrypted sample entry (enca) into the clear one, dropping its sinf box"""
+    children = [bytes(data[box.offset:box.end]) for box in iter_boxes(data, entry.children_offset, entry.box.end)
+                if box.type != b"sinf"]
+    return make_box(get_original_format(data, entry), bytes(data[entry.box.body:entry.children_offset]), *children)
+
+
+UNITY_MATRIX = struct.pack(">9I", 0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0, 0x40000000)
+LANGUAGE_UND = 0x55C4
+
+
+def _make_time_fields(creation_time: int, modification_time: int, duration: int, timescale: Optional[int] = None):
+    # Use version 1 of mvhd/tkhd/mdhd when a value does not fit in 32 bits
+    version = 1 if max(creation_time, modification_time, duration) > 0xFFFFFFFF else 0
+    if timescale is None:
+        fmt = ">QQ" if version else ">II"
+        return version, struct.pack(fmt, creation_time, modification_time), \
+            struct.pack(">Q" if version else ">I", duration)
+    fmt = ">QQIQ" if version else ">IIII"
+    return version, struct.pack(fmt, creation_time, modification_time, timescale, duration), b""
+
+
+def _run_length(values) -> list[tuple[int, int]]:
+    runs = []
+    for value in values:
+        if runs and runs[-1][1] == value:
+            runs[-1][0] += 1
+        else:
+            runs.append([1, value])
+    return [(count, value) for count, value in runs]
+
+
+def _make_stbl(sample_entry: bytes, sizes: Sequence[int], durations: Sequence[int], chunks: list[tuple[int, int]],
+               chunk_base: int, use_co64: bool) -> bytes:
+    stsd = make_full_box(b"stsd", 0, 0, struct.pack(">I", 1), sample_entry)
+    stts_runs = _run_length(durations)
+    stts = make_full_box(b"stts", 0, 0, struct.pack(">I", len(stts_runs)),
+                         b"".join(struct.pack(">II", count, value) for count, value in stts_runs))
+    stsc_runs = []
+    for chunk_index, (_, sample_count) in enumerate(chunks, start=1):
+        if not stsc_runs or stsc_runs[-1][1] != sample_count:
+            stsc_runs.append((chunk_index, sample_count))
+    stsc = make_full_box(b"stsc", 0, 0, struct.pack(">I", len(stsc_runs)),
+                         b"".join(struct.pack(">III", first, count, 1) for first, count in stsc_runs))
+    if len(set(sizes)) == 1:
+        stsz = make_full_box(b"stsz", 0, 0, struct.pack(">II", sizes[0], len(sizes)))
+    else:
+        stsz = make_full_box(b"stsz", 0, 0, struct.pack(">II", 0, len(sizes)), struct.pack(f">{len(sizes)}I", *sizes))
+    offsets = [chunk_base + offset for offset, _ in chunks]
+    if use_co64:
+        stco = make_full_box(b"co64", 0, 0, struct.pack(">I", len(offsets)), struct.pack(f">{len(offsets)}Q", *offsets))
+    else:
+        stco = make_full_box(b"stco", 0, 0, struct.pack(">I", len(offsets)), struct.pack(f">{len(offsets)}I", *offsets))
+    return make_box(b"stbl", stsd, stts, stsc, stsz, stco)
+
+
+# Data types of iTunes metadata, see also mutagen.mp4.AtomDataType
+DATA_TYPE_IMPLICIT = 0
+DATA_TYPE_UTF8 = 1
+DATA_TYPE_JPEG = 13
+DATA_TYPE_INTEGER = 21
+
+
+def _make_data_box(data_type: int, payload: bytes) -> bytes:
+    return make_box(b"data", struct.pack(">II", data_type, 0), payload)
+
+
+def _make_ilst_item(key: str, value) -> bytes:
+    if key.startswith("----:"):
+        _, mean, name = key.split(":", 2)
+        return make_box(b"----", make_full_box(b"mean", 0, 0, mean.encode()),
+                        make_full_box(b"name", 0, 0, name.encode()),
+                        *[_make_data_box(DATA_TYPE_UTF8, item) for item in value])
+    atom = key.encode("latin-1")
+    if isinstance(value, str):
+        value = [value]
+    data_boxes = []
+    for item in value:
+        if key == "trkn":
+            data_boxes.append(_make_data_box(DATA_TYPE_IMPLICIT, struct.pack(">HHHH", 0, item[0], item[1] or 0, 0)))
+        elif key == "disk":
+            data_boxes.append(_make_data_box(DATA_TYPE_IMPLICIT, struct.pack(">HHH", 0, item[0], item[1] or 0)))
+        elif key == "covr":
+            data_boxes.append(_make_data_box(getattr(item, "imageformat", DATA_TYPE_JPEG), bytes(item)))
+        elif isinstance(item, int):
+            data_boxes.append(_make_data_box(DATA_TYPE_INTEGER, struct.pack(">b", item)))
+        else:
+            data_boxes.append(_make_data_box(DATA_TYPE_UTF8, str(item).encode()))
+    return make_box(atom, *data_boxes)
+
+
+def make_udta(tags: dict) -> bytes:
+    """Render tags in the format of SongMetadata.to_mutagen_tags as moov/udta/meta/ilst"""
+    hdlr = make_full_box(b"hdlr", 0, 0, struct.pack(">I4s4s8x", 0, b"mdir", b"appl"), b"\x00")
+    ilst = make_box(b"ilst", *[_make_ilst_item(key, value) for key, value in tags.items()])
+    return make_box(b"udta", make_full_box(b"meta", 0, 0, hdlr, ilst))
+
+
+def _make_moov(sample_entry: bytes, timescale: int, sizes: Sequence[int], durations: Sequence[int],
+               chunks: list[tuple[int, int]], chunk_base: int, use_co64: bool,
+               creation_time: int, modification_time: int, udta: bytes, handler_name: str) -> bytes:
+    duration = sum(durations)
+    version, times, _ = _make_time_fields(creation_time, modification_time, duration, timescale)
+    mvhd = make_full_box(b"mvhd", version, 0, times, struct.pack(">IH10s", 0x00010000, 0x0100, b""),
+                         UNITY_MATRIX, b"\x00" * 24, struct.pack(">I", 2))
+    version, times, packed_duration = _make_time_fields(creation_time, modification_time, duration)
+    tkhd = make_full_box(b"tkhd", version, 0x000007, times, struct.pack(">II", 1, 0), packed_duration,
+                         struct.pack(">8xhhH2x", 0, 0, 0x0100), UNITY_MATRIX, struct.pack(">II", 0, 0))
+    version, times, _ = _make_time_fields(creation_time, modification_time, duration, timescale)
+    mdhd = make_full_box(b"mdhd", version, 0, times, struct.pack(">HH", LANGUAGE_UND, 0))
+    hdlr = make_full_box(b"hdlr", 0, 0, struct.pack(">I4s12x", 0, b"soun"), handler_name.encode() + b"\x00")
+    smhd = make_full_box(b"smhd", 0, 0, struct.pack(">hH", 0, 0))
+    dinf = make_box(b"dinf", make_full_box(b"dref", 0, 0, struct.pack(">I", 1), make_full_box(b"url ", 0, 1)))
+    stbl = _make_stbl(sample_entry, sizes, durations, chunks, chunk_base, use_co64)
+    mdia = make_box(b"mdia", mdhd, hdlr, make_box(b"minf", smhd, dinf, stbl))
+    return make_box(b"moov", mvhd, make_box(b"trak", tkhd, mdia), udta)
+
+
+def build_m4a(sample_entry: bytes, timescale: int, sizes: Sequence[int], durations: Sequence[int], media,
+              creation_time: int = 0, modification_time: int = 0, udta: bytes = b"",
+              handler_name: str = "SoundHandler") -> bytes:
+    """Build a progressive M4A (ftyp/moov/mdat) holding one audio track, with the moov in front"""
+    ftyp = make_box(b"ftyp", b"M4A ", struct.pack(">I", 0), b"M4A mp42isom")
+    # Group samples into chunks of about one second
+    chunks = []
+    chunk_offset, chunk_samples, chunk_duration, offset = 0, 0, 0, 0
+    for size, duration in zip(sizes, durations):
+        if chunk_samples and chunk_duration >= timescale:
+            chunks.append((chunk_offset, chunk_samples))
+            chunk_offset, chunk_samples, chunk_duration = offset, 0, 0
+        chunk_samples += 1
+        chunk_duration += duration
+        offset += size
+    if chunk_samples:
+        chunks.append((chunk_offset, chunk_samples))
+    mdat_header = struct.pack(">I4s", 8 + len(media), b"mdat") if 8 + len(media) <= 0xFFFFFFFF \
+        else struct.pack(">I4sQ", 1, b"mdat", 16 + len(media))
+    use_co64 = False
+    moov = _make_moov(sample_entry, timescale, sizes, durations, chunks, 0, use_co64,
+                      creation_time, modification_time, udta, handler_name)
+    chunk_base = len(ftyp) + len(moov) + len(mdat_header)
+    if chunk_base + len(media) > 0xFFFFFFFF:
+        use_co64 = True
+        moov = _make_moov(sample_entry, timescale, sizes, durations, chunks, 0, use_co64,
+                          creation_time, modification_time, udta, handler_name)
+        chunk_base = len(ftyp) + len(moov) + len(mdat_header)
+    moov = _make_moov(sample_entry, timescale, sizes, durations, chunks, chunk_base, use_co64,
+                      creation_time, modification_time, udta, handler_name)
+    return b"".join([ftyp, moov, mdat_header, media])
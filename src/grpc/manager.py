@@ -24,7 +24,7 @@ class WrapperManagerException(Exception):
 class WrapperManager:
     _channel: Channel
     _stub: WrapperManagerServiceStub
-    _decrypt_queue: asyncio.Queue[DecryptRequest]
+    _decrypt_queue: asyncio.Queue[tuple[str, str, bytes | memoryview, int]]
     _login_lock: asyncio.Lock
 
     def __init__(self):
@@ -97,14 +97,15 @@ class WrapperManager:
                         password=password,
                         two_step_code=two_step_code)))
 
-    async def decrypt(self, adam_id: str, key: str, sample: bytes, sample_index: int):
-        await self._decrypt_queue.put(
-            DecryptRequest(data=DecryptData(adam_id=adam_id, key=key, sample_index=sample_index,
-                                            sample=sample)))
+    async def decrypt(self, adam_id: str, key: str, sample: bytes | memoryview, sample_index: int):
+        await self._decrypt_queue.put((adam_id, key, sample, sample_index))
 
     async def _decrypt_request_generator(self):
+        # Samples may be views into the downloaded song, only copy them out when building the request
         while True:
-            yield await self._decrypt_queue.get()
+            adam_id, key, sample, sample_index = await self._decrypt_queue.get()
+            yield DecryptRequest(data=DecryptData(adam_id=adam_id, key=key, sample_index=sample_index,
+                                                  sample=bytes(sample)))
 
     async def decrypt_init(self, on_success: Callable[[str, str, bytes, int], Awaitable[None]],
                            on_failure: Callable[[str, str, bytes, int], Awaitable[None]]):
@@ -124,7 +125,7 @@ class WrapperManager:
 
     async def _decrypt_keepalive(self):
         while True:
-            await self._decrypt_queue.put(DecryptRequest(data=DecryptData(adam_id="KEEPALIVE")))
+            await self._decrypt_queue.put(("KEEPALIVE", "", b"", 0))
             await asyncio.sleep(15)
 
     @retry(retry=((retry_if_exception_type(WrapperManagerException)) & (
@@ -0,0 +1,262 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime
+from enum import StrEnum
+
+from creart import it
+
+from src.config import Config
+from src.logger import GlobalLogger
+from src.measurer import SpeedMeasurer
+
+# Seconds between two adjustments of the limit
+ADJUST_INTERVAL = 10
+# Growth that does not improve the throughput by this ratio is undone
+MIN_IMPROVEMENT = 0.05
+# Adjustments to wait after undoing a growth before trying to grow again
+HOLD_INTERVALS = 6
+
+
+class AdaptiveLimiter:
+    """
+    A semaphore whose limit follows AIMD on the download throughput of SpeedMeasurer: it grows by one while
+    the throughput keeps improving, and halves when requests are throttled or time out
+    """
+    limit: int
+    minimum: int
+    maximum: int
+    active: int
+    errors: int
+    _waiters: deque[asyncio.Future]
+    _last_adjust: float
+    _last_bytes: int
+    _last_throughput: float
+    _grew: bool
+    _hold_until: float
+
+    def __init__(self, initial: int, minimum: int, maximum: int):
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.active = 0
+        self.errors = 0
+        self._waiters = deque()
+        self._last_adjust = time.monotonic()
+        self._last_bytes = it(SpeedMeasurer).downloaded_bytes
+        self._last_throughput = 0.0
+        self._grew = False
+        self._hold_until = 0.0
+
+    async def acquire(self):
+        self._adjust()
+        while self.active >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                elif waiter.done() and not waiter.cancelled():
+                    # Woken while being cancelled, the slot goes to the next waiter
+                    self._wake()
+                raise
+        self.active += 1
+
+    def release(self):
+        # Adjust before releasing, while the slot still counts as used
+        self._adjust()
+        self.active -= 1
+        self._wake()
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    def record_error(self):
+        """A request was throttled (429), failed on the server (5xx) or timed out"""
+        self.errors += 1
+
+    def _wake(self):
+        for _ in range(self.limit - self.active):
+            if not self._waiters:
+                break
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _set_limit(self, limit: int, reason: str):
+        if limit == self.limit:
+            return
+        it(GlobalLogger).logger.info(f"Download concurrency {self.limit} -> {limit}: {reason}")
+        self.limit = limit
+        self._wake()
+
+    def _adjust(self):
+        now = time.monotonic()
+        if now - self._last_adjust < ADJUST_INTERVAL:
+            return
+        downloaded = it(SpeedMeasurer).downloaded_bytes
+        throughput = (downloaded - self._last_bytes) / (now - self._last_adjust)
+        errors = self.errors
+        self._last_adjust, self._last_bytes, self.errors = now, downloaded, 0
+        grew, self._grew = self._grew, False
+        if errors:
+            self._set_limit(max(self.minimum, self.limit // 2), f"{errors} requests throttled or timed out")
+        elif grew and throughput < self._last_throughput * (1 + MIN_IMPROVEMENT):
+            self._set_limit(max(self.minimum, self.limit - 1),
+                            f"throughput stopped improving at {throughput / 1024 / 1024:.2f} MB/s")
+            self._hold_until = now + ADJUST_INTERVAL * HOLD_INTERVALS
+        elif self._waiters and self.active >= self.limit and self.limit < self.maximum and now >= self._hold_until:
+            self._set_limit(self.limit + 1, f"throughput {throughput / 1024 / 1024:.2f} MB/s with songs waiting")
+            self._grew = True
+        self._last_throughput = throughput
+
+
+# Seconds of traffic a bucket may save up while idle
+BURST_SECONDS = 0.2
+
+
+class TrafficClass(StrEnum):
+    AUDIO = "audio"
+    ARTWORK = "artwork"
+    API = "api"
+
+
+class TokenBucket:
+    """
+    Token bucket charged after the bytes were received. A consumer in debt sleeps until the debt is paid,
+    holding a FIFO lock so that concurrent songs take turns instead of one of them starving the others
+    """
+    tokens: float
+    _last_refill: float
+    _lock: asyncio.Lock
+
+    def __init__(self):
+        self.tokens = 0.0
+        self._last_refill = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def consume(self, amount: int, rate: float):
+        if rate <= 0:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self._last_refill) * rate, rate * BURST_SECONDS) - amount
+            self._last_refill = now
+            if self.tokens < 0:
+                await asyncio.sleep(-self.tokens / rate)
+
+
+def _minutes(clock: str) -> int:
+    hour, minute = clock.split(":")
+    return int(hour) * 60 + int(minute)
+
+
+class BandwidthShaper:
+    buckets: dict[TrafficClass, TokenBucket]
+
+    def __init__(self):
+        self.buckets = {traffic: TokenBucket() for traffic in TrafficClass}
+
+    @staticmethod
+    def rate(traffic: TrafficClass) -> int:
+        """Current limit of the traffic class in bytes per second, 0 means unlimited"""
+        download = it(Config).download
+        rate = getattr(download, f"{traffic}Bandwidth")
+        now = datetime.now()
+        minutes = now.hour * 60 + now.minute
+        for rule in download.bandwidthSchedule:
+            start, end = _minutes(rule.start), _minutes(rule.end)
+            active = start <= minutes < end if start <= end else minutes >= start or minutes < end
+            if active and getattr(rule, traffic) is not None:
+                rate = getattr(rule, traffic)
+        return rate * 1024
+
+    async def consume(self, traffic: TrafficClass, amount: int):
+        await self.buckets[traffic].consume(amount, self.rate(traffic))
+
+
+# Seconds of waiting that raise a queued request by one lane of priority
+AGING_SECONDS = 2
+
+
+class Lane(StrEnum):
+    # In order of priority
+    INTERACTIVE = "interactive"
+    METADATA = "metadata"
+    EXISTENCE = "existence"
+    ARTWORK = "artwork"
+
+
+LANE_PRIORITY = {lane: priority for priority, lane in enumerate(Lane)}
+
+
+class RequestScheduler:
+    """
+    Limits API requests in total and per lane. A free slot goes to the waiting request of the highest priority,
+    requests gain priority while they wait so that no lane starves
+    """
+    total: int
+    limits: dict[Lane, int]
+    active: dict[Lane, int]
+    waiting: dict[Lane, deque[tuple[float, asyncio.Future]]]
+
+    def __init__(self, total: int, limits: dict[str, int]):
+        self.total = total
+        self.limits = {lane: max(limits.get(lane, total), 1) for lane in Lane}
+        self.active = {lane: 0 for lane in Lane}
+        self.waiting = {lane: deque() for lane in Lane}
+
+    def _free(self, lane: Lane) -> bool:
+        return sum(self.active.values()) < self.total and self.active[lane] < self.limits[lane]
+
+    async def acquire(self, lane: Lane):
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (time.monotonic(), waiter)
+        self.waiting[lane].append(entry)
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if entry in self.waiting[lane]:
+                self.waiting[lane].remove(entry)
+            elif waiter.done() and not waiter.cancelled():
+                # The slot was granted while being cancelled
+                self.release(lane)
+            raise
+
+    def release(self, lane: Lane):
+        self.active[lane] -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while True:
+            candidates = [(LANE_PRIORITY[lane] - (now - self.waiting[lane][0][0]) / AGING_SECONDS,
+                           self.waiting[lane][0][0], lane)
+                          for lane in Lane if self.waiting[lane] and self._free(lane)]
+            if not candidates:
+                return
+            lane = min(candidates)[2]
+            _, waiter = self.waiting[lane].popleft()
+            if waiter.done():
+                continue
+            self.active[lane] += 1
+            waiter.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, lane: Lane):
+        await self.acquire(lane)
+        try:
+            yield
+        finally:
+            self.release(lane)
+
+    def summary(self) -> str:
+        return ", ".join(f"{lane} {self.active[lane]}/{self.limits[lane]} active, {len(self.waiting[lane])} queued"
+                         for lane in Lane)
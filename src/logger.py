@@ -95,6 +95,12 @@ class RipLogger:
     def decrypting(self):
         self.logger.info("Decrypting song...")
 
+    def failed_tool(self, error: Exception):
+        self.logger.error(f"Failed to process song: {error}")
+
+    def failed_decrypt(self):
+        self.logger.error("Decrypted samples stopped arriving, giving up on the song")
+
     def failed_integrity(self):
         self.logger.warning(f"Song did not pass the integrity check!")
 
@@ -104,5 +110,8 @@ class RipLogger:
     def done(self):
         self.logger.success(f"Finished ripping")
 
+    def catalog_requests(self, summary: str):
+        self.logger.info(f"Catalog: {summary}")
+
     def selected_codec(self, selected_codec):
         self.logger.info(f"Selected codec: {selected_codec}")
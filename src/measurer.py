@@ -9,16 +9,37 @@ class SpeedMeasurer:
     def __init__(self, sample_window=1):
         self._sample_window = sample_window
         self._download_records = deque()  # 存储 (时间戳, 字节数)
+        self.downloaded_bytes = 0  # 下载的总字节数
         self._decrypt_records = deque()  # 存储 (时间戳, 字节数)
+        self.finalized_songs = 0
+        self.finalize_copied_bytes = 0  # 封装歌曲时复制的总字节数
+        self.scratch_used = 0
+        self.scratch_peak = 0
+        self.scratch_fallbacks = 0  # 临时空间不足而回退到磁盘的次数
 
     def record_download(self, content_length: int):
         now = time.time()
+        self.downloaded_bytes += content_length
         self._download_records.append((now, content_length))
 
     def record_decrypt(self, content_length: int):
         now = time.time()
         self._decrypt_records.append((now, content_length))
 
+    def record_finalize(self, copied_bytes: int):
+        self.finalized_songs += 1
+        self.finalize_copied_bytes += copied_bytes
+
+    def record_scratch(self, used: int, fallback: bool = False):
+        self.scratch_used = used
+        self.scratch_peak = max(self.scratch_peak, used)
+        if fallback:
+            self.scratch_fallbacks += 1
+
+    def scratch_usage(self) -> str:
+        return f"{self.scratch_used / 1024 / 1024:.2f} MB (peak {self.scratch_peak / 1024 / 1024:.2f} MB, " \
+               f"{self.scratch_fallbacks} on disk)"
+
     def download_speed(self) -> str:
         now = time.time()
         self._evict_old(self._download_records, now)
@@ -10,7 +10,7 @@ from src.models.song_data import Datum
 from src.utils import ttml_convent_to_lrc, count_total_track_and_disc
 
 NOT_INCLUDED_FIELD = ["playlistIndex", "bit_depth", "sample_rate", "sample_rate_kHz",
-                      "song_id", "album_id", "track_total", "disk_total"]
+                      "song_id", "album_id", "track_total", "disk_total", "lrc"]
 TAG_MAPPING = {
     "song_id": "cnID",  # iTunes Catalog ID
     "title": "©nam",  # MP4 title
@@ -52,6 +52,7 @@ class SongMetadata(BaseModel):
     disk: Optional[int] = None
     disk_total: Optional[int] = None
     lyrics: Optional[str] = None
+    lrc: Optional[str] = None
     cover: bytes = None
     cover_url: Optional[str] = None
     copyright: Optional[str] = None
@@ -73,7 +74,7 @@ class SongMetadata(BaseModel):
                 if key in NOT_INCLUDED_FIELD:
                     continue
                 if key == "lyrics":
-                    lrc = ttml_convent_to_lrc(value)
+                    lrc = self.lrc or ttml_convent_to_lrc(value)
                     tags.append(f"{key}={lrc}")
                     continue
                 if key.lower() in ('upc', 'isrc'):
@@ -95,7 +96,7 @@ class SongMetadata(BaseModel):
                 if key in NOT_INCLUDED_FIELD:
                     continue
                 if key == "lyrics":
-                    lrc = ttml_convent_to_lrc(value)
+                    lrc = self.lrc or ttml_convent_to_lrc(value)
                     tags.update({TAG_MAPPING[key]: lrc})
                     continue
                 if key == "tracknum":
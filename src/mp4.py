@@ -1,13 +1,11 @@
 import pickle
-import subprocess
-import sys
+import random
+import struct
 import uuid
-from io import BytesIO
+from array import array
 from pathlib import Path
-from tempfile import TemporaryDirectory
 from typing import Tuple
 
-import m3u8
 import regex
 import mutagen.mp4
 from bs4 import BeautifulSoup
@@ -16,41 +14,40 @@ from loguru import logger
 
 from src.api import WebAPI
 from src.config import Config
-from src.exceptions import CodecNotFoundException
+from src.exceptions import CodecNotFoundException, MP4ParseException
+from src.fmp4 import Track, parse_fragmented_mp4, find_sample_entry_child, get_audio_specific_config, \
+    get_original_format, parse_init_segment, make_plain_sample_entry, build_m4a, make_udta, \
+    parse_progressive_mp4, check_box_tree, find_box, iter_boxes
 from src.metadata import SongMetadata
+from src.runner import ToolRunner
+from src.scratch import ScratchSpace
 from src.types import *
-from src.utils import find_best_codec, get_codec_from_codec_id, get_suffix, convent_mac_timestamp_to_datetime, \
-    if_raw_atmos
-
-
-def if_shell():
-    if sys.platform in ('win32', 'cygwin', 'cli'):
-        return False
-    else:
-        return True
+from src.utils import find_best_codec, index_variants, get_codec_from_codec_id, get_suffix, convent_mac_timestamp_to_datetime, \
+    if_raw_atmos, run_sync, ExecutorType
 
 
 async def get_available_codecs(m3u8_url: str) -> Tuple[list[str], list[str]]:
-    parsed_m3u8 = m3u8.loads(await it(WebAPI).download_m3u8(m3u8_url), uri=m3u8_url)
+    parsed_m3u8 = await it(WebAPI).get_m3u8(m3u8_url)
     codec_ids = [playlist.stream_info.audio for playlist in parsed_m3u8.playlists]
     codecs = [get_codec_from_codec_id(codec_id) for codec_id in codec_ids]
     return codecs, codec_ids
 
 
 async def extract_media(m3u8_url: str, codec: str, song_metadata: SongMetadata) -> M3U8Info:
-    parsed_m3u8 = m3u8.loads(await it(WebAPI).download_m3u8(m3u8_url), uri=m3u8_url)
-    specifyPlaylist = find_best_codec(parsed_m3u8, codec)
+    parsed_m3u8 = await it(WebAPI).get_m3u8(m3u8_url)
+    variants = index_variants(parsed_m3u8)
+    specifyPlaylist = find_best_codec(parsed_m3u8, codec, variants)
     if not specifyPlaylist and it(Config).download.codecAlternative:
         logger.warning(f"Codec {codec} of song: {song_metadata.artist} - {song_metadata.title} did not found")
         for a_codec in it(Config).download.codecPriority:
-            specifyPlaylist = find_best_codec(parsed_m3u8, a_codec)
+            specifyPlaylist = find_best_codec(parsed_m3u8, a_codec, variants)
             if specifyPlaylist:
                 codec = a_codec
                 break
     if not specifyPlaylist:
         raise CodecNotFoundException
     selected_codec = specifyPlaylist.media[0].group_id
-    stream = m3u8.loads(await it(WebAPI).download_m3u8(specifyPlaylist.absolute_uri), uri=specifyPlaylist.absolute_uri)
+    stream = await it(WebAPI).get_m3u8(specifyPlaylist.absolute_uri)
     skds = [key.uri for key in stream.keys if regex.match('(skd?://[^"]*)', key.uri)]
     keys = [prefetchKey]
     key_suffix = CodecKeySuffix.KeySuffixDefault
@@ -77,43 +74,123 @@ async def extract_media(m3u8_url: str, codec: str, song_metadata: SongMetadata)
                     sample_rate=sample_rate)
 
 
-def extract_song(raw_song: bytes, codec: str) -> SongInfo:
-    tmp_dir = TemporaryDirectory()
-    mp4_name = uuid.uuid4().hex
-    raw_mp4 = Path(tmp_dir.name) / Path(f"{mp4_name}.mp4")
-    with open(raw_mp4.absolute(), "wb") as f:
-        f.write(raw_song)
-    nhml_name = (Path(tmp_dir.name) / Path(mp4_name).with_suffix('.nhml')).absolute()
-    media_name = (Path(tmp_dir.name) / Path(mp4_name).with_suffix('.media')).absolute()
-    subprocess.run(f"gpac -i {raw_mp4.absolute()} nhmlw:pckp=true -o {nhml_name}",
-                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, shell=if_shell())
-    xml_name = (Path(tmp_dir.name) / Path(mp4_name).with_suffix('.xml')).absolute()
-    subprocess.run(f"MP4Box -diso {raw_mp4.absolute()} -out {xml_name}",
-                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, shell=if_shell())
-    decoder_params = None
+async def extract_song(raw_song: bytes, codec: str) -> SongInfo:
+    match it(Config).download.demuxer:
+        case "gpac":
+            return await extract_song_gpac(raw_song, codec)
+        case "compat":
+            song_info = await extract_song_gpac(raw_song, codec)
+            diff = diff_song_info(await run_sync(extract_song_native, raw_song, codec), song_info)
+            if diff:
+                logger.warning(f"Native demuxer result differs from gpac: {diff}")
+            return song_info
+        case _:
+            return await run_sync(extract_song_native, raw_song, codec)
 
-    with open(xml_name, "r") as f:
-        info_xml = BeautifulSoup(f.read(), "xml")
-    with open(nhml_name, "r") as f:
-        raw_nhml = f.read()
-        nhml = BeautifulSoup(raw_nhml, "xml")
-    with open(media_name, "rb") as f:
-        media = BytesIO(f.read())
 
+def extract_song_native(raw_song: bytes, codec: str) -> SongInfo:
+    track = parse_fragmented_mp4(raw_song)
+    if not track.entries:
+        raise MP4ParseException("No sample entry found")
+    decoder_params = None
     match codec:
         case Codec.ALAC:
-            alac_atom_name = (Path(tmp_dir.name) / Path(mp4_name).with_suffix('.atom')).absolute()
-            subprocess.run(
-                f"mp4extract moov/trak/mdia/minf/stbl/stsd/enca[0]/alac {raw_mp4.absolute()} {alac_atom_name}",
-                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, shell=if_shell())
-            with open(alac_atom_name, "rb") as f:
-                decoder_params = f.read()
+            alac = find_sample_entry_child(raw_song, track.entries[0], b"alac")
+            if alac:
+                decoder_params = bytes(raw_song[alac.offset:alac.end])
         case Codec.AAC | Codec.AAC_DOWNMIX | Codec.AAC_BINAURAL | Codec.AAC_LEGACY:
-            info_name = (Path(tmp_dir.name) / Path(mp4_name).with_suffix('.info')).absolute()
-            with open(info_name, "rb") as f:
-                decoder_params = f.read()
+            esds = find_sample_entry_child(raw_song, track.entries[0], b"esds")
+            if esds:
+                decoder_params = get_audio_specific_config(raw_song, esds)
 
-    samples = []
+    params = {"CreationTime": convent_mac_timestamp_to_datetime(track.creation_time),
+              "ModificationTime": convent_mac_timestamp_to_datetime(track.modification_time)}
+    return SongInfo(codec=codec, raw=raw_song, samples=track.samples, nhml=build_nhml(raw_song, track, codec),
+                    decoderParams=decoder_params, params=params)
+
+
+# Produce the same NHML document as "gpac nhmlw" for the fallback encapsulation
+def build_nhml(raw_song: bytes, track: Track, codec: str) -> str:
+    entry = track.entries[0]
+    media_sub_type = get_original_format(raw_song, entry).decode(errors="ignore")
+    stream_attrs = (f'version="1.0" timeScale="{track.timescale}" mediaType="soun" mediaSubType="{media_sub_type}" '
+                    f'sampleRate="{track.timescale}" numChannels="{entry.channels}" bitsPerSample="{entry.sample_size}"')
+    if codec in (Codec.AAC, Codec.AAC_DOWNMIX, Codec.AAC_BINAURAL, Codec.AAC_LEGACY):
+        stream_attrs += ' streamType="5" objectTypeIndication="64"'
+    lines = ['<?xml version="1.0" encoding="UTF-8" ?>', f'<NHNTStream {stream_attrs}>']
+    dts = 0
+    for number, (size, duration) in enumerate(zip(track.samples.sizes, track.samples.durations), start=1):
+        lines.append(f'<NHNTSample DTS="{dts}" dataLength="{size}" isRAP="yes" duration="{duration}" number="{number}"/>')
+        dts += duration
+    lines.append("</NHNTStream>")
+    return "\n".join(lines)
+
+
+def diff_song_info(native: SongInfo, reference: SongInfo) -> Optional[str]:
+    if len(native.samples) != len(reference.samples):
+        return f"sample count {len(native.samples)} != {len(reference.samples)}"
+    if native.samples.durations != reference.samples.durations:
+        return "sample durations mismatch"
+    if native.samples.desc_indexes != reference.samples.desc_indexes:
+        return "sample description indexes mismatch"
+    for index, (a, b) in enumerate(zip(native.samples.views(), reference.samples.views())):
+        if a != b:
+            return f"sample {index} mismatch"
+    if native.decoderParams != reference.decoderParams:
+        return "decoder params mismatch"
+    if native.params != reference.params:
+        return "params mismatch"
+    return None
+
+
+async def extract_song_gpac(raw_song: bytes, codec: str) -> SongInfo:
+    decoder_params = None
+    async with it(ScratchSpace).workspace(len(raw_song) * 3) as tmp_dir:
+        mp4_name = uuid.uuid4().hex
+        raw_mp4 = Path(tmp_dir.name) / Path(f"{mp4_name}.mp4")
+        await run_sync(raw_mp4.write_bytes, raw_song)
+        nhml_name = (Path(tmp_dir.name) / Path(mp4_name).with_suffix('.nhml')).absolute()
+        media_name = (Path(tmp_dir.name) / Path(mp4_name).with_suffix('.media')).absolute()
+        await it(ToolRunner).run(["gpac", "-i", raw_mp4.absolute(), "nhmlw:pckp=true", "-o", nhml_name])
+        xml_name = (Path(tmp_dir.name) / Path(mp4_name).with_suffix('.xml')).absolute()
+        await it(ToolRunner).run(["MP4Box", "-diso", raw_mp4.absolute(), "-out", xml_name])
+        match codec:
+            case Codec.ALAC:
+                alac_atom_name = (Path(tmp_dir.name) / Path(mp4_name).with_suffix('.atom')).absolute()
+                await it(ToolRunner).run(["mp4extract", "moov/trak/mdia/minf/stbl/stsd/enca[0]/alac",
+                                          raw_mp4.absolute(), alac_atom_name])
+                decoder_params = await run_sync(alac_atom_name.read_bytes)
+            case Codec.AAC | Codec.AAC_DOWNMIX | Codec.AAC_BINAURAL | Codec.AAC_LEGACY:
+                info_name = (Path(tmp_dir.name) / Path(mp4_name).with_suffix('.info')).absolute()
+                decoder_params = await run_sync(info_name.read_bytes)
+        info_xml = await run_sync(xml_name.read_text)
+        raw_nhml = await run_sync(nhml_name.read_text)
+        media = await run_sync(media_name.read_bytes)
+    try:
+        sizes, durations, desc_indexes, params = await run_sync(parse_gpac_dump, info_xml, raw_nhml,
+                                                                executor=ExecutorType.CPU)
+    except KeyError as e:
+        with open("FOR_DEBUG_RAW_SONG.mp4", "wb") as f:
+            f.write(raw_song)
+        with open("FOR_DEBUG_NHNT_DUMP.bin", "wb") as f:
+            pickle.dump(raw_nhml, f)
+        logger.error(
+            "An error occurred! Please send FOR_DEBUG_RAW_SONG.mp4 and FOR_DEBUG_NHNT_DUMP.bin to the developer!")
+        raise e
+    samples = SampleTable(media)
+    media_offset = 0
+    for size, duration, desc_index in zip(sizes, durations, desc_indexes):
+        samples.append(media_offset, size, duration, desc_index)
+        media_offset += size
+    return SongInfo(codec=codec, raw=raw_song, samples=samples, nhml=raw_nhml, decoderParams=decoder_params,
+                    params=params)
+
+
+def parse_gpac_dump(raw_info_xml: str, raw_nhml: str) -> Tuple[array, array, array, dict[str, Any]]:
+    """Read sample sizes, durations and description indexes from the output of MP4Box -diso and gpac nhmlw"""
+    info_xml = BeautifulSoup(raw_info_xml, "xml")
+    nhml = BeautifulSoup(raw_nhml, "xml")
+    sizes, durations, desc_indexes = array("I"), array("I"), array("H")
     moofs = info_xml.find_all("MovieFragmentBox")
     nhnt_sample_number = 0
     nhnt_samples = {}
@@ -127,153 +204,255 @@ def extract_song(raw_song: bytes, codec: str) -> SongInfo:
         for trun in truns:
             for sample_number in range(int(trun.get("SampleCount"))):
                 nhnt_sample_number += 1
-                try:
-                    nhnt_sample = nhnt_samples[nhnt_sample_number]
-                except KeyError as e:
-                    with open("FOR_DEBUG_RAW_SONG.mp4", "wb") as f:
-                        f.write(raw_song)
-                    with open("FOR_DEBUG_NHNT_DUMP.bin", "wb") as f:
-                        pickle.dump(nhnt_samples, f)
-                    logger.error(
-                        "An error occurred! Please send FOR_DEBUG_RAW_SONG.mp4 and FOR_DEBUG_NHNT_DUMP.bin to the developer!")
-                    raise e
-                sample_data = media.read(int(nhnt_sample.get("dataLength")))
-                duration = int(nhnt_sample.get("duration"))
-                samples.append(SampleInfo(descIndex=index, data=sample_data, duration=int(duration)))
+                nhnt_sample = nhnt_samples[nhnt_sample_number]
+                sizes.append(int(nhnt_sample.get("dataLength")))
+                durations.append(int(nhnt_sample.get("duration")))
+                desc_indexes.append(index)
     mvhd = info_xml.find("MovieHeaderBox")
     params.update({"CreationTime": convent_mac_timestamp_to_datetime(int(mvhd.get("CreationTime"))),
                    "ModificationTime": convent_mac_timestamp_to_datetime(int(mvhd.get("ModificationTime")))})
-    tmp_dir.cleanup()
-    return SongInfo(codec=codec, raw=raw_song, samples=samples, nhml=raw_nhml, decoderParams=decoder_params,
-                    params=params)
+    return sizes, durations, desc_indexes, params
 
 
-def encapsulate(song_info: SongInfo, decrypted_media: bytes, atmos_convent: bool) -> bytes:
-    tmp_dir = TemporaryDirectory()
-    name = uuid.uuid4().hex
-    media = Path(tmp_dir.name) / Path(name).with_suffix(".media")
-    with open(media.absolute(), "wb") as f:
-        f.write(decrypted_media)
-    song_name = Path(tmp_dir.name) / Path(name).with_suffix(get_suffix(song_info.codec, atmos_convent))
-    match song_info.codec:
-        case Codec.ALAC:
-            nhml_name = Path(tmp_dir.name) / Path(f"{name}.nhml")
-            with open(nhml_name.absolute(), "w", encoding="utf-8") as f:
-                nhml_xml = BeautifulSoup(song_info.nhml, features="xml")
-                nhml_xml.NHNTStream["baseMediaFile"] = media.name
-                f.write(str(nhml_xml))
-            subprocess.run(f"gpac -i {nhml_name.absolute()} nhmlr -o {song_name.absolute()}",
-                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, shell=if_shell())
-            alac_params_atom_name = Path(tmp_dir.name) / Path(f"{name}.atom")
-            with open(alac_params_atom_name.absolute(), "wb") as f:
-                f.write(song_info.decoderParams)
-            final_m4a_name = Path(tmp_dir.name) / Path(f"{name}_final.m4a")
-            subprocess.run(
-                f"mp4edit --insert moov/trak/mdia/minf/stbl/stsd/alac:{alac_params_atom_name.absolute()} {song_name.absolute()} {final_m4a_name.absolute()}",
-                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, shell=if_shell())
-            song_name = final_m4a_name
-        case Codec.EC3 | Codec.AC3:
-            if not atmos_convent:
-                with open(song_name.absolute(), "wb") as f:
-                    f.write(decrypted_media)
-            else:
-                subprocess.run(f"gpac -i {media.absolute()} -o {song_name.absolute()}",
-                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, shell=if_shell())
-        case Codec.AAC_BINAURAL | Codec.AAC_DOWNMIX | Codec.AAC:
-            nhml_name = Path(tmp_dir.name) / Path(f"{name}.nhml")
-            info_name = Path(tmp_dir.name) / Path(f"{name}.info")
-            with open(info_name.absolute(), "wb") as f:
-                f.write(song_info.decoderParams)
-            with open(nhml_name.absolute(), "w", encoding="utf-8") as f:
-                nhml_xml = BeautifulSoup(song_info.nhml, features="xml")
-                nhml_xml.NHNTStream["baseMediaFile"] = media.name
-                nhml_xml.NHNTStream["specificInfoFile"] = info_name.name
-                nhml_xml.NHNTStream["streamType"] = "5"
-                f.write(str(nhml_xml))
-            subprocess.run(f"gpac -i {nhml_name.absolute()} nhmlr -o {song_name.absolute()}",
-                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, shell=if_shell())
-    if not if_raw_atmos(song_info.codec, atmos_convent):
-        subprocess.run(f'MP4Box -brand "M4A " -ab "M4A " -ab "mp42" {song_name.absolute()}',
-                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, shell=if_shell())
-    with open(song_name.absolute(), "rb") as f:
-        final_song = f.read()
-    tmp_dir.cleanup()
-    return final_song
-
-
-def write_metadata(song: bytes, metadata: SongMetadata, embed_metadata: list[str],
-                         cover_format: str, params: dict[str, Any]) -> bytes:
-    tmp_dir = TemporaryDirectory()
-    name = uuid.uuid4().hex
-    song_name = Path(tmp_dir.name) / Path(f"{name}.m4a")
-    with open(song_name.absolute(), "wb") as f:
-        f.write(song)
-    subprocess.run(["MP4Box",
-                    "-time", params.get("CreationTime").strftime("%d/%m/%Y-%H:%M:%S"),
-                    "-mtime", params.get("ModificationTime").strftime("%d/%m/%Y-%H:%M:%S"), "-keep-utc",
-                    "-name", f"1={metadata.title}", "-itags", "tool=", song_name.absolute()],
-                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+async def finalize(song_info: SongInfo, decrypted_media: bytes, metadata: SongMetadata, embed_metadata: list[str],
+                   cover_format: str, atmos_convent: bool) -> Tuple[bytes, int]:
+    """Turn decrypted samples into the final song, return the song and the number of bytes copied to produce it"""
+    if if_raw_atmos(song_info.codec, atmos_convent):
+        return decrypted_media, 0
+    if it(Config).download.muxer == "native":
+        try:
+            song = await run_sync(encapsulate_native, song_info, decrypted_media, metadata, embed_metadata)
+            return song, len(song)
+        except (MP4ParseException, struct.error, IndexError) as e:
+            logger.warning(f"Failed to encapsulate {song_info.codec} song in process, falling back to external tools: {e}")
+    return await finalize_tools(song_info, decrypted_media, metadata, embed_metadata, cover_format, atmos_convent)
+
+
+async def finalize_tools(song_info: SongInfo, decrypted_media: bytes, metadata: SongMetadata,
+                         embed_metadata: list[str], cover_format: str, atmos_convent: bool) -> Tuple[bytes, int]:
+    # Every step writes its input to a temporary file and reads its output back
+    song = await encapsulate_tools(song_info, decrypted_media, atmos_convent)
+    copied = len(decrypted_media) + len(song)
+    fixed_song = await fix_encapsulate(song)
+    copied += len(song) + len(fixed_song)
+    song = await write_metadata(fixed_song, metadata, embed_metadata, cover_format, song_info.params)
+    copied += len(fixed_song) + len(song)
+    if song_info.codec in (Codec.AAC, Codec.AAC_DOWNMIX, Codec.AAC_BINAURAL):
+        fixed_song = await fix_esds_box(song_info.raw, song)
+        copied += len(song_info.raw) + len(song) + len(fixed_song)
+        song = fixed_song
+    return song, copied
+
+
+def encapsulate_native(song_info: SongInfo, decrypted_media: bytes, metadata: SongMetadata = None,
+                       embed_metadata: list[str] = None) -> bytes:
+    track, _ = parse_init_segment(song_info.raw)
+    sample_entry = make_plain_sample_entry(song_info.raw, track.entries[0])
+    udta = make_udta(metadata.to_mutagen_tags(embed_metadata)) if metadata else b""
+    handler_name = metadata.title if metadata and metadata.title else "SoundHandler"
+    return build_m4a(sample_entry, track.timescale, song_info.samples.sizes, song_info.samples.durations,
+                     decrypted_media, track.creation_time, track.modification_time, udta, handler_name)
+
+
+def _edit_nhml(nhml: str, **attrs: str) -> str:
+    nhml_xml = BeautifulSoup(nhml, features="xml")
+    for key, value in attrs.items():
+        nhml_xml.NHNTStream[key] = value
+    return str(nhml_xml)
+
+
+async def encapsulate_tools(song_info: SongInfo, decrypted_media: bytes, atmos_convent: bool) -> bytes:
+    async with it(ScratchSpace).workspace(len(decrypted_media) * 3) as tmp_dir:
+        name = uuid.uuid4().hex
+        media = Path(tmp_dir.name) / Path(name).with_suffix(".media")
+        await run_sync(media.write_bytes, decrypted_media)
+        song_name = Path(tmp_dir.name) / Path(name).with_suffix(get_suffix(song_info.codec, atmos_convent))
+        match song_info.codec:
+            case Codec.ALAC:
+                nhml_name = Path(tmp_dir.name) / Path(f"{name}.nhml")
+                nhml = await run_sync(_edit_nhml, song_info.nhml, baseMediaFile=media.name)
+                await run_sync(nhml_name.write_text, nhml, "utf-8")
+                await it(ToolRunner).run(["gpac", "-i", nhml_name.absolute(), "nhmlr", "-o", song_name.absolute()])
+                alac_params_atom_name = Path(tmp_dir.name) / Path(f"{name}.atom")
+                await run_sync(alac_params_atom_name.write_bytes, song_info.decoderParams)
+                final_m4a_name = Path(tmp_dir.name) / Path(f"{name}_final.m4a")
+                await it(ToolRunner).run(["mp4edit", "--insert",
+                                          f"moov/trak/mdia/minf/stbl/stsd/alac:{alac_params_atom_name.absolute()}",
+                                          song_name.absolute(), final_m4a_name.absolute()])
+                song_name = final_m4a_name
+            case Codec.EC3 | Codec.AC3:
+                if not atmos_convent:
+                    await run_sync(song_name.write_bytes, decrypted_media)
+                else:
+                    await it(ToolRunner).run(["gpac", "-i", media.absolute(), "-o", song_name.absolute()])
+            case Codec.AAC_BINAURAL | Codec.AAC_DOWNMIX | Codec.AAC:
+                nhml_name = Path(tmp_dir.name) / Path(f"{name}.nhml")
+                info_name = Path(tmp_dir.name) / Path(f"{name}.info")
+                await run_sync(info_name.write_bytes, song_info.decoderParams)
+                nhml = await run_sync(_edit_nhml, song_info.nhml, baseMediaFile=media.name,
+                                      specificInfoFile=info_name.name, streamType="5")
+                await run_sync(nhml_name.write_text, nhml, "utf-8")
+                await it(ToolRunner).run(["gpac", "-i", nhml_name.absolute(), "nhmlr", "-o", song_name.absolute()])
+        if not if_raw_atmos(song_info.codec, atmos_convent):
+            await it(ToolRunner).run(["MP4Box", "-brand", "M4A ", "-ab", "M4A ", "-ab", "mp42", song_name.absolute()])
+        return await run_sync(song_name.read_bytes)
+
+
+def _write_mutagen_tags(song_name: Path, tags: dict):
     mp4 = mutagen.mp4.Open(song_name.absolute())
-    mp4.update(metadata.to_mutagen_tags(embed_metadata))
+    mp4.update(tags)
     mp4.save()
-    with open(song_name.absolute(), "rb") as f:
-        embed_song = f.read()
-    tmp_dir.cleanup()
-    return embed_song
+
+
+async def write_metadata(song: bytes, metadata: SongMetadata, embed_metadata: list[str],
+                         cover_format: str, params: dict[str, Any]) -> bytes:
+    async with it(ScratchSpace).workspace(len(song)) as tmp_dir:
+        name = uuid.uuid4().hex
+        song_name = Path(tmp_dir.name) / Path(f"{name}.m4a")
+        await run_sync(song_name.write_bytes, song)
+        await it(ToolRunner).run(["MP4Box",
+                                  "-time", params.get("CreationTime").strftime("%d/%m/%Y-%H:%M:%S"),
+                                  "-mtime", params.get("ModificationTime").strftime("%d/%m/%Y-%H:%M:%S"), "-keep-utc",
+                                  "-name", f"1={metadata.title}", "-itags", "tool=", song_name.absolute()])
+        await run_sync(_write_mutagen_tags, song_name, metadata.to_mutagen_tags(embed_metadata))
+        return await run_sync(song_name.read_bytes)
 
 
 # There are suspected errors in M4A files encapsulated by MP4Box and GPAC,
 # causing some applications to be unable to correctly process Metadata (such as Android.media, Salt Music)
 # Using FFMPEG re-encapsulating solves this problem
-def fix_encapsulate(song: bytes) -> bytes:
-    tmp_dir = TemporaryDirectory()
-    name = uuid.uuid4().hex
-    song_name = Path(tmp_dir.name) / Path(f"{name}.m4a")
-    new_song_name = Path(tmp_dir.name) / Path(f"{name}_fixed.m4a")
-    with open(song_name.absolute(), "wb") as f:
-        f.write(song)
-    subprocess.run(
-        f"ffmpeg -y -i {song_name.absolute()} -fflags +bitexact -map_metadata 0 -c:a copy -c:v copy {new_song_name.absolute()}",
-        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, shell=if_shell())
-    with open(new_song_name.absolute(), "rb") as f:
-        encapsulated_song = f.read()
-    tmp_dir.cleanup()
-    return encapsulated_song
+async def fix_encapsulate(song: bytes) -> bytes:
+    async with it(ScratchSpace).workspace(len(song) * 2) as tmp_dir:
+        name = uuid.uuid4().hex
+        song_name = Path(tmp_dir.name) / Path(f"{name}.m4a")
+        new_song_name = Path(tmp_dir.name) / Path(f"{name}_fixed.m4a")
+        await run_sync(song_name.write_bytes, song)
+        await it(ToolRunner).run(["ffmpeg", "-y", "-i", song_name.absolute(), "-fflags", "+bitexact",
+                                  "-map_metadata", "0", "-c:a", "copy", "-c:v", "copy", new_song_name.absolute()])
+        return await run_sync(new_song_name.read_bytes)
 
 
 # FFMPEG will overwrite maxBitrate in DecoderConfigDescriptor
 # Using raw song's esds box to fix it
 # see also https://trac.ffmpeg.org/ticket/4894
-def fix_esds_box(raw_song: bytes, song: bytes) -> bytes:
-    tmp_dir = TemporaryDirectory()
-    name = uuid.uuid4().hex
-    esds_name = Path(tmp_dir.name) / Path(f"{name}.atom")
-    raw_song_name = Path(tmp_dir.name) / Path(f"{name}_raw.m4a")
-    song_name = Path(tmp_dir.name) / Path(f"{name}.m4a")
-    final_song_name = Path(tmp_dir.name) / Path(f"{name}_final.m4a")
-    with open(raw_song_name.absolute(), "wb") as f:
-        f.write(raw_song)
-    with open(song_name.absolute(), "wb") as f:
-        f.write(song)
-    subprocess.run(
-        f"mp4extract moov/trak/mdia/minf/stbl/stsd/enca[0]/esds {raw_song_name.absolute()} {esds_name.absolute()}",
-        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, shell=if_shell())
-    subprocess.run(
-        f"mp4edit --replace moov/trak/mdia/minf/stbl/stsd/mp4a/esds:{esds_name.absolute()} {song_name.absolute()} {final_song_name.absolute()}",
-        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, shell=if_shell())
-    with open(final_song_name.absolute(), "rb") as f:
-        final_song = f.read()
-    tmp_dir.cleanup()
-    return final_song
-
-
-def check_song_integrity(song: bytes) -> bool:
-    tmp_dir = TemporaryDirectory()
-    name = uuid.uuid4().hex
-    song_name = Path(tmp_dir.name) / Path(f"{name}.m4a")
-    with open(song_name.absolute(), "wb") as f:
-        f.write(song)
-    output = subprocess.run(f"ffmpeg -y -v error -i {song_name.absolute()} -c:a pcm_s16le -f null /dev/null",
-                            capture_output=True, shell=if_shell())
-    tmp_dir.cleanup()
-    return not bool(output.stderr)
+async def fix_esds_box(raw_song: bytes, song: bytes) -> bytes:
+    async with it(ScratchSpace).workspace(len(raw_song) + len(song) * 2) as tmp_dir:
+        name = uuid.uuid4().hex
+        esds_name = Path(tmp_dir.name) / Path(f"{name}.atom")
+        raw_song_name = Path(tmp_dir.name) / Path(f"{name}_raw.m4a")
+        song_name = Path(tmp_dir.name) / Path(f"{name}.m4a")
+        final_song_name = Path(tmp_dir.name) / Path(f"{name}_final.m4a")
+        await run_sync(raw_song_name.write_bytes, raw_song)
+        await run_sync(song_name.write_bytes, song)
+        await it(ToolRunner).run(["mp4extract", "moov/trak/mdia/minf/stbl/stsd/enca[0]/esds",
+                                  raw_song_name.absolute(), esds_name.absolute()])
+        await it(ToolRunner).run(["mp4edit", "--replace", f"moov/trak/mdia/minf/stbl/stsd/mp4a/esds:{esds_name.absolute()}",
+                                  song_name.absolute(), final_song_name.absolute()])
+        return await run_sync(final_song_name.read_bytes)
+
+
+SAMPLED_WINDOW_SECONDS = 2
+
+
+def _parse_song(song: bytes) -> Track:
+    if find_box(song, "moov/mvex"):
+        return parse_fragmented_mp4(song)
+    return parse_progressive_mp4(song)
+
+
+def _moov_first(song: bytes) -> bool:
+    try:
+        for box in iter_boxes(song):
+            if box.type in (b"moov", b"mdat"):
+                return box.type == b"moov"
+    except MP4ParseException:
+        pass
+    return False
+
+
+def check_song_structure(song: bytes, song_info: SongInfo, raw_atmos: bool = False) -> Optional[str]:
+    """Compare the song with the sample table it was built from, return the reason if they do not match"""
+    expected = song_info.samples
+    if raw_atmos:
+        if len(song) != expected.total_size():
+            return f"Song has {len(song)} bytes, expected {expected.total_size()}"
+        return None
+    try:
+        check_box_tree(song)
+        track = _parse_song(song)
+    except (MP4ParseException, struct.error) as e:
+        return str(e)
+    if len(track.samples) != len(expected):
+        return f"Song has {len(track.samples)} samples, expected {len(expected)}"
+    if track.samples.sizes != expected.sizes:
+        return f"Song has {track.samples.total_size()} bytes of samples, expected {expected.total_size()}"
+    duration = sum(track.samples.durations)
+    if duration != sum(expected.durations):
+        return f"Song has a duration of {duration}, expected {sum(expected.durations)}"
+    # The mdhd of a fragmented song does not cover the fragments
+    if track.duration and track.duration != duration:
+        return f"mdhd has a duration of {track.duration}, but the samples last {duration}"
+    mdats = [(box.body, box.end) for box in iter_boxes(song) if box.type == b"mdat"]
+    for offset, size in zip(track.samples.offsets, track.samples.sizes):
+        if not any(start <= offset and offset + size <= end for start, end in mdats):
+            return f"Sample at offset {offset} is outside of mdat"
+    return None
+
+
+def build_sampled_clip(song: bytes, song_info: SongInfo, raw_atmos: bool, windows: int) -> bytes:
+    """Cut a few random windows of samples out of the song into a small M4A"""
+    if raw_atmos:
+        track, _ = parse_init_segment(song_info.raw)
+        sample_entry = make_plain_sample_entry(song_info.raw, track.entries[0])
+        samples = SampleTable(song)
+        offset = 0
+        for size, duration, desc_index in zip(song_info.samples.sizes, song_info.samples.durations,
+                                              song_info.samples.desc_indexes):
+            samples.append(offset, size, duration, desc_index)
+            offset += size
+    else:
+        track = _parse_song(song)
+        sample_entry = make_plain_sample_entry(song, track.entries[0])
+        samples = track.samples
+    window = SAMPLED_WINDOW_SECONDS * track.timescale
+    indexes = []
+    for start in sorted(random.sample(range(len(samples)), min(windows, len(samples)))):
+        index, elapsed = max(start, indexes[-1] + 1 if indexes else 0), 0
+        while index < len(samples) and elapsed < window:
+            indexes.append(index)
+            elapsed += samples.durations[index]
+            index += 1
+    return build_m4a(sample_entry, track.timescale, [samples.sizes[i] for i in indexes],
+                     [samples.durations[i] for i in indexes], b"".join(samples.data(i) for i in indexes))
+
+
+async def decode_song(song: bytes, raw_atmos: bool = False) -> bool:
+    # ffmpeg can only read an MP4 from a pipe when the moov comes before the media
+    if raw_atmos or _moov_first(song):
+        result = await it(ToolRunner).run(["ffmpeg", "-y", "-v", "error", "-i", "pipe:0",
+                                           "-c:a", "pcm_s16le", "-f", "null", "-"], check=False, input=song)
+        return not bool(result.stderr)
+    async with it(ScratchSpace).workspace(len(song)) as tmp_dir:
+        name = uuid.uuid4().hex
+        song_name = Path(tmp_dir.name) / Path(f"{name}.m4a")
+        await run_sync(song_name.write_bytes, song)
+        result = await it(ToolRunner).run(["ffmpeg", "-y", "-v", "error", "-i", song_name.absolute(),
+                                           "-c:a", "pcm_s16le", "-f", "null", "-"], check=False)
+        return not bool(result.stderr)
+
+
+async def check_song_integrity(song: bytes, song_info: SongInfo, raw_atmos: bool = False) -> bool:
+    level = it(Config).download.integrityCheck
+    if level == "off":
+        return True
+    if level == "full":
+        return await decode_song(song, raw_atmos)
+    error = await run_sync(check_song_structure, song, song_info, raw_atmos)
+    if error:
+        logger.warning(f"Structural integrity check of {song_info.codec} song failed: {error}")
+        return False
+    if level == "sampled":
+        clip = await run_sync(build_sampled_clip, song, song_info, raw_atmos,
+                              it(Config).download.integrityCheckWindows)
+        return await decode_song(clip)
+    return True
@@ -1,6 +1,5 @@
 from typing import Optional
 
-import m3u8
 from creart import it
 from pydantic import BaseModel
 
@@ -9,7 +8,7 @@ from src.utils import get_codec_from_codec_id
 
 
 async def get_available_audio_quality(m3u8_url: str):
-    parsed_m3u8 = m3u8.loads(await it(WebAPI).download_m3u8(m3u8_url), uri=m3u8_url)
+    parsed_m3u8 = await it(WebAPI).get_m3u8(m3u8_url)
     result = []
     for playlist in parsed_m3u8.playlists:
         if get_codec_from_codec_id(playlist.stream_info.audio):
@@ -1,25 +1,30 @@
 import asyncio
+import struct
 import subprocess
 from typing import Dict
 
 from creart import it
 
 from src.api import WebAPI
+from src.catalog_batch import CatalogBatch
 from src.config import Config
+from src.download_cache import DownloadCache
+from src.exceptions import MP4ParseException, ToolException
 from src.flags import Flags
-from src.grpc.manager import WrapperManager, WrapperManagerException
-from src.logger import RipLogger
+from src.grpc.manager import WrapperManager
+from src.fmp4 import FragmentStream
+from src.logger import RipLogger, GlobalLogger
 from src.measurer import SpeedMeasurer
 from src.metadata import SongMetadata
 from src.models import PlaylistInfo
-from src.mp4 import extract_media, extract_song, encapsulate, write_metadata, fix_encapsulate, fix_esds_box, \
-    check_song_integrity
+from src.mp4 import extract_media, extract_song, finalize, write_metadata, check_song_integrity
 from src.save import save
 from src.task import Task, Status
 from src.types import Codec, ParentDoneHandler
 from src.url import Song, Album, URLType, Playlist
-from src.utils import get_codec_from_codec_id, check_song_existence, check_song_exists, if_raw_atmos, \
-    check_album_existence, playlist_write_song_index, run_sync, safely_create_task, language_exist, query_language
+from src.utils import get_codec_from_codec_id, check_song_existence, check_song_exists, \
+    check_album_existence, vouch_song_existence, get_next_offset, run_sync, safely_create_task, language_exist, query_language, \
+    ttml_convent_to_lrc, ExecutorType, if_raw_atmos
 from src.legacy.mp4 import extract_media as legacy_extract_media
 from src.legacy.mp4 import decrypt as legacy_decrypt
 from src.legacy.decrypt import WidevineDecrypt
@@ -27,11 +32,15 @@ from src.legacy.decrypt import WidevineDecrypt
 # START -> getMetadata -> getLyrics -> getM3U8 -> downloadSong -> decrypt -> encapsulate -> save -> END
 
 adam_id_task_mapping: Dict[str, Task] = {}
+# Seconds to wait for the replies to streamed samples before a song is decrypted again
+DECRYPT_DRAIN_TIMEOUT = 120
 task_lock = asyncio.Semaphore(it(Config).download.maxRunningTasks)
 
 
 async def task_done(task: Task, status: Status):
     task_lock.release()
+    if task.m3u8Info:
+        await it(DownloadCache).release(task.m3u8Info.uri)
     task.update_status(status)
     if task.parentDone:
         await task.parentDone.try_done()
@@ -48,10 +57,12 @@ async def on_decrypt_failed(adam_id: str, key: str, sample: bytes, sample_index:
 
 
 async def recv_decrypted_sample(adam_id: str, sample_index: int, sample: bytes):
-    task = adam_id_task_mapping[adam_id]
-    task.decryptedSamples[sample_index] = sample
-    task.decryptedCount += 1
-    if task.decryptedCount == len(task.decryptedSamples):
+    task = adam_id_task_mapping.get(adam_id)
+    if not task:
+        # The song failed before all of its replies arrived
+        return
+    task.decrypt_received()
+    if task.write_decrypted_sample(sample_index, sample) and task.decrypt_finished():
         safely_create_task(decrypt_done(adam_id))
 
 
@@ -59,18 +70,19 @@ async def decrypt_done(adam_id: str):
     task = adam_id_task_mapping[adam_id]
     codec = get_codec_from_codec_id(task.m3u8Info.codec_id)
 
-    song = await run_sync(encapsulate, task.info, bytes().join(task.decryptedSamples),
-                          it(Config).download.atmosConventToM4a)
-    if not if_raw_atmos(codec, it(Config).download.atmosConventToM4a):
-        if codec != Codec.EC3 or codec != Codec.EC3:
-            song = await run_sync(fix_encapsulate, song)
-        song = await run_sync(write_metadata, song, task.metadata, it(Config).metadata.embedMetadata,
-                              it(Config).download.coverFormat, task.info.params)
-        if codec == Codec.AAC or codec == Codec.AAC_DOWNMIX or codec == Codec.AAC_BINAURAL:
-            song = await run_sync(fix_esds_box, task.info.raw, song)
-
-    if not await run_sync(check_song_integrity, song):
-        task.logger.failed_integrity()
+    try:
+        song, copied = await finalize(task.info, memoryview(task.decryptedMedia), task.metadata,
+                                      it(Config).metadata.embedMetadata, it(Config).download.coverFormat,
+                                      it(Config).download.atmosConventToM4a)
+        it(SpeedMeasurer).record_finalize(copied)
+
+        if not await check_song_integrity(song, task.info, if_raw_atmos(task.info.codec,
+                                                                         it(Config).download.atmosConventToM4a)):
+            task.logger.failed_integrity()
+    except ToolException as e:
+        task.logger.failed_tool(e)
+        await task_done(task, Status.FAILED)
+        return
 
     filename = await run_sync(save, song, codec, task.metadata, task.playlist)
     task.logger.saved()
@@ -83,16 +95,20 @@ async def decrypt_done(adam_id: str):
 
 
 async def rip_song(url: Song, codec: str, flags: Flags = Flags(),
-                   parent_done: ParentDoneHandler = None, playlist: PlaylistInfo = None):
+                   parent_done: ParentDoneHandler = None, playlist: PlaylistInfo = None, batch: CatalogBatch = None):
     task = Task(adam_id=url.id, parent_done=parent_done, playlist=playlist)
     adam_id_task_mapping[url.id] = task
     task.init_logger()
     await task_lock.acquire()
 
     # Set Metadata
-    raw_metadata = await it(WebAPI).get_song_info(task.adamId, url.storefront, flags.language)
-    album_data = await it(WebAPI).get_album_info(raw_metadata.relationships.albums.data[0].id, url.storefront,
-                                                 flags.language)
+    if batch:
+        raw_metadata = await batch.song_info(task.adamId)
+        album_data = await batch.album_info(raw_metadata.relationships.albums.data[0].id)
+    else:
+        raw_metadata = await it(WebAPI).get_song_info(task.adamId, url.storefront, flags.language)
+        album_data = await it(WebAPI).get_album_info(raw_metadata.relationships.albums.data[0].id, url.storefront,
+                                                     flags.language)
     task.metadata = SongMetadata.parse_from_song_data(raw_metadata)
     task.metadata.parse_from_album_data(album_data)
 
@@ -113,6 +129,8 @@ async def rip_song(url: Song, codec: str, flags: Flags = Flags(),
     if raw_metadata.attributes.hasTimeSyncedLyrics:
         task.metadata.lyrics = await it(WrapperManager).lyrics(task.adamId, flags.language,
                                                                url.storefront)
+        if task.metadata.lyrics:
+            task.metadata.lrc = await run_sync(ttml_convent_to_lrc, task.metadata.lyrics, executor=ExecutorType.CPU)
     if playlist:
         task.metadata.set_playlist_index(playlist.songIdIndexMapping.get(url.id))
 
@@ -154,19 +172,60 @@ async def rip_song(url: Song, codec: str, flags: Flags = Flags(),
             await task_done(task, Status.DONE)
             return
 
-    # Download
+    # Download, sending the samples of each fragment to decrypt as soon as it arrives
     task.logger.downloading()
     task.update_status(Status.DOWNLOADING)
-    raw_song = await it(WebAPI).download_song(task.m3u8Info.uri)
+    task.begin_decrypted_samples()
+    stream = FragmentStream()
+    streaming = True
+
+    async def on_chunk(buffer: bytearray, filled: int):
+        nonlocal streaming
+        if not streaming:
+            return
+        try:
+            samples = stream.feed(buffer, filled)
+        except (MP4ParseException, struct.error):
+            # Leave the song to be decrypted once it has been downloaded
+            streaming = False
+            return
+        task.reserve_decrypted_media(len(buffer))
+        for sample_index, sample, desc_index in samples:
+            task.add_decrypted_sample(len(sample))
+            task.decrypt_sent()
+            await it(WrapperManager).decrypt(task.adamId, task.m3u8Info.keys[desc_index], sample, sample_index)
+
+    raw_song = await it(WebAPI).download_song(task.m3u8Info.uri, on_chunk)
 
     # Decrypt
     task.logger.decrypting()
     task.update_status(Status.DECRYPTING)
     codec = get_codec_from_codec_id(task.m3u8Info.codec_id)
-    task.info = await run_sync(extract_song, raw_song, codec)
-    task.init_decrypted_samples()
-    for sampleIndex, sample in enumerate(task.info.samples):
-        await it(WrapperManager).decrypt(task.adamId, task.m3u8Info.keys[sample.descIndex], sample.data, sampleIndex)
+    try:
+        task.info = await extract_song(raw_song, codec)
+    except ToolException as e:
+        task.logger.failed_tool(e)
+        await task_done(task, Status.FAILED)
+        return
+    if not task.seal_decrypted_samples():
+        it(GlobalLogger).logger.warning(f"Samples of song {task.adamId} parsed while downloading differ from the "
+                                        f"sample table, decrypting them again")
+        # Replies to the streamed samples would land on the same indexes of the new store
+        try:
+            await asyncio.wait_for(task.decryptDrained.wait(), DECRYPT_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            # A reply was lost, the song would wait forever
+            task.logger.failed_decrypt()
+            await task_done(task, Status.FAILED)
+            return
+        task.init_decrypted_samples()
+        for sampleIndex, (sample, descIndex) in enumerate(zip(task.info.samples.views(),
+                                                              task.info.samples.desc_indexes)):
+            task.decrypt_sent()
+            await it(WrapperManager).decrypt(task.adamId, task.m3u8Info.keys[descIndex], sample, sampleIndex)
+    # All samples may have been decrypted before the song was sealed
+    elif task.decrypt_finished():
+        safely_create_task(decrypt_done(task.adamId))
 
 
 async def rip_song_legacy(task: Task):
@@ -175,22 +234,27 @@ async def rip_song_legacy(task: Task):
     task.logger.downloading()
     task.update_status(Status.DOWNLOADING)
     raw_song = await it(WebAPI).download_song(task.m3u8Info.uri)
-    task.info = await run_sync(extract_song, raw_song, Codec.AAC_LEGACY)
-
-    task.logger.decrypting()
-    task.update_status(Status.DECRYPTING)
-    wvDecrypt = WidevineDecrypt()
-    challenge = wvDecrypt.generate_challenge(task.m3u8Info.keys[0].split(",")[1])
-    wvLicense = await it(WrapperManager).license(adam_id=task.adamId, challenge=challenge,
-                                                 kid=task.m3u8Info.keys[0])
-    keys = wvDecrypt.generate_key(wvLicense)
-    song = await run_sync(legacy_decrypt, raw_song, keys[1].kid.hex, keys[1].key.hex())
-
-    song = await run_sync(write_metadata, song, task.metadata, it(Config).metadata.embedMetadata,
-                          it(Config).download.coverFormat, task.info.params)
-
-    if not await run_sync(check_song_integrity, song):
-        task.logger.failed_integrity()
+    try:
+        task.info = await extract_song(raw_song, Codec.AAC_LEGACY)
+
+        task.logger.decrypting()
+        task.update_status(Status.DECRYPTING)
+        wvDecrypt = WidevineDecrypt()
+        challenge = wvDecrypt.generate_challenge(task.m3u8Info.keys[0].split(",")[1])
+        wvLicense = await it(WrapperManager).license(adam_id=task.adamId, challenge=challenge,
+                                                     kid=task.m3u8Info.keys[0])
+        keys = wvDecrypt.generate_key(wvLicense)
+        song = await legacy_decrypt(raw_song, keys[1].kid.hex, keys[1].key.hex())
+
+        song = await write_metadata(song, task.metadata, it(Config).metadata.embedMetadata,
+                                    it(Config).download.coverFormat, task.info.params)
+
+        if not await check_song_integrity(song, task.info):
+            task.logger.failed_integrity()
+    except ToolException as e:
+        task.logger.failed_tool(e)
+        await task_done(task, Status.FAILED)
+        return
 
     filename = await run_sync(save, song, Codec.AAC_LEGACY, task.metadata, task.playlist)
     task.logger.saved()
@@ -211,17 +275,24 @@ async def rip_album(url: Album, codec: str, flags: Flags = Flags(), parent_done:
     if not await check_album_existence(url.id, url.storefront):
         logger.not_exist()
         return
+    vouch_song_existence([track.id for track in album_info.data[0].relationships.tracks.data], url.storefront)
+
+    batch = CatalogBatch(url.storefront, flags.language)
+    # Children share the album loaded here instead of loading it again
+    batch.prime_album(album_info)
 
     async def on_children_done():
+        logger.catalog_requests(batch.summary())
         logger.done()
         if parent_done:
             await parent_done.try_done()
 
     done_handler = ParentDoneHandler(len(album_info.data[0].relationships.tracks.data), on_children_done)
 
+    batch.prefetch([track.id for track in album_info.data[0].relationships.tracks.data])
     for track in album_info.data[0].relationships.tracks.data:
         song = Song(id=track.id, storefront=url.storefront, url="", type=URLType.Song)
-        safely_create_task(rip_song(song, codec, flags, done_handler))
+        safely_create_task(rip_song(song, codec, flags, done_handler, batch=batch))
 
 
 async def rip_artist(url: Album, codec: str, flags: Flags = Flags()):
@@ -234,31 +305,62 @@ async def rip_artist(url: Album, codec: str, flags: Flags = Flags()):
     async def on_children_done():
         logger.done()
 
+    # Children are started as the pages of the listing arrive
+    done_handler = ParentDoneHandler(0, on_children_done, sealed=False)
+    seen = set()
     if flags.include_participate_in_works:
-        songs = await it(WebAPI).get_songs_from_artist(url.id, url.storefront, flags.language)
-        done_handler = ParentDoneHandler(len(songs), on_children_done)
-        for song_url in songs:
-            safely_create_task(rip_song(Song.parse_url(song_url), codec, flags, done_handler))
+        async for songs in it(WebAPI).iter_songs_from_artist(url.id, url.storefront, flags.language):
+            for song_url in songs:
+                if song_url in seen:
+                    continue
+                seen.add(song_url)
+                done_handler.add()
+                safely_create_task(rip_song(Song.parse_url(song_url), codec, flags, done_handler))
     else:
-        albums = await it(WebAPI).get_albums_from_artist(url.id, url.storefront, flags.language)
-        done_handler = ParentDoneHandler(len(albums), on_children_done)
-        for album_url in albums:
-            safely_create_task(rip_album(Album.parse_url(album_url), codec, flags, done_handler))
+        async for albums in it(WebAPI).iter_albums_from_artist(url.id, url.storefront, flags.language):
+            for album_url in albums:
+                if album_url in seen:
+                    continue
+                seen.add(album_url)
+                done_handler.add()
+                safely_create_task(rip_album(Album.parse_url(album_url), codec, flags, done_handler))
+    await done_handler.seal()
 
 
 async def rip_playlist(url: Playlist, codec: str, flags: Flags = Flags()):
-    playlist_info = await it(WebAPI).get_playlist_info_and_tracks(url.id, url.storefront, flags.language)
-    playlist_info = playlist_write_song_index(playlist_info)
+    playlist_info = await it(WebAPI).get_playlist_info(url.id, url.storefront, flags.language)
     logger = RipLogger(url.type, url.id)
     logger.set_fullname(playlist_info.data[0].attributes.curatorName, playlist_info.data[0].attributes.name)
 
     logger.create()
 
+    batch = CatalogBatch(url.storefront, flags.language)
+
     async def on_children_done():
+        logger.catalog_requests(batch.summary())
         logger.done()
 
-    done_handler = ParentDoneHandler(len(playlist_info.data[0].relationships.tracks.data), on_children_done)
-
-    for track in playlist_info.data[0].relationships.tracks.data:
-        song = Song(id=track.id, storefront=url.storefront, url="", type=URLType.Song)
-        safely_create_task(rip_song(song, codec, flags, done_handler, playlist=playlist_info))
+    done_handler = ParentDoneHandler(0, on_children_done, sealed=False)
+    tracks = playlist_info.data[0].relationships.tracks
+    position = 0
+
+    def rip_tracks(page):
+        nonlocal position
+        batch.prefetch([track.id for track in page])
+        for track in page:
+            position += 1
+            # A song listed twice is downloaded once, under its first index
+            if track.id in playlist_info.songIdIndexMapping:
+                continue
+            playlist_info.songIdIndexMapping[track.id] = position
+            done_handler.add()
+            song = Song(id=track.id, storefront=url.storefront, url="", type=URLType.Song)
+            safely_create_task(rip_song(song, codec, flags, done_handler, playlist=playlist_info, batch=batch))
+
+    rip_tracks(list(tracks.data))
+    if tracks.next:
+        async for page in it(WebAPI).iter_playlist_tracks(url.id, url.storefront, flags.language,
+                                                          get_next_offset(tracks.next)):
+            tracks.data.extend(page)
+            rip_tracks(page)
+    await done_handler.seal()
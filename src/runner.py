@@ -0,0 +1,100 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Type
+
+from creart import AbstractCreator, CreateTargetInfo, exists_module, it
+
+from src.config import Config
+from src.exceptions import ToolException
+
+
+@dataclass
+class ToolResult:
+    returncode: int
+    stdout: bytes
+    stderr: bytes
+
+
+@dataclass
+class ToolStats:
+    count: int = 0
+    failures: int = 0
+    total_time: float = 0.0
+    running: int = 0
+
+
+class ToolRunner:
+    concurrency: int
+    timeout: float
+    stats: dict[str, ToolStats]
+    _semaphores: dict[str, asyncio.Semaphore]
+
+    def __init__(self, concurrency: int, timeout: float):
+        self.concurrency = concurrency if concurrency > 0 else os.cpu_count() or 1
+        self.timeout = timeout
+        self.stats = {}
+        self._semaphores = {}
+
+    def _semaphore(self, tool: str) -> asyncio.Semaphore:
+        if tool not in self._semaphores:
+            self._semaphores[tool] = asyncio.Semaphore(self.concurrency)
+        return self._semaphores[tool]
+
+    async def run(self, argv: list, check: bool = True, timeout: Optional[float] = None,
+                  input: Optional[bytes] = None) -> ToolResult:
+        """
+        Run an external tool without a shell, limiting the number of concurrent processes of each tool.
+        If input is given, it is fed to the stdin of the tool.
+        """
+        argv = [str(arg) for arg in argv]
+        tool = Path(argv[0]).stem
+        stats = self.stats.setdefault(tool, ToolStats())
+        async with self._semaphore(tool):
+            stats.running += 1
+            start = time.monotonic()
+            try:
+                stdin = asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL
+                process = await asyncio.create_subprocess_exec(*argv, stdin=stdin,
+                                                               stdout=asyncio.subprocess.PIPE,
+                                                               stderr=asyncio.subprocess.PIPE)
+                try:
+                    stdout, stderr = await asyncio.wait_for(process.communicate(input), timeout or self.timeout)
+                except BaseException as e:
+                    # Timed out or cancelled, the process must not outlive its caller
+                    if process.returncode is None:
+                        process.kill()
+                        await asyncio.shield(process.wait())
+                    stats.failures += 1
+                    if isinstance(e, asyncio.TimeoutError):
+                        raise ToolException(tool, None, f"Timed out after {timeout or self.timeout} seconds")
+                    raise
+            finally:
+                stats.running -= 1
+                stats.count += 1
+                stats.total_time += time.monotonic() - start
+        if check and process.returncode != 0:
+            stats.failures += 1
+            raise ToolException(tool, process.returncode, stderr.decode(errors="ignore").strip())
+        return ToolResult(process.returncode, stdout, stderr)
+
+    def summary(self) -> str:
+        return ", ".join(f"{tool}: {stats.count} runs ({stats.failures} failed, {stats.running} running), "
+                         f"{stats.total_time / stats.count if stats.count else 0:.2f}s avg"
+                         for tool, stats in self.stats.items())
+
+
+class ToolRunnerCreator(AbstractCreator):
+    targets = (
+        CreateTargetInfo("src.runner", "ToolRunner"),
+    )
+
+    @staticmethod
+    def available() -> bool:
+        return exists_module("src.runner")
+
+    @staticmethod
+    def create(create_type: Type[ToolRunner]) -> ToolRunner:
+        return create_type(it(Config).download.toolConcurrency, it(Config).download.toolTimeout)
@@ -16,12 +16,15 @@ def save(song: bytes, codec: str, metadata: SongMetadata, playlist: PlaylistInfo
     song_path = dir_path / Path(song_name + get_suffix(codec, it(Config).download.atmosConventToM4a))
     with open(song_path.absolute(), "wb") as f:
         f.write(song)
-    if it(Config).download.saveCover and not playlist:
+    if it(Config).download.saveCover and not playlist and metadata.cover:
         cover_path = dir_path / Path(f"cover.{it(Config).download.coverFormat}")
-        with open(cover_path.absolute(), "wb") as f:
-            f.write(metadata.cover)
+        # Every song of an album saves the same cover
+        if not cover_path.exists() or cover_path.stat().st_size != len(metadata.cover) \
+                or cover_path.read_bytes() != metadata.cover:
+            with open(cover_path.absolute(), "wb") as f:
+                f.write(metadata.cover)
     if it(Config).download.saveLyrics and metadata.lyrics:
         lrc_path = dir_path / Path(song_name + ".lrc")
         with open(lrc_path.absolute(), "w", encoding="utf-8") as f:
-            f.write(ttml_convent_to_lrc(metadata.lyrics))
+            f.write(metadata.lrc or ttml_convent_to_lrc(metadata.lyrics))
     return song_path.absolute()
@@ -0,0 +1,95 @@
+import os
+import shutil
+import threading
+from contextlib import asynccontextmanager
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import AsyncIterator, Optional, Type
+
+from creart import AbstractCreator, CreateTargetInfo, exists_module, it
+
+from src.config import Config
+from src.measurer import SpeedMeasurer
+from src.utils import run_sync
+
+SCRATCH_PREFIX = "amd-scratch-"
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ScratchSpace:
+    root: Optional[Path]
+    budget: int
+    used: int
+    _lock: threading.Lock
+
+    def __init__(self, root: str, budget: int):
+        self.root = Path(root) if root and Path(root).is_dir() else None
+        self.budget = budget
+        self.used = 0
+        self._lock = threading.Lock()
+        self._sweep()
+
+    def _sweep(self):
+        # Remove the workspaces left behind by crashed processes
+        if not self.root or os.name != "posix":
+            return
+        for path in self.root.glob(f"{SCRATCH_PREFIX}*"):
+            pid = path.name.removeprefix(SCRATCH_PREFIX).split("-")[0]
+            if pid.isdigit() and not _pid_alive(int(pid)):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _reserve(self, size: int) -> bool:
+        with self._lock:
+            if not self.root or self.used + size > self.budget:
+                it(SpeedMeasurer).record_scratch(self.used, fallback=True)
+                return False
+            self.used += size
+            it(SpeedMeasurer).record_scratch(self.used)
+            return True
+
+    def _release(self, size: int):
+        with self._lock:
+            self.used -= size
+            it(SpeedMeasurer).record_scratch(self.used)
+
+    @asynccontextmanager
+    async def workspace(self, size: int) -> AsyncIterator[TemporaryDirectory]:
+        """
+        A temporary directory for external tools, placed under the scratch root when the expected size fits
+        into the budget and under the default temporary directory otherwise. Removed on exit, even if the tool failed.
+        """
+        reserved = self._reserve(size)
+        tmp_dir = TemporaryDirectory(prefix=f"{SCRATCH_PREFIX}{os.getpid()}-",
+                                     dir=self.root if reserved else None, ignore_cleanup_errors=True)
+        try:
+            yield tmp_dir
+        finally:
+            try:
+                # Removing large intermediates must not block the event loop
+                await run_sync(tmp_dir.cleanup)
+            finally:
+                if reserved:
+                    self._release(size)
+
+
+class ScratchCreator(AbstractCreator):
+    targets = (
+        CreateTargetInfo("src.scratch", "ScratchSpace"),
+    )
+
+    @staticmethod
+    def available() -> bool:
+        return exists_module("src.scratch")
+
+    @staticmethod
+    def create(create_type: Type[ScratchSpace]) -> ScratchSpace:
+        return create_type(it(Config).download.scratchRoot, it(Config).download.scratchBudget * 1024 * 1024)
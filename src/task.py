@@ -1,6 +1,9 @@
+import asyncio
+from array import array
 from enum import StrEnum
-from typing import Optional
+from itertools import accumulate
 
+from src.exceptions import DecryptException
 from src.logger import RipLogger
 from src.metadata import SongMetadata
 from src.models import PlaylistInfo
@@ -20,26 +23,110 @@ class Task:
     adamId: str
     status: Status
     info: SongInfo
-    m3u8Info: M3U8Info
+    m3u8Info: M3U8Info = None
     metadata: SongMetadata
     logger: RipLogger
     parentDone: ParentDoneHandler
     playlist: PlaylistInfo = None
-    decryptedSamples: list[Optional[bytes]]
+    decryptedMedia: bytearray
+    decryptedOffsets: array
+    decryptedMask: bytearray
     decryptedCount: int
+    decryptedSealed: bool
+    decryptInFlight: int
+    decryptDrained: asyncio.Event
 
     def __init__(self, adam_id: str, parent_done: ParentDoneHandler = None, playlist: PlaylistInfo = None):
         self.adamId = adam_id
         self.status = Status.WAITING
         self.parentDone = parent_done
         self.playlist = playlist
+        self.decryptedMask = bytearray()
+        self.decryptedCount = 0
+        self.decryptedSealed = False
+        self.decryptInFlight = 0
+        self.decryptDrained = asyncio.Event()
+        self.decryptDrained.set()
 
     def update_status(self, status: Status):
         self.status = status
 
     def init_decrypted_samples(self):
-        self.decryptedSamples = [None for _ in self.info.samples]
+        # Decrypted samples keep their size, so each one can be written straight to its final offset
+        self.decryptedOffsets = array("Q", accumulate(self.info.samples.sizes, initial=0))
+        self.decryptedMedia = bytearray(self.decryptedOffsets[-1])
+        self.decryptedMask = bytearray(len(self.info.samples))
+        self.decryptedCount = 0
+        self.decryptedSealed = True
+
+    def begin_decrypted_samples(self):
+        # Samples are announced one by one while the song is still downloading
+        self.decryptedOffsets = array("Q", [0])
+        self.decryptedMedia = bytearray()
+        self.decryptedMask = bytearray()
         self.decryptedCount = 0
+        self.decryptedSealed = False
+
+    def reserve_decrypted_media(self, size: int):
+        # The samples are never larger than the song holding them, the size of the download bounds them
+        if not self.decryptedMedia:
+            self.decryptedMedia = bytearray(size)
+        elif size > len(self.decryptedMedia):
+            self.decryptedMedia.extend(bytearray(size - len(self.decryptedMedia)))
+
+    def add_decrypted_sample(self, size: int) -> int:
+        end = self.decryptedOffsets[-1] + size
+        self.decryptedOffsets.append(end)
+        if end > len(self.decryptedMedia):
+            self.decryptedMedia.extend(bytearray(end - len(self.decryptedMedia)))
+        self.decryptedMask.append(0)
+        return len(self.decryptedMask) - 1
+
+    def seal_decrypted_samples(self) -> bool:
+        """Mark the announced samples as complete, return False if they differ from the sample table of the song"""
+        if self.decryptedOffsets != array("Q", accumulate(self.info.samples.sizes, initial=0)):
+            return False
+        # Trim the reserve to the samples, in place
+        del self.decryptedMedia[self.decryptedOffsets[-1]:]
+        self.decryptedSealed = True
+        return True
+
+    def decrypt_sent(self):
+        self.decryptInFlight += 1
+        self.decryptDrained.clear()
+
+    def decrypt_received(self):
+        self.decryptInFlight -= 1
+        if not self.decryptInFlight:
+            self.decryptDrained.set()
+
+    def write_decrypted_sample(self, sample_index: int, sample: bytes) -> bool:
+        if self.decryptedMask[sample_index]:
+            return False
+        start, end = self.decryptedOffsets[sample_index], self.decryptedOffsets[sample_index + 1]
+        if len(sample) != end - start:
+            raise DecryptException(f"Size of decrypted sample {sample_index} is {len(sample)}, expected {end - start}")
+        self.decryptedMedia[start:end] = sample
+        self.decryptedMask[sample_index] = 1
+        self.decryptedCount += 1
+        return True
+
+    def decrypt_finished(self) -> bool:
+        return self.decryptedSealed and self.decryptedCount == len(self.decryptedMask)
+
+    def decrypt_progress(self) -> float:
+        return self.decryptedCount / len(self.decryptedMask) if self.decryptedMask else 0.0
+
+    def missing_ranges(self) -> list[tuple[int, int]]:
+        """Ranges [start, end) of sample indexes that have not been decrypted yet"""
+        ranges = []
+        start = self.decryptedMask.find(0)
+        while start != -1:
+            end = self.decryptedMask.find(1, start)
+            end = len(self.decryptedMask) if end == -1 else end
+            ranges.append((start, end))
+            start = self.decryptedMask.find(0, end)
+        return ranges
 
     def init_logger(self):
         self.logger = RipLogger(URLType.Song, self.adamId)
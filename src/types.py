@@ -1,35 +1,84 @@
-from typing import Optional, Any, Callable, Awaitable
+from array import array
+from typing import Optional, Any, Callable, Awaitable, Iterator
 
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 
 defaultId = "0"
 prefetchKey = "skd://itunes.apple.com/P000000000/s1/e1"
 
 
 class ParentDoneHandler:
+    """
+    Calls back once all children are done. An unsealed handler is counting children while they are still being
+    listed, it only calls back after seal()
+    """
     count: int
     callback: Callable[[], Awaitable[None]]
+    sealed: bool
 
-    def __init__(self, count: int, callback: Callable[[], Awaitable[None]]):
+    def __init__(self, count: int, callback: Callable[[], Awaitable[None]], sealed: bool = True):
         self.count = count
         self.callback = callback
+        self.sealed = sealed
+
+    def add(self):
+        self.count += 1
+
+    async def seal(self):
+        self.sealed = True
+        if self.count == 0:
+            await self.callback()
 
     async def try_done(self):
         self.count -= 1
-        if self.count == 0:
+        if self.count == 0 and self.sealed:
             await self.callback()
 
 
-class SampleInfo(BaseModel):
-    data: bytes
-    duration: int
-    descIndex: int
+class SampleTable:
+    """Samples stored in one buffer, described by offsets, sizes, durations and sample description indexes"""
+    buffer: bytes
+    offsets: array
+    sizes: array
+    durations: array
+    desc_indexes: array
+
+    def __init__(self, buffer: bytes = b""):
+        self.buffer = buffer
+        self.offsets = array("Q")
+        self.sizes = array("I")
+        self.durations = array("I")
+        self.desc_indexes = array("H")
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, offset: int, size: int, duration: int, desc_index: int):
+        self.offsets.append(offset)
+        self.sizes.append(size)
+        self.durations.append(duration)
+        self.desc_indexes.append(desc_index)
+
+    def data(self, index: int) -> memoryview:
+        offset = self.offsets[index]
+        return memoryview(self.buffer)[offset:offset + self.sizes[index]]
+
+    def views(self) -> Iterator[memoryview]:
+        buffer = memoryview(self.buffer)
+        for offset, size in zip(self.offsets, self.sizes):
+            yield buffer[offset:offset + size]
+
+    def total_size(self) -> int:
+        return sum(self.sizes)
 
 
 class SongInfo(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     codec: str
-    raw: bytes
-    samples: list[SampleInfo]
+    # The download buffer of the song, not copied
+    raw: bytes | bytearray
+    samples: SampleTable
     nhml: str
     decoderParams: Optional[bytes] = None
     params: dict[str, Any]
@@ -1,14 +1,20 @@
 import asyncio
 import concurrent.futures
 import json
+import multiprocessing
+import os
 import subprocess
 import time
 from asyncio import AbstractEventLoop
+from collections import OrderedDict
 from copy import deepcopy
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from itertools import islice
 from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
 from distutils.version import LooseVersion
+from functools import lru_cache
 
 import m3u8
 import regex
@@ -23,10 +29,29 @@ from src.models import PlaylistInfo
 from src.models.album_meta import Tracks
 from src.types import *
 
-executor_pool = concurrent.futures.ThreadPoolExecutor()
 background_tasks = set()
 
 
+class ExecutorType:
+    # CPU-bound work in pure Python, run in worker processes. Arguments and results must be picklable and small
+    CPU = "cpu"
+    # Blocking I/O, work that releases the GIL and work on whole songs, which would cost more to copy to a
+    # worker process and back than to parse in place
+    IO = "io"
+
+
+@dataclass
+class ExecutorStats:
+    submitted: int = 0
+    completed: int = 0
+    total_wait: float = 0.0
+
+
+executors: dict[str, concurrent.futures.Executor] = {}
+executor_workers: dict[str, int] = {}
+executor_stats: dict[str, ExecutorStats] = {}
+
+
 def check_url(url):
     pattern = regex.compile(
         r'^(?:https:\/\/(?:beta\.music|music)\.apple\.com\/(\w{2})(?:\/album|\/album\/.+))\/(?:id)?(\d[^\D]+)(?:$|\?)')
@@ -45,13 +70,24 @@ def byte_length(i):
     return (i.bit_length() + 7) // 8
 
 
-def find_best_codec(parsed_m3u8: m3u8.M3U8, codec: str) -> Optional[m3u8.Playlist]:
-    available_medias = [playlist for playlist in parsed_m3u8.playlists
-                        if regex.match(CodecRegex.get_pattern_by_codec(codec), playlist.stream_info.audio)]
-    if not available_medias:
-        return None
-    available_medias.sort(key=lambda x: x.stream_info.average_bandwidth, reverse=True)
-    return available_medias[0]
+def index_variants(parsed_m3u8: m3u8.M3U8) -> dict[str, list[m3u8.Playlist]]:
+    """Variants of a master playlist by codec, highest average bandwidth first"""
+    index = {}
+    for playlist in parsed_m3u8.playlists:
+        codec = get_codec_from_codec_id(playlist.stream_info.audio) if playlist.stream_info.audio else ""
+        if codec:
+            index.setdefault(codec, []).append(playlist)
+    for variants in index.values():
+        variants.sort(key=lambda x: x.stream_info.average_bandwidth, reverse=True)
+    if Codec.AAC in index:
+        index[Codec.AAC_LEGACY] = index[Codec.AAC]
+    return index
+
+
+def find_best_codec(parsed_m3u8: m3u8.M3U8, codec: str,
+                    variants: Optional[dict[str, list[m3u8.Playlist]]] = None) -> Optional[m3u8.Playlist]:
+    available_medias = (variants if variants is not None else index_variants(parsed_m3u8)).get(codec)
+    return available_medias[0] if available_medias else None
 
 
 def chunk(it, size):
@@ -126,10 +162,15 @@ def get_valid_dir_name(dirname: str):
     return regex.sub(r"\.+$", "", get_valid_filename(dirname))
 
 
+# Patterns of CodecRegex compiled once, in the order codec IDs are classified
+CODEC_PATTERNS = {codec: regex.compile(CodecRegex.get_pattern_by_codec(codec))
+                  for codec in [Codec.AC3, Codec.EC3, Codec.AAC, Codec.ALAC, Codec.AAC_BINAURAL, Codec.AAC_DOWNMIX]}
+
+
+@lru_cache(maxsize=1024)
 def get_codec_from_codec_id(codec_id: str) -> str:
-    codecs = [Codec.AC3, Codec.EC3, Codec.AAC, Codec.ALAC, Codec.AAC_BINAURAL, Codec.AAC_DOWNMIX]
-    for codec in codecs:
-        if regex.match(CodecRegex.get_pattern_by_codec(codec), codec_id):
+    for codec, pattern in CODEC_PATTERNS.items():
+        if pattern.match(codec_id):
             return codec
     return ""
 
@@ -206,10 +247,9 @@ def get_song_name_and_dir_path(codec: str, metadata, playlist: PlaylistInfo = No
     return song_name, dir_path
 
 
-def playlist_write_song_index(playlist: PlaylistInfo):
-    for track_index, track in enumerate(playlist.data[0].relationships.tracks.data):
-        playlist.songIdIndexMapping[track.id] = track_index + 1
-    return playlist
+def get_next_offset(next_url: str) -> int:
+    # "next" of a catalog listing looks like /v1/catalog/us/playlists/pl.xxx/tracks?offset=100
+    return int(parse_qs(urlsplit(next_url).query).get("offset", ["0"])[0])
 
 
 def convent_mac_timestamp_to_datetime(timestamp: int):
@@ -226,36 +266,110 @@ def check_dep():
     return True, None
 
 
-async def check_song_existence(adam_id: str, region: str):
+# Seconds an availability check of a storefront stays valid
+EXISTENCE_TTL = 3600
+# A missing item may as well be a throttled or failed request, so it is checked again sooner
+NEGATIVE_EXISTENCE_TTL = 60
+# Availability checks kept, the least recently used are dropped first
+EXISTENCE_CACHE_SIZE = 10000
+_existence_cache: OrderedDict[tuple[str, str, str], tuple[bool, float]] = OrderedDict()
+
+
+def _remember_existence(key: tuple[str, str, str], exists: bool):
+    _existence_cache[key] = (exists, time.monotonic() + (EXISTENCE_TTL if exists else NEGATIVE_EXISTENCE_TTL))
+    _existence_cache.move_to_end(key)
+    while len(_existence_cache) > EXISTENCE_CACHE_SIZE:
+        _existence_cache.popitem(last=False)
+
+
+async def _check_existence(kind: str, item_id: str, region: str, exist_on_storefront) -> bool:
     from src.grpc.manager import WrapperManager
-    from src.api import WebAPI
-    check = False
-    for m_region in (await it(WrapperManager).status()).regions:
+    key = (kind, item_id, region.upper())
+    cached = _existence_cache.get(key)
+    if cached and time.monotonic() < cached[1]:
+        _existence_cache.move_to_end(key)
+        return cached[0]
+
+    async def probe(m_region: str):
         try:
-            check = await it(WebAPI).exist_on_storefront_by_song_id(adam_id, region, m_region)
-            if check:
-                break
+            return await exist_on_storefront(item_id, region, m_region)
         except ValidationError:
-            pass
-    return check
+            return False
 
-
-async def check_album_existence(album_id: str, region: str):
-    from src.grpc.manager import WrapperManager
-    from src.api import WebAPI
+    # Every region is probed at once, the first one that has the item settles the check
+    probes = [asyncio.create_task(probe(m_region)) for m_region in (await it(WrapperManager).status()).regions]
     check = False
-    for m_region in (await it(WrapperManager).status()).regions:
-        try:
-            check = await it(WebAPI).exist_on_storefront_by_album_id(album_id, region, m_region)
-            if check:
+    try:
+        for probe_done in asyncio.as_completed(probes):
+            if await probe_done:
+                check = True
                 break
-        except ValidationError:
-            pass
+    finally:
+        for probe_task in probes:
+            probe_task.cancel()
+        await asyncio.gather(*probes, return_exceptions=True)
+    _remember_existence(key, check)
     return check
 
 
-async def run_sync(task: Callable, *args):
-    return await it(AbstractEventLoop).run_in_executor(executor_pool, task, *args)
+async def check_song_existence(adam_id: str, region: str):
+    from src.api import WebAPI
+    return await _check_existence("song", adam_id, region, it(WebAPI).exist_on_storefront_by_song_id)
+
+
+async def check_album_existence(album_id: str, region: str):
+    from src.api import WebAPI
+    return await _check_existence("album", album_id, region, it(WebAPI).exist_on_storefront_by_album_id)
+
+
+def vouch_song_existence(adam_ids: list[str], region: str):
+    """Songs of an album that passed check_album_existence are available as well"""
+    for adam_id in adam_ids:
+        _remember_existence(("song", adam_id, region.upper()), True)
+
+
+def get_executor(executor_type: str) -> concurrent.futures.Executor:
+    if executor_type not in executors:
+        match executor_type:
+            case ExecutorType.CPU:
+                # Same default as ProcessPoolExecutor
+                executor_workers[executor_type] = it(Config).download.cpuWorkers or os.cpu_count() or 1
+                # Spawn instead of fork, forking a process with a running grpc channel is not safe
+                executors[executor_type] = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=executor_workers[executor_type], mp_context=multiprocessing.get_context("spawn"))
+            case _:
+                # Same default as ThreadPoolExecutor
+                executor_workers[executor_type] = it(Config).download.ioWorkers or min(32, (os.cpu_count() or 1) + 4)
+                executors[executor_type] = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=executor_workers[executor_type], thread_name_prefix=executor_type)
+    return executors[executor_type]
+
+
+def _timed_call(task: Callable, submitted: float, *args):
+    return time.time() - submitted, task(*args)
+
+
+async def run_sync(task: Callable, *args, executor: str = ExecutorType.IO):
+    stats = executor_stats.setdefault(executor, ExecutorStats())
+    stats.submitted += 1
+    try:
+        wait, result = await it(AbstractEventLoop).run_in_executor(get_executor(executor), _timed_call, task,
+                                                                   time.time(), *args)
+    finally:
+        stats.completed += 1
+    stats.total_wait += wait
+    return result
+
+
+def get_executor_status() -> str:
+    status = []
+    for executor_type, stats in executor_stats.items():
+        in_flight = stats.submitted - stats.completed
+        running = min(in_flight, executor_workers.get(executor_type, 0))
+        average_wait = stats.total_wait / stats.completed if stats.completed else 0
+        status.append(f"{executor_type}: {running} running, {in_flight - running} queued, "
+                      f"{average_wait:.3f}s average wait")
+    return ", ".join(status)
 
 
 def safely_create_task(coro):
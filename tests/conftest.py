@@ -0,0 +1,38 @@
+import asyncio
+from pathlib import Path
+from typing import Type
+
+import pytest
+from creart import add_creator
+
+from src.cdn import EdgePoolCreator
+from src.config import Config, ConfigCreator
+from src.download_cache import DownloadCacheCreator
+from src.logger import LoggerCreator
+from src.measurer import MeasurerCreator
+from src.runner import ToolRunnerCreator
+from src.scratch import ScratchCreator
+
+
+class ExampleConfigCreator(ConfigCreator):
+    @staticmethod
+    def create(create_type: Type[Config]) -> Config:
+        return create_type.load_from_config(str(Path(__file__).parent.parent / "config.example.toml"))
+
+
+add_creator(LoggerCreator)
+add_creator(ExampleConfigCreator)
+add_creator(MeasurerCreator)
+add_creator(ScratchCreator)
+add_creator(ToolRunnerCreator)
+add_creator(EdgePoolCreator)
+add_creator(DownloadCacheCreator)
+
+# run_sync keeps the loop it first ran on, like main.py every test runs on the same one
+_loop = asyncio.new_event_loop()
+asyncio.set_event_loop(_loop)
+
+
+@pytest.fixture
+def run():
+    return _loop.run_until_complete
@@ -0,0 +1,48 @@
+"""Small synthetic MP4 files for the tests, shaped like the encrypted songs served by Apple Music"""
+import struct
+
+from src.fmp4 import make_box, make_full_box
+
+TIMESCALE = 44100
+SAMPLE_DURATION = 4096
+
+
+def make_alac_entry() -> bytes:
+    alac = make_full_box(b"alac", 0, 0, struct.pack(">IBBBBBBHIII", SAMPLE_DURATION, 0, 16, 40, 10, 14, 2, 255,
+                                                    0, 0, TIMESCALE))
+    sinf = make_box(b"sinf", make_box(b"frma", b"alac"))
+    return make_box(b"enca", b"\x00" * 6, struct.pack(">H", 1), b"\x00" * 8,
+                    struct.pack(">HHHHI", 2, 16, 0, 0, TIMESCALE << 16), alac, sinf)
+
+
+def make_init_segment(entries: int = 2) -> bytes:
+    stsd = make_full_box(b"stsd", 0, 0, struct.pack(">I", entries), *[make_alac_entry() for _ in range(entries)])
+    mdhd = make_full_box(b"mdhd", 0, 0, struct.pack(">IIIIxxxx", 100, 200, TIMESCALE, 0))
+    mvhd = make_full_box(b"mvhd", 0, 0, struct.pack(">IIII", 3600, 7200, 1000, 0), b"\x00" * 80)
+    trex = make_full_box(b"trex", 0, 0, struct.pack(">IIIII", 1, 1, SAMPLE_DURATION, 0, 0))
+    trak = make_box(b"trak", make_box(b"mdia", mdhd, make_box(b"minf", make_box(b"stbl", stsd))))
+    moov = make_box(b"moov", mvhd, trak, make_box(b"mvex", trex))
+    return make_box(b"ftyp", b"iso5", struct.pack(">I", 1)) + moov
+
+
+def make_fragment(sequence: int, samples: list[bytes], desc_index: int) -> bytes:
+    def make_moof(data_offset: int) -> bytes:
+        # Base is the moof, sample description index and sample sizes are given
+        tfhd = make_full_box(b"tfhd", 0, 0x020002, struct.pack(">II", 1, desc_index))
+        trun = make_full_box(b"trun", 0, 0x000201, struct.pack(">Ii", len(samples), data_offset),
+                             *[struct.pack(">I", len(sample)) for sample in samples])
+        return make_box(b"moof", make_full_box(b"mfhd", 0, 0, struct.pack(">I", sequence)),
+                        make_box(b"traf", tfhd, trun))
+
+    moof = make_moof(len(make_moof(0)) + 8)
+    return moof + make_box(b"mdat", *samples)
+
+
+def make_fmp4(fragments: list[list[bytes]], desc_indexes: tuple[int, ...] = (1, 2)) -> bytes:
+    """A fragmented MP4 with one fragment per list of samples, cycling through the sample descriptions"""
+    return make_init_segment(len(set(desc_indexes))) + b"".join(
+        make_fragment(index + 1, samples, desc_indexes[index % len(desc_indexes)])
+        for index, samples in enumerate(fragments))
+
+
+FRAGMENTS = [[b"a" * 10, b"b" * 20, b"c" * 30], [b"d" * 40], [b"e" * 50, b"f" * 60]]
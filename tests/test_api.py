@@ -0,0 +1,289 @@
+import asyncio
+import base64
+import json
+import os
+import time
+
+import httpx
+import pytest
+from creart import it
+from tenacity import RetryError, wait_none, stop_after_attempt
+
+from src.api import WebAPI, MIN_RANGE_SIZE, PLAYLIST_TTL, _token_expiry
+from src.config import Config
+from src.download_cache import DownloadCache, ByteRange
+
+URL = "https://aod.itunes.apple.com/itunes-assets/song.mp4"
+DATA = os.urandom(3 * 1024 * 1024)
+
+
+class CDN:
+    """Serves DATA with byte ranges, optionally as a file that changed since a partial download was made"""
+
+    def __init__(self):
+        self.etag = "first"
+        self.content = DATA
+        self.requests = []
+        self.reject_ranges = False
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        byte_range = request.headers.get("Range")
+        self.requests.append(byte_range)
+        if not byte_range:
+            return httpx.Response(200, content=self.content, headers={"ETag": self.etag})
+        start, end = byte_range.removeprefix("bytes=").split("-")
+        start, end = int(start), int(end) if end else len(self.content) - 1
+        if start >= len(self.content):
+            return httpx.Response(416, headers={"Content-Range": f"bytes */{len(self.content)}"})
+        if self.reject_ranges or request.headers.get("If-Range", self.etag) != self.etag:
+            return httpx.Response(200, content=self.content, headers={"ETag": self.etag})
+        return httpx.Response(206, content=self.content[start:end + 1], headers={
+            "ETag": self.etag, "Content-Range": f"bytes {start}-{end}/{len(self.content)}"})
+
+
+@pytest.fixture
+def cdn(monkeypatch):
+    monkeypatch.setattr(WebAPI._download_song.retry, "wait", wait_none())
+    monkeypatch.setattr(WebAPI._download_song.retry, "stop", stop_after_attempt(3))
+    monkeypatch.setattr(WebAPI._download_range.retry, "wait", wait_none())
+    return CDN()
+
+
+def make_api(monkeypatch, cdn: CDN, connections: int) -> WebAPI:
+    monkeypatch.setattr(WebAPI, "_set_token", lambda self: setattr(self, "token", ""))
+    api = WebAPI("", 1, connections)
+    api.cdn_client = httpx.AsyncClient(transport=httpx.MockTransport(cdn.handle))
+    api._cdn_users = {api.cdn_client: 0}
+    return api
+
+
+async def make_partial(total: int, received: int, etag: str):
+    download = await it(DownloadCache).create(URL, total, etag, [ByteRange(0, total)])
+    download.buffer[:received] = DATA[:received]
+    download.ranges[0].received = received
+    return download
+
+
+@pytest.mark.parametrize("connections", [1, 4])
+def test_download(run, monkeypatch, cdn, connections):
+    api = make_api(monkeypatch, cdn, connections)
+    song = run(api.download_song(URL))
+    assert song == DATA
+    # The download buffer is handed over without a copy
+    assert isinstance(song, bytearray)
+    assert len(cdn.requests) == (1 if connections == 1 else 4)
+    run(it(DownloadCache).release(URL))
+
+
+def test_download_ranges(run, monkeypatch, cdn):
+    api = make_api(monkeypatch, cdn, 8)
+    assert run(api.download_song(URL)) == DATA
+    # The song is split into ranges of at least MIN_RANGE_SIZE that cover it without gaps
+    ranges = sorted(tuple(int(i) for i in byte_range.removeprefix("bytes=").split("-"))
+                    for byte_range in cdn.requests[1:])
+    assert len(ranges) == len(DATA) // MIN_RANGE_SIZE
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(DATA) - 1
+    assert all(end + 1 == start for (_, end), (start, _) in zip(ranges, ranges[1:]))
+    run(it(DownloadCache).release(URL))
+
+
+def test_download_ranges_ignored(run, monkeypatch, cdn):
+    api = make_api(monkeypatch, cdn, 4)
+    cdn.reject_ranges = True
+    assert run(api.download_song(URL)) == DATA
+    # The CDN answered the probe with the whole file, the song is downloaded as one stream
+    assert cdn.requests == ["bytes=0-0", None]
+    run(it(DownloadCache).release(URL))
+
+
+@pytest.mark.parametrize("connections", [1, 4])
+def test_resume(run, monkeypatch, cdn, connections):
+    api = make_api(monkeypatch, cdn, connections)
+    run(make_partial(len(DATA), 1000, cdn.etag))
+    assert run(api.download_song(URL)) == DATA
+    assert cdn.requests == (["bytes=1000-"] if connections == 1 else [f"bytes=1000-{len(DATA) - 1}"])
+    run(it(DownloadCache).release(URL))
+
+
+@pytest.mark.parametrize("connections", [1, 4])
+def test_resume_of_changed_file(run, monkeypatch, cdn, connections):
+    api = make_api(monkeypatch, cdn, connections)
+    run(make_partial(len(DATA), 1000, "stale"))
+    assert run(api.download_song(URL)) == DATA
+    run(it(DownloadCache).release(URL))
+
+
+def test_resume_rejected(run, monkeypatch, cdn):
+    api = make_api(monkeypatch, cdn, 1)
+    # The file shrank, the range after the partial download is not satisfiable
+    cdn.content = DATA[:1000]
+    run(make_partial(len(DATA), 2000, cdn.etag))
+    assert run(api.download_song(URL)) == DATA[:1000]
+    assert cdn.requests == ["bytes=2000-", None]
+    run(it(DownloadCache).release(URL))
+
+
+def test_resume_rejected_by_ranges(run, monkeypatch, cdn):
+    api = make_api(monkeypatch, cdn, 4)
+    download = run(make_partial(len(DATA), 0, cdn.etag))
+    download.ranges = [ByteRange(0, 1000), ByteRange(1000, len(DATA))]
+    cdn.reject_ranges = True
+    assert run(api.download_song(URL)) == DATA
+    # The stale partial download is dropped instead of being requested again on every retry,
+    # the CDN ignoring ranges the song is downloaded as one stream
+    assert cdn.requests.count("bytes=0-999") == 1
+    assert cdn.requests[-2:] == ["bytes=0-0", None]
+    run(it(DownloadCache).release(URL))
+
+
+def test_failed_download_is_discarded(run, monkeypatch, cdn):
+    handle = cdn.handle
+    # Every range after the first one fails
+    cdn.handle = lambda request: handle(request) if request.headers["Range"].startswith("bytes=0-") \
+        else httpx.Response(503)
+    api = make_api(monkeypatch, cdn, 4)
+    with pytest.raises(RetryError):
+        run(api.download_song(URL))
+    assert not it(DownloadCache).downloads
+    assert not it(DownloadCache).active
+
+
+def test_single_flight(run, monkeypatch, cdn):
+    api = make_api(monkeypatch, cdn, 1)
+    calls = []
+
+    async def lookup():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "album"
+
+    async def main():
+        first = asyncio.create_task(api._single_flight(("album", "1"), lookup))
+        second = asyncio.create_task(api._single_flight(("album", "1"), lookup))
+        await asyncio.sleep(0.01)
+        # Cancelling one caller leaves the lookup to the others
+        first.cancel()
+        result = await second
+        return first.cancelled(), result, dict(api._inflight)
+
+    assert run(main()) == (True, "album", {})
+    assert len(calls) == 1
+    assert run(api._single_flight(("album", "1"), lookup)) == "album"
+    assert len(calls) == 2
+
+
+def test_single_flight_failure(run, monkeypatch, cdn):
+    api = make_api(monkeypatch, cdn, 1)
+
+    async def lookup():
+        await asyncio.sleep(0.01)
+        raise httpx.HTTPError("failed")
+
+    async def main():
+        return await asyncio.gather(*[api._single_flight(("album", "1"), lookup) for _ in range(3)],
+                                    return_exceptions=True)
+
+    assert [type(result) for result in run(main())] == [httpx.HTTPError] * 3
+    assert not api._inflight
+
+
+def test_cdn_client_rebuilt_on_settings_change(run, monkeypatch, cdn):
+    api = make_api(monkeypatch, cdn, 1)
+
+    async def main():
+        async with api._cdn() as first:
+            async with api._cdn() as same:
+                assert same is first
+            monkeypatch.setattr(it(Config).download, "cdnPoolSize", it(Config).download.cdnPoolSize + 1)
+            async with api._cdn() as rebuilt:
+                assert rebuilt is not first
+            # The old client is closed only once the downloads still using it are done
+            closed_in_use = first.is_closed
+        return closed_in_use, first.is_closed, rebuilt.is_closed
+
+    assert run(main()) == (False, True, False)
+    assert api.cdn_stats.rebuilds == 1
+    assert list(api._cdn_users) == [api.cdn_client]
+    run(api.cdn_client.aclose())
+
+
+def make_token(expiry: float) -> str:
+    def encode(claims: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(claims).encode()).decode().rstrip("=")
+
+    return f"{encode({'alg': 'ES256'})}.{encode({'exp': int(expiry)})}.signature"
+
+
+@pytest.fixture
+def token_cache(tmp_path, monkeypatch):
+    """Token file of an earlier run, and the tokens scraped in this one"""
+    path = tmp_path / "token.json"
+    monkeypatch.setattr(it(Config).download, "tokenCache", str(path))
+    fetched = []
+
+    def fetch_token(self):
+        fetched.append(make_token(time.time() + 7 * 24 * 3600 + len(fetched)))
+        return fetched[-1]
+
+    monkeypatch.setattr(WebAPI, "_fetch_token", fetch_token)
+    return path, fetched
+
+
+def test_token_reused(token_cache):
+    path, fetched = token_cache
+    token = make_token(time.time() + 3600)
+    path.write_text(json.dumps({"token": token}))
+    api = WebAPI("", 1)
+    assert (api.token, fetched) == (token, [])
+    assert api.token_expiry == _token_expiry(token)
+    assert api.client.headers["Authorization"] == f"Bearer {token}"
+
+
+@pytest.mark.parametrize("cached", [None, "broken", make_token(time.time() - 1)])
+def test_token_scraped(token_cache, cached):
+    path, fetched = token_cache
+    if cached:
+        path.write_text(json.dumps({"token": cached}))
+    api = WebAPI("", 1)
+    assert fetched == [api.token]
+    assert json.loads(path.read_text())["token"] == api.token
+
+
+def test_token_refresh(run, token_cache):
+    path, fetched = token_cache
+    api = WebAPI("", 1)
+
+    async def main():
+        await asyncio.gather(*[api.refresh_token() for _ in range(3)])
+
+    run(main())
+    # Concurrent refreshes scrape once
+    assert len(fetched) == 2
+    assert api.client.headers["Authorization"] == f"Bearer {fetched[-1]}"
+    assert json.loads(path.read_text())["token"] == fetched[-1]
+
+
+def test_playlist_cache(run, monkeypatch, cdn):
+    api = make_api(monkeypatch, cdn, 1)
+    downloads = []
+
+    async def download_m3u8(m3u8_url: str) -> str:
+        downloads.append(m3u8_url)
+        await asyncio.sleep(0.01)
+        return "#EXTM3U\n#EXT-X-TARGETDURATION:10\n#EXTINF:10,\nsegment.mp4\n#EXT-X-ENDLIST\n"
+
+    monkeypatch.setattr(api, "download_m3u8", download_m3u8)
+
+    async def main():
+        return await asyncio.gather(*[api.get_m3u8(URL) for _ in range(3)])
+
+    playlists = run(main())
+    # Concurrent loads share one download and one parsed playlist
+    assert all(playlist is playlists[0] for playlist in playlists)
+    assert run(api.get_m3u8(URL)) is playlists[0]
+    assert len(downloads) == 1
+    expiry, playlist = api._playlists[URL]
+    assert expiry - time.monotonic() <= PLAYLIST_TTL
+    api._playlists[URL] = (time.monotonic() - 1, playlist)
+    assert run(api.get_m3u8(URL)) is not playlists[0]
+    assert len(downloads) == 2
@@ -0,0 +1,89 @@
+import asyncio
+
+import httpx
+import pytest
+
+from src.artwork_cache import ArtworkCache
+
+COVER = "https://is1-ssl.mzstatic.com/image/thumb/Music/cover.jpg/5000x5000bb.jpg"
+
+
+def fetcher(data: bytes, calls: list):
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return data
+
+    return fetch
+
+
+def test_artwork_cache_shared_download(run):
+    cache = ArtworkCache("", 1024, 0)
+    calls = []
+
+    async def main():
+        return await asyncio.gather(*[cache.get(COVER, fetcher(b"cover", calls)) for _ in range(4)])
+
+    assert run(main()) == [b"cover"] * 4
+    # Another mzstatic host serves the same image
+    assert run(cache.get(COVER.replace("is1", "is2"), fetcher(b"cover", calls))) == b"cover"
+    assert len(calls) == 1
+    assert (cache.hits, cache.misses) == (4, 1)
+
+
+def test_artwork_cache_memory_budget(run):
+    cache = ArtworkCache("", 10, 0)
+    calls = []
+    for name in ("a", "b", "c"):
+        run(cache.get(COVER.replace("cover", name), fetcher(b"cover", calls)))
+    # Only the two most recently used covers fit, an oversized one is not kept at all
+    assert list(cache.memory.values()) == [b"cover"] * 2 and cache.memory_size == 10
+    run(cache.get(COVER.replace("cover", "big"), fetcher(b"x" * 11, calls)))
+    assert cache.memory_size == 10
+    run(cache.get(COVER.replace("cover", "a"), fetcher(b"cover", calls)))
+    assert len(calls) == 5
+
+
+def test_artwork_cache_on_disk(run, tmp_path):
+    calls = []
+    run(ArtworkCache(str(tmp_path), 1024, 1024).get(COVER, fetcher(b"cover", calls)))
+    cache = ArtworkCache(str(tmp_path), 1024, 1024)
+    assert run(cache.get(COVER, fetcher(b"cover", calls))) == b"cover"
+    assert len(calls) == 1
+
+
+def test_artwork_cache_error_not_cached(run):
+    cache = ArtworkCache("", 1024, 0)
+    calls = []
+
+    async def fail():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise httpx.HTTPStatusError("Not Found", request=httpx.Request("GET", COVER),
+                                    response=httpx.Response(404))
+
+    async def main():
+        return await asyncio.gather(*[cache.get(COVER, fail) for _ in range(2)], return_exceptions=True)
+
+    assert [type(result) for result in run(main())] == [httpx.HTTPStatusError] * 2
+    assert not cache.memory and not cache._inflight
+    assert run(cache.get(COVER, fetcher(b"cover", calls))) == b"cover"
+    assert len(calls) == 2
+
+
+def test_artwork_cache_cancelled_requester(run):
+    cache = ArtworkCache("", 1024, 0)
+
+    async def main():
+        first = asyncio.create_task(cache.get(COVER, fetcher(b"cover", [])))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(cache.get(COVER, fetcher(b"cover", [])))
+        await asyncio.sleep(0)
+        # The song that started the download is cancelled, the other one still gets the cover
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert run(main()) == b"cover"
+    assert not cache._inflight
@@ -0,0 +1,37 @@
+import asyncio
+import json
+
+import pytest
+from tenacity import RetryError
+
+from src.catalog_batch import BatchLoader
+
+
+def test_batch_loader_coalesces_requests(run):
+    requested = []
+
+    async def resolve(ids):
+        requested.append(ids)
+        return {item_id: item_id.upper() for item_id in ids if item_id != "missing"}
+
+    async def main():
+        loader = BatchLoader(resolve, 2)
+        loader.prime("primed", "PRIMED")
+        return await asyncio.gather(*[loader.load(item_id) for item_id in ("a", "b", "a", "c", "missing", "primed")])
+
+    assert run(main()) == ["A", "B", "A", "C", None, "PRIMED"]
+    assert sorted(requested) == [["a", "b"], ["c", "missing"]]
+
+
+@pytest.mark.parametrize("error", [RetryError(None), json.JSONDecodeError("Expecting value", "", 0), KeyError("data")])
+def test_batch_loader_failure(run, error):
+    async def resolve(ids):
+        raise error
+
+    async def main():
+        loader = BatchLoader(resolve, 100)
+        # Callers get None and fall back to loading the items one by one
+        return await asyncio.wait_for(asyncio.gather(loader.load("a"), loader.load("b")), 1)
+
+    assert run(main()) == [None, None]
+
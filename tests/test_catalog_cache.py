@@ -0,0 +1,71 @@
+import time
+
+import httpx
+
+from src.catalog_cache import CatalogCache, bypass_catalog_cache
+
+ALBUM = httpx.URL("https://amp-api.music.apple.com/v1/catalog/us/albums/1", params={"l": "en-US"})
+SONG = httpx.URL("https://amp-api.music.apple.com/v1/catalog/us/songs/1")
+
+
+def make_cache(tmp_path, max_size: int = 1024 * 1024) -> CatalogCache:
+    return CatalogCache(str(tmp_path / "catalog.db"), max_size, {"albums": 60, "default": 0})
+
+
+def test_catalog_cache_hit(run, tmp_path):
+    cache = make_cache(tmp_path)
+    run(cache.put(ALBUM, httpx.Response(200, content=b"album")))
+    response = run(cache.get(httpx.URL("https://amp-api.music.apple.com/v1/catalog/us/albums/1?l=en-US")))
+    assert response.content == b"album"
+    # Another language is another response
+    assert run(cache.get(ALBUM.copy_with(params={"l": "ja"}))) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_catalog_cache_persistent(run, tmp_path):
+    run(make_cache(tmp_path).put(ALBUM, httpx.Response(200, content=b"album")))
+    cache = make_cache(tmp_path)
+    assert cache.size == len(b"album")
+    assert run(cache.get(ALBUM)).content == b"album"
+
+
+def test_catalog_cache_ttl(run, tmp_path, monkeypatch):
+    cache = make_cache(tmp_path)
+    run(cache.put(ALBUM, httpx.Response(200, content=b"album")))
+    run(cache.put(SONG, httpx.Response(200, content=b"song")))
+    # Songs fall back to the default TTL
+    assert run(cache.get(SONG)) is None
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert run(cache.get(ALBUM)) is None
+
+
+def test_catalog_cache_lru(run, tmp_path, monkeypatch):
+    cache = make_cache(tmp_path, max_size=10)
+    now = time.time()
+    for i, url in enumerate((ALBUM, ALBUM.copy_with(path="/v1/catalog/us/albums/2"))):
+        monkeypatch.setattr(time, "time", lambda stored=now + i: stored)
+        run(cache.put(url, httpx.Response(200, content=b"album")))
+    monkeypatch.setattr(time, "time", lambda: now + 2)
+    # Reading the first album makes the second one the least recently used
+    assert run(cache.get(ALBUM))
+    monkeypatch.setattr(time, "time", lambda: now + 3)
+    run(cache.put(ALBUM.copy_with(path="/v1/catalog/us/albums/3"), httpx.Response(200, content=b"album")))
+    assert run(cache.get(ALBUM))
+    assert run(cache.get(ALBUM.copy_with(path="/v1/catalog/us/albums/2"))) is None
+    assert cache.size == 10
+
+
+def test_catalog_cache_skips(run, tmp_path):
+    cache = make_cache(tmp_path)
+    run(cache.put(ALBUM, httpx.Response(404, content=b"missing")))
+    assert run(cache.get(ALBUM)) is None
+    run(cache.put(ALBUM, httpx.Response(200, content=b"album")))
+    token = bypass_catalog_cache.set(True)
+    try:
+        assert run(cache.get(ALBUM)) is None
+    finally:
+        bypass_catalog_cache.reset(token)
+    assert CatalogCache.cacheable("GET", ALBUM)
+    assert not CatalogCache.cacheable("HEAD", ALBUM)
+    assert not CatalogCache.cacheable("GET", httpx.URL("https://amp-api.music.apple.com/v1/me/library"))
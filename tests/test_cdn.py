@@ -0,0 +1,66 @@
+import pytest
+from creart import it
+
+from src.cdn import EdgePool, parse_edges, EJECT_AFTER_FAILURES, EJECT_BASE_SECONDS
+from src.config import Config
+
+EDGES = ["17.253.85.201", "17.253.85.202"]
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(it(Config).download, "appleCDNIP", EDGES)
+    return EdgePool()
+
+
+def test_parse_edges():
+    assert parse_edges("17.253.85.201-203, 17.253.85.201") == ["17.253.85.201", "17.253.85.202", "17.253.85.203"]
+    assert parse_edges("17.253.85.200/30") == ["17.253.85.201", "17.253.85.202"]
+    assert parse_edges(["17.253.85.201-17.253.85.202"]) == EDGES
+    assert parse_edges("") == []
+
+
+def test_edge_ejected_after_failures(pool):
+    for _ in range(EJECT_AFTER_FAILURES):
+        pool.record_failure(EDGES[0])
+    assert pool.edges[EDGES[0]].ejected
+    assert all(pool.pick() == EDGES[1] for _ in range(20))
+
+
+def test_edge_dropping_bodies_is_ejected(pool):
+    # Headers arrive in time, the body breaks off every time
+    for _ in range(EJECT_AFTER_FAILURES):
+        pool.record_ttfb(EDGES[0], 0.05)
+        pool.record_failure(EDGES[0])
+    assert pool.edges[EDGES[0]].ejected
+    assert pool.edges[EDGES[0]].ttfb == pytest.approx(0.05)
+
+
+def test_completed_transfer_forgives_failures(pool):
+    for _ in range(EJECT_AFTER_FAILURES - 1):
+        pool.record_failure(EDGES[0])
+    pool.record_success(EDGES[0], size=1024 * 1024, elapsed=0.5)
+    pool.record_failure(EDGES[0])
+    assert not pool.edges[EDGES[0]].ejected
+    assert pool.edges[EDGES[0]].throughput == 2 * 1024 * 1024
+
+
+def test_repeated_ejections_back_off(pool):
+    edge = pool.edges[EDGES[0]]
+    durations = []
+    for _ in range(3):
+        for _ in range(EJECT_AFTER_FAILURES):
+            pool.record_failure(EDGES[0])
+        durations.append(edge.ejected_until)
+        # The ejection expires without the edge having recovered
+        edge.ejected_until = 0.0
+    assert edge.ejections == 3
+    assert durations[1] - durations[0] == pytest.approx(EJECT_BASE_SECONDS, abs=1)
+
+
+def test_all_edges_ejected(pool):
+    for ip in EDGES:
+        for _ in range(EJECT_AFTER_FAILURES):
+            pool.record_failure(ip)
+    # The edge whose ejection ends first is still used
+    assert pool.pick() == EDGES[0]
@@ -0,0 +1,107 @@
+import os
+
+from src.download_cache import DownloadCache, PartialDownload, ByteRange, FLUSH_SIZE, _cache_key
+
+URL = "https://aod.itunes.apple.com/itunes-assets/song.mp4?token=a"
+TOTAL = 3 * FLUSH_SIZE
+DATA = os.urandom(TOTAL)
+
+
+def receive(download: PartialDownload, byte_range: ByteRange, size: int):
+    start = byte_range.start + byte_range.received
+    download.buffer[start:start + size] = DATA[start:start + size]
+    byte_range.received += size
+
+
+def test_cache_key_ignores_query():
+    assert _cache_key(URL) == _cache_key(URL.replace("token=a", "token=b"))
+    assert _cache_key(URL) != _cache_key(URL.replace("song", "other"))
+
+
+def test_prefix():
+    ranges = [ByteRange(0, 100), ByteRange(100, 200), ByteRange(200, 300)]
+    download = PartialDownload("key", 300, None, ranges, bytearray(300))
+    assert download.prefix() == 0
+    ranges[1].received = 100
+    assert download.prefix() == 0
+    ranges[0].received = 100
+    ranges[2].received = 50
+    assert download.prefix() == 250
+    ranges[0].flushed = 100
+    download.restart_from_prefix()
+    assert [(r.start, r.end, r.received, r.flushed) for r in download.ranges] == [(0, 300, 250, 100)]
+
+
+def test_resume_in_process(run):
+    cache = DownloadCache("", TOTAL)
+    download = run(cache.create(URL, TOTAL, "etag", [ByteRange(0, TOTAL)]))
+    receive(download, download.ranges[0], 1000)
+    # Without a cache directory the partial download is only kept in memory
+    assert run(cache.open(URL)) is download
+    assert run(cache.open(URL.replace("token=a", "token=b"))) is download
+
+
+def test_resume_from_disk(run, tmp_path):
+    cache = DownloadCache(str(tmp_path), TOTAL * 4)
+    download = run(cache.create(URL, TOTAL, "etag", [ByteRange(0, TOTAL // 2), ByteRange(TOTAL // 2, TOTAL)]))
+    receive(download, download.ranges[0], FLUSH_SIZE + 10)
+    receive(download, download.ranges[1], 10)
+    # Only the ranges with at least FLUSH_SIZE new bytes are written unless forced
+    run(cache.flush(download))
+    assert [byte_range.flushed for byte_range in download.ranges] == [FLUSH_SIZE + 10, 0]
+    run(cache.flush(download, force=True))
+    assert [byte_range.flushed for byte_range in download.ranges] == [FLUSH_SIZE + 10, 10]
+
+    # A new process finds the flushed bytes
+    resumed = run(DownloadCache(str(tmp_path), TOTAL * 4).open(URL))
+    assert (resumed.total, resumed.etag, resumed.complete) == (TOTAL, "etag", False)
+    assert [(r.start, r.end, r.received) for r in resumed.ranges] == \
+        [(0, TOTAL // 2, FLUSH_SIZE + 10), (TOTAL // 2, TOTAL, 10)]
+    assert resumed.buffer[:FLUSH_SIZE + 10] == DATA[:FLUSH_SIZE + 10]
+    assert resumed.buffer[TOTAL // 2:TOTAL // 2 + 10] == DATA[TOTAL // 2:TOTAL // 2 + 10]
+
+
+def test_finished_download_is_reused(run, tmp_path):
+    cache = DownloadCache(str(tmp_path), TOTAL * 4)
+    download = run(cache.create(URL, TOTAL, None, [ByteRange(0, TOTAL)]))
+    receive(download, download.ranges[0], TOTAL)
+    run(cache.finish(download))
+    assert not cache.downloads
+    finished = run(DownloadCache(str(tmp_path), TOTAL * 4).open(URL))
+    assert finished.complete
+    assert finished.buffer == DATA
+
+
+def test_truncated_partial_is_ignored(run, tmp_path):
+    cache = DownloadCache(str(tmp_path), TOTAL * 4)
+    download = run(cache.create(URL, TOTAL, None, [ByteRange(0, TOTAL)]))
+    with open(download.path, "r+b") as f:
+        f.truncate(TOTAL - 1)
+    assert run(DownloadCache(str(tmp_path), TOTAL * 4).open(URL)) is None
+
+
+def test_discard(run, tmp_path):
+    cache = DownloadCache(str(tmp_path), TOTAL * 4)
+    download = run(cache.create(URL, TOTAL, None, [ByteRange(0, TOTAL)]))
+    receive(download, download.ranges[0], 10)
+    run(cache.flush(download, force=True))
+    run(cache.discard(URL))
+    assert not cache.downloads
+    assert not cache.active
+    assert not list(tmp_path.iterdir())
+
+
+def test_release_evicts_unused_downloads(run, tmp_path):
+    cache = DownloadCache(str(tmp_path), TOTAL)
+    urls = [URL.replace("song", f"song{index}") for index in range(3)]
+    for url in urls:
+        download = run(cache.create(url, TOTAL, None, [ByteRange(0, TOTAL)]))
+        receive(download, download.ranges[0], TOTAL)
+        run(cache.finish(download))
+    # Downloads still in use are kept even over the size limit
+    run(cache.release(urls[0]))
+    assert not (tmp_path / f"{_cache_key(urls[0])}.part").exists()
+    assert len(list(tmp_path.glob("*.part"))) == 2
+    run(cache.release(urls[1]))
+    run(cache.release(urls[2]))
+    assert len(list(tmp_path.glob("*.part"))) == 1
@@ -0,0 +1,130 @@
+import io
+
+import mutagen.mp4
+import pytest
+
+from src.exceptions import MP4ParseException
+from src.fmp4 import FragmentStream, parse_fragmented_mp4, parse_init_segment, parse_moof, parse_progressive_mp4, \
+    find_boxes, iter_boxes, make_plain_sample_entry, build_m4a, make_udta, check_box_tree
+from src.types import SampleTable
+from samples import FRAGMENTS, TIMESCALE, SAMPLE_DURATION, make_fmp4
+
+
+def test_parse_init_segment():
+    track, defaults = parse_init_segment(make_fmp4(FRAGMENTS))
+    assert (track.timescale, track.creation_time, track.modification_time) == (TIMESCALE, 3600, 7200)
+    assert len(track.entries) == 2
+    assert (track.entries[0].channels, track.entries[0].sample_size, track.entries[0].sample_rate) == (2, 16, TIMESCALE)
+    assert defaults.sample_duration == SAMPLE_DURATION
+    assert len(track.samples) == 0
+
+
+def test_parse_moof():
+    data = make_fmp4(FRAGMENTS)
+    track, defaults = parse_init_segment(data)
+    moofs = find_boxes(data, b"moof")
+    assert len(moofs) == len(FRAGMENTS)
+    parse_moof(data, moofs[1], defaults, track.samples)
+    assert [bytes(sample) for sample in track.samples.views()] == FRAGMENTS[1]
+    assert list(track.samples.desc_indexes) == [1]
+
+
+def test_parse_fragmented_mp4():
+    track = parse_fragmented_mp4(make_fmp4(FRAGMENTS))
+    expected = [sample for fragment in FRAGMENTS for sample in fragment]
+    assert len(track.samples) == len(expected)
+    assert list(track.samples.sizes) == [len(sample) for sample in expected]
+    assert [bytes(sample) for sample in track.samples.views()] == expected
+    assert list(track.samples.durations) == [SAMPLE_DURATION] * len(expected)
+    assert list(track.samples.desc_indexes) == [0, 0, 0, 1, 0, 0]
+
+
+def test_parse_truncated_fmp4():
+    data = make_fmp4(FRAGMENTS)
+    with pytest.raises(MP4ParseException):
+        parse_fragmented_mp4(data[:-10])
+
+
+def feed_in_chunks(stream: FragmentStream, buffer: bytearray, data: bytes, start: int, chunk_size: int):
+    samples = []
+    for filled in range(start + chunk_size, len(data) + chunk_size, chunk_size):
+        filled = min(filled, len(data))
+        buffer[:filled] = data[:filled]
+        samples.extend((index, bytes(sample), desc_index)
+                       for index, sample, desc_index in stream.feed(buffer, filled))
+    return samples
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 100000])
+def test_fragment_stream_matches_whole_file(chunk_size):
+    data = make_fmp4(FRAGMENTS)
+    track = parse_fragmented_mp4(data)
+    samples = feed_in_chunks(FragmentStream(), bytearray(len(data)), data, 0, chunk_size)
+    assert samples == [(index, bytes(sample), desc_index) for index, (sample, desc_index)
+                       in enumerate(zip(track.samples.views(), track.samples.desc_indexes))]
+
+
+def test_fragment_stream_restart():
+    data = make_fmp4(FRAGMENTS)
+    stream = FragmentStream()
+    # The first attempt fails after the second fragment
+    first_attempt = feed_in_chunks(stream, bytearray(len(data)), data[:data.index(b"e" * 50)], 0, 16)
+    assert [index for index, _, _ in first_attempt] == [0, 1, 2, 3]
+    # The restarted download hands out only the samples not seen before, at their original indexes
+    second_attempt = feed_in_chunks(stream, bytearray(len(data)), data, 0, 16)
+    assert second_attempt == [(4, b"e" * 50, 0), (5, b"f" * 60, 0)]
+
+
+def test_fragment_stream_rejects_moof_before_moov():
+    data = make_fmp4(FRAGMENTS)
+    moov_end = find_boxes(data, b"moof")[0].offset
+    fragments_only = data[moov_end:]
+    with pytest.raises(MP4ParseException):
+        FragmentStream().feed(bytearray(fragments_only), len(fragments_only))
+
+
+def test_sample_table():
+    samples = SampleTable(b"0123456789")
+    samples.append(2, 3, 100, 0)
+    samples.append(7, 2, 200, 1)
+    assert len(samples) == 2
+    assert bytes(samples.data(1)) == b"78"
+    assert [bytes(view) for view in samples.views()] == [b"234", b"78"]
+    assert samples.total_size() == 5
+    assert list(samples.durations) == [100, 200]
+    assert list(samples.desc_indexes) == [0, 1]
+
+
+def mux(tags: dict) -> tuple[bytes, list[bytes]]:
+    data = make_fmp4(FRAGMENTS)
+    track = parse_fragmented_mp4(data)
+    media = b"".join(bytes(sample) for sample in track.samples.views())
+    song = build_m4a(make_plain_sample_entry(data, track.entries[0]), track.timescale, track.samples.sizes,
+                     track.samples.durations, media, track.creation_time, track.modification_time, make_udta(tags))
+    return song, [bytes(sample) for sample in track.samples.views()]
+
+
+def test_build_m4a():
+    song, samples = mux({})
+    check_box_tree(song)
+    track = parse_progressive_mp4(song)
+    assert [bytes(sample) for sample in track.samples.views()] == samples
+    assert sum(track.samples.durations) == SAMPLE_DURATION * len(samples)
+    assert (track.timescale, track.creation_time, track.modification_time) == (TIMESCALE, 3600, 7200)
+    assert [box.type for box in iter_boxes(song)] == [b"ftyp", b"moov", b"mdat"]
+
+
+def test_ilst_round_trip():
+    tags = {"\xa9nam": "Title", "\xa9ART": ["Artist"], "trkn": [(3, 12)], "disk": [(1, 2)], "rtng": [1],
+            "covr": [mutagen.mp4.MP4Cover(b"\x89PNG cover", imageformat=mutagen.mp4.MP4Cover.FORMAT_PNG)],
+            "----:com.apple.iTunes:ISRC": [b"USRC17607839"]}
+    song, _ = mux(tags)
+    read = mutagen.mp4.MP4(io.BytesIO(song))
+    assert read.tags["\xa9nam"] == ["Title"]
+    assert read.tags["\xa9ART"] == ["Artist"]
+    assert read.tags["trkn"] == [(3, 12)]
+    assert read.tags["disk"] == [(1, 2)]
+    assert read.tags["rtng"] == [1]
+    assert read.tags["covr"] == [b"\x89PNG cover"]
+    assert read.tags["covr"][0].imageformat == mutagen.mp4.MP4Cover.FORMAT_PNG
+    assert read.tags["----:com.apple.iTunes:ISRC"] == [b"USRC17607839"]
@@ -0,0 +1,160 @@
+import asyncio
+import time
+from datetime import datetime
+
+import pytest
+from creart import it
+
+import src.limiter
+from src.config import Config, BandwidthRule
+from src.limiter import AdaptiveLimiter, TokenBucket, BandwidthShaper, TrafficClass, RequestScheduler, Lane, \
+    ADJUST_INTERVAL, BURST_SECONDS
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_adaptive_limiter_limits_concurrency(run):
+    async def main():
+        limiter = AdaptiveLimiter(2, 1, 4)
+        running, peak = 0, 0
+
+        async def work():
+            nonlocal running, peak
+            async with limiter:
+                running += 1
+                peak = max(peak, running)
+                await asyncio.sleep(0.01)
+                running -= 1
+
+        await asyncio.gather(*[work() for _ in range(6)])
+        return peak, limiter.active
+
+    assert run(main()) == (2, 0)
+
+
+def test_adaptive_limiter_woken_waiter_cancelled(run):
+    async def main():
+        limiter = AdaptiveLimiter(1, 1, 1)
+        await limiter.acquire()
+        first = asyncio.create_task(limiter.acquire())
+        second = asyncio.create_task(limiter.acquire())
+        await settle()
+        limiter.release()
+        # The first waiter got the slot, but is cancelled before it could take it
+        first.cancel()
+        await settle()
+        return first.cancelled(), second.done(), limiter.active
+
+    assert run(main()) == (True, True, 1)
+
+
+def test_adaptive_limiter_halves_on_errors(run):
+    async def main():
+        limiter = AdaptiveLimiter(8, 2, 8)
+        limiter.record_error()
+        limiter._last_adjust -= ADJUST_INTERVAL
+        await limiter.acquire()
+        limiter.release()
+        return limiter.limit
+
+    assert run(main()) == 4
+
+
+def test_adaptive_limiter_grows_with_waiters(run):
+    async def main():
+        limiter = AdaptiveLimiter(1, 1, 4)
+        await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await settle()
+        limiter._last_adjust -= ADJUST_INTERVAL
+        limiter._adjust()
+        await settle()
+        return limiter.limit, waiter.done()
+
+    assert run(main()) == (2, True)
+
+
+def test_token_bucket(run):
+    async def main():
+        bucket = TokenBucket()
+        await bucket.consume(10 ** 9, 0)
+        start = time.monotonic()
+        rate = 10000
+        for _ in range(4):
+            await bucket.consume(rate // 10, rate)
+        return time.monotonic() - start
+
+    # 0.4 seconds of traffic, of which at most BURST_SECONDS were saved up before
+    assert run(main()) >= 0.4 - BURST_SECONDS - 0.05
+
+
+def test_bandwidth_schedule(monkeypatch):
+    class Night(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime(2026, 1, 1, 23, 30)
+
+    download = it(Config).download
+    monkeypatch.setattr(src.limiter, "datetime", Night)
+    monkeypatch.setattr(download, "audioBandwidth", 100)
+    monkeypatch.setattr(download, "artworkBandwidth", 10)
+    monkeypatch.setattr(download, "bandwidthSchedule", [BandwidthRule(start="22:00", end="06:00", audio=0),
+                                                        BandwidthRule(start="08:00", end="18:00", artwork=1)])
+    # The rule over midnight lifts the audio limit, the rule of the day does not apply
+    assert BandwidthShaper.rate(TrafficClass.AUDIO) == 0
+    assert BandwidthShaper.rate(TrafficClass.ARTWORK) == 10 * 1024
+
+
+def test_request_scheduler_priority(run):
+    async def main():
+        scheduler = RequestScheduler(1, {})
+        order = []
+        await scheduler.acquire(Lane.METADATA)
+
+        async def request(lane: Lane):
+            async with scheduler.slot(lane):
+                order.append(lane)
+
+        tasks = [asyncio.create_task(request(lane)) for lane in (Lane.ARTWORK, Lane.EXISTENCE, Lane.INTERACTIVE)]
+        await settle()
+        scheduler.release(Lane.METADATA)
+        await asyncio.gather(*tasks)
+        return order, scheduler.active
+
+    order, active = run(main())
+    assert order == [Lane.INTERACTIVE, Lane.EXISTENCE, Lane.ARTWORK]
+    assert not any(active.values())
+
+
+def test_request_scheduler_lane_limit(run):
+    async def main():
+        scheduler = RequestScheduler(4, {"artwork": 1})
+        await scheduler.acquire(Lane.ARTWORK)
+        artwork = asyncio.create_task(scheduler.acquire(Lane.ARTWORK))
+        metadata = asyncio.create_task(scheduler.acquire(Lane.METADATA))
+        await settle()
+        result = artwork.done(), metadata.done()
+        artwork.cancel()
+        await settle()
+        return result
+
+    assert run(main()) == (False, True)
+
+
+def test_request_scheduler_cancelled_waiter(run):
+    async def main():
+        scheduler = RequestScheduler(1, {})
+        await scheduler.acquire(Lane.METADATA)
+        waiter = asyncio.create_task(scheduler.acquire(Lane.METADATA))
+        await settle()
+        scheduler.release(Lane.METADATA)
+        # Granted and cancelled at once, the slot must not leak
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        return sum(scheduler.active.values())
+
+    assert run(main()) == 0
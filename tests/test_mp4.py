@@ -0,0 +1,67 @@
+from src.fmp4 import iter_boxes, check_box_tree, parse_progressive_mp4
+from src.mp4 import extract_song_native, encapsulate_native, check_song_structure, build_sampled_clip
+from src.types import Codec
+from samples import FRAGMENTS, make_fmp4
+
+
+def test_extract_song_native():
+    song_info = extract_song_native(make_fmp4(FRAGMENTS), Codec.ALAC)
+    assert len(song_info.samples) == sum(len(fragment) for fragment in FRAGMENTS)
+    assert b"".join(bytes(sample) for sample in song_info.samples.views()) == \
+        b"".join(sample for fragment in FRAGMENTS for sample in fragment)
+    assert song_info.decoderParams[4:8] == b"alac"
+
+
+def test_extract_song_native_keeps_download_buffer():
+    raw_song = bytearray(make_fmp4(FRAGMENTS))
+    song_info = extract_song_native(raw_song, Codec.ALAC)
+    assert song_info.raw is raw_song
+    assert song_info.samples.buffer is raw_song
+    assert isinstance(song_info.decoderParams, bytes)
+
+
+def make_song():
+    song_info = extract_song_native(make_fmp4(FRAGMENTS), Codec.ALAC)
+    media = b"".join(bytes(sample) for sample in song_info.samples.views())
+    return song_info, media, encapsulate_native(song_info, media)
+
+
+def test_check_song_structure():
+    song_info, _, song = make_song()
+    assert check_song_structure(song, song_info) is None
+
+
+def test_check_song_structure_truncated():
+    song_info, _, song = make_song()
+    assert check_song_structure(song[:-1], song_info)
+    assert check_song_structure(song[:len(song) // 2], song_info)
+
+
+def test_check_song_structure_missing_samples():
+    # Samples that were lost on the way into the song
+    song_info, _, song = make_song()
+    song_info.samples.append(len(song_info.raw), 10, 4096, 0)
+    assert check_song_structure(song, song_info) == "Song has 6 samples, expected 7"
+
+
+def test_check_song_structure_corrupted_box():
+    song_info, _, song = make_song()
+    mdat = next(box for box in iter_boxes(song) if box.type == b"mdat")
+    corrupted = bytearray(song)
+    corrupted[mdat.offset:mdat.offset + 4] = (mdat.size + 100).to_bytes(4, "big")
+    assert check_song_structure(bytes(corrupted), song_info)
+
+
+def test_check_raw_atmos_structure():
+    song_info, media, _ = make_song()
+    assert check_song_structure(media, song_info, raw_atmos=True) is None
+    assert check_song_structure(media[:-1], song_info, raw_atmos=True)
+
+
+def test_build_sampled_clip():
+    song_info, _, song = make_song()
+    clip = build_sampled_clip(song, song_info, False, 2)
+    assert check_box_tree(clip) is None
+    samples = parse_progressive_mp4(clip).samples
+    assert 0 < len(samples) <= len(song_info.samples)
+    assert all(bytes(sample) in song for sample in samples.views())
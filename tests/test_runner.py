@@ -0,0 +1,47 @@
+import asyncio
+import sys
+
+import pytest
+
+from src.exceptions import ToolException
+from src.runner import ToolRunner
+
+
+def test_tool_runner_output(run):
+    runner = ToolRunner(1, 10)
+    result = run(runner.run([sys.executable, "-c", "import sys; sys.stdout.write(sys.stdin.read())"],
+                            input=b"song"))
+    assert (result.returncode, result.stdout) == (0, b"song")
+
+
+def test_tool_runner_check(run):
+    runner = ToolRunner(1, 10)
+    argv = [sys.executable, "-c", "import sys; sys.stderr.write('broken'); sys.exit(3)"]
+    with pytest.raises(ToolException) as e:
+        run(runner.run(argv))
+    assert (e.value.returncode, e.value.stderr) == (3, "broken")
+    assert run(runner.run(argv, check=False)).returncode == 3
+    stats = next(iter(runner.stats.values()))
+    assert (stats.count, stats.failures, stats.running) == (2, 1, 0)
+
+
+def test_tool_runner_timeout_kills(run):
+    runner = ToolRunner(1, 10)
+    with pytest.raises(ToolException) as e:
+        run(runner.run([sys.executable, "-c", "import time; time.sleep(30)"], timeout=0.2))
+    assert e.value.returncode is None
+    assert next(iter(runner.stats.values())).running == 0
+
+
+def test_tool_runner_cancel_kills(run):
+    async def main():
+        runner = ToolRunner(1, 10)
+        task = asyncio.create_task(runner.run([sys.executable, "-c", "import time; time.sleep(30)"]))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # The semaphore of the tool is free again
+        return (await runner.run([sys.executable, "-c", "pass"], timeout=5)).returncode
+
+    assert run(main()) == 0
@@ -0,0 +1,47 @@
+from pathlib import Path
+
+import pytest
+
+from src.scratch import ScratchSpace, SCRATCH_PREFIX
+
+
+def test_workspace(run, tmp_path):
+    scratch = ScratchSpace(str(tmp_path), 1000)
+
+    async def main():
+        async with scratch.workspace(600) as tmp_dir:
+            inside = Path(tmp_dir.name)
+            (inside / "song.m4a").write_bytes(b"0" * 600)
+            # Over the budget, the second workspace goes to the default temporary directory
+            async with scratch.workspace(600) as other_dir:
+                outside = Path(other_dir.name)
+            used = scratch.used
+        return inside, outside, used
+
+    inside, outside, used = run(main())
+    assert inside.parent == tmp_path
+    assert outside.parent != tmp_path
+    assert used == 600
+    assert not inside.exists() and not outside.exists()
+    assert scratch.used == 0
+
+
+def test_workspace_removed_on_failure(run, tmp_path):
+    scratch = ScratchSpace(str(tmp_path), 1000)
+
+    async def main():
+        async with scratch.workspace(10) as tmp_dir:
+            (Path(tmp_dir.name) / "song.m4a").write_bytes(b"0")
+            raise RuntimeError("tool failed")
+
+    with pytest.raises(RuntimeError):
+        run(main())
+    assert not list(tmp_path.iterdir())
+    assert scratch.used == 0
+
+
+def test_sweep_removes_workspaces_of_dead_processes(tmp_path):
+    # PIDs are far below this on every system
+    (tmp_path / f"{SCRATCH_PREFIX}999999999-abc").mkdir()
+    ScratchSpace(str(tmp_path), 1000)
+    assert not list(tmp_path.iterdir())
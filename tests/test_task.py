@@ -0,0 +1,59 @@
+import asyncio
+
+from src.mp4 import extract_song_native
+from src.task import Task
+from src.types import Codec
+from samples import FRAGMENTS, make_fmp4
+
+
+def stream_samples(task: Task, song: bytes):
+    task.begin_decrypted_samples()
+    task.reserve_decrypted_media(len(song))
+    for fragment in FRAGMENTS:
+        for sample in fragment:
+            task.add_decrypted_sample(len(sample))
+
+
+def test_streamed_samples():
+    song = make_fmp4(FRAGMENTS)
+    task = Task("1")
+    stream_samples(task, song)
+    media = task.decryptedMedia
+    task.info = extract_song_native(song, Codec.ALAC)
+    assert not task.decrypt_finished()
+    assert task.seal_decrypted_samples()
+    # The reserve is trimmed in place instead of being copied
+    assert task.decryptedMedia is media
+    assert len(task.decryptedMedia) == task.info.samples.total_size()
+    samples = [sample.upper() for fragment in FRAGMENTS for sample in fragment]
+    for index, sample in reversed(list(enumerate(samples))):
+        assert task.write_decrypted_sample(index, sample)
+    assert not task.write_decrypted_sample(0, samples[0])
+    assert task.decrypt_finished()
+    assert task.decryptedMedia == b"".join(samples)
+
+
+def test_streamed_samples_differ_from_sample_table():
+    song = make_fmp4(FRAGMENTS)
+    task = Task("1")
+    stream_samples(task, song)
+    task.add_decrypted_sample(10)
+    task.info = extract_song_native(song, Codec.ALAC)
+    assert not task.seal_decrypted_samples()
+    task.init_decrypted_samples()
+    assert len(task.decryptedMedia) == task.info.samples.total_size()
+    assert task.missing_ranges() == [(0, len(task.info.samples))]
+
+
+def test_decrypt_drained(run):
+    async def main():
+        task = Task("1")
+        task.decrypt_sent()
+        task.decrypt_sent()
+        task.decrypt_received()
+        drained = task.decryptDrained.is_set()
+        task.decrypt_received()
+        await asyncio.wait_for(task.decryptDrained.wait(), 1)
+        return drained
+
+    assert run(main()) is False
@@ -0,0 +1,111 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import m3u8
+import pytest
+from creart import add_creator
+
+import src.utils
+from src.grpc.manager import WrapperManager, WMCreator
+from src.types import Codec
+from src.utils import run_sync, get_executor_status, ExecutorStats, ExecutorType, _check_existence, \
+    _remember_existence, vouch_song_existence, NEGATIVE_EXISTENCE_TTL, get_codec_from_codec_id, index_variants, \
+    find_best_codec
+
+# The wrapper manager only needs the regions of its status, which the tests replace
+add_creator(WMCreator)
+
+
+def test_executor_status(monkeypatch):
+    monkeypatch.setattr(src.utils, "executor_stats", {ExecutorType.IO: ExecutorStats(submitted=7, completed=2)})
+    monkeypatch.setattr(src.utils, "executor_workers", {ExecutorType.IO: 2})
+    # Jobs beyond the workers are queued, not running
+    assert get_executor_status() == "io: 2 running, 3 queued, 0.000s average wait"
+
+
+def test_run_sync(run):
+    assert run(run_sync(threading.current_thread)) is not threading.current_thread()
+    assert run(run_sync(sum, [1, 2, 3])) == 6
+
+
+@pytest.fixture
+def storefronts(monkeypatch):
+    """Regions of the wrapper, the song is only available when checked from jp"""
+    async def status(self):
+        return SimpleNamespace(regions=["us", "jp", "gb"])
+
+    monkeypatch.setattr(WrapperManager, "status", status)
+    monkeypatch.setattr(src.utils, "_existence_cache", OrderedDict())
+    probes = []
+
+    async def exist_on_storefront(item_id: str, region: str, m_region: str):
+        probes.append(m_region)
+        await asyncio.sleep(0.01 if m_region == "jp" else 1)
+        return m_region == "jp"
+
+    return probes, exist_on_storefront
+
+
+def test_check_existence(run, storefronts):
+    probes, exist_on_storefront = storefronts
+    start = time.monotonic()
+    assert run(_check_existence("song", "1", "us", exist_on_storefront))
+    # The regions are probed at once and the slow ones are not waited for
+    assert time.monotonic() - start < 0.5
+    assert sorted(probes) == ["gb", "jp", "us"]
+    assert run(_check_existence("song", "1", "US", exist_on_storefront))
+    assert len(probes) == 3
+
+
+def test_check_existence_negative_ttl(run, storefronts, monkeypatch):
+    probes, _ = storefronts
+
+    async def missing(item_id: str, region: str, m_region: str):
+        probes.append(m_region)
+        return False
+
+    assert not run(_check_existence("album", "1", "us", missing))
+    assert not run(_check_existence("album", "1", "us", missing))
+    assert len(probes) == 3
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + NEGATIVE_EXISTENCE_TTL + 1)
+    assert not run(_check_existence("album", "1", "us", missing))
+    assert len(probes) == 6
+
+
+def test_existence_cache_bound(storefronts, monkeypatch):
+    monkeypatch.setattr(src.utils, "EXISTENCE_CACHE_SIZE", 2)
+    _remember_existence(("song", "1", "US"), True)
+    vouch_song_existence(["2", "3"], "us")
+    assert list(src.utils._existence_cache) == [("song", "2", "US"), ("song", "3", "US")]
+
+
+@pytest.mark.parametrize("codec_id, codec", [("audio-alac-stereo-44100-24", Codec.ALAC),
+                                             ("audio-alac-stereo-192000-24", Codec.ALAC),
+                                             ("audio-atmos-2768", Codec.EC3),
+                                             ("audio-ec3-2768", Codec.EC3),
+                                             ("audio-ac3-768", Codec.AC3),
+                                             ("audio-stereo-256", Codec.AAC),
+                                             ("audio-stereo-256-binaural", Codec.AAC_BINAURAL),
+                                             ("audio-stereo-256-downmix", Codec.AAC_DOWNMIX),
+                                             ("audio-stereo-64-he", "")])
+def test_get_codec_from_codec_id(codec_id, codec):
+    assert get_codec_from_codec_id(codec_id) == codec
+
+
+def test_index_variants():
+    variants = [("audio-stereo-256", 256000), ("audio-alac-stereo-44100-24", 1000000),
+                ("audio-alac-stereo-96000-24", 3000000), ("audio-stereo-64-he", 64000)]
+    parsed_m3u8 = m3u8.loads("#EXTM3U\n" + "".join(
+        f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},AVERAGE-BANDWIDTH={bandwidth},AUDIO="{codec_id}"\n{codec_id}.m3u8\n'
+        for codec_id, bandwidth in variants))
+    index = index_variants(parsed_m3u8)
+    # Highest average bandwidth first, unknown codecs are left out
+    assert [playlist.uri for playlist in index[Codec.ALAC]] == ["audio-alac-stereo-96000-24.m3u8",
+                                                                 "audio-alac-stereo-44100-24.m3u8"]
+    assert set(index) == {Codec.ALAC, Codec.AAC, Codec.AAC_LEGACY}
+    assert find_best_codec(parsed_m3u8, Codec.AAC_LEGACY, index).uri == "audio-stereo-256.m3u8"
+    assert find_best_codec(parsed_m3u8, Codec.EC3) is None